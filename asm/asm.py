@@ -14,6 +14,10 @@
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
 
+import collections
+import hashlib
+import json
+import os
 import sys
 import re
 
@@ -55,338 +59,987 @@ OPCODES = {
     "XOR":  {"type": 2, "code": "10101011"},
 }
 
-# Regex for matching lines
-# Capturing groups: label, opcode, operandA, operandB
-REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
+# Machine code for each opcode, as an int
+MACHINE_CODES = {opcode: int(info["code"], 2) for opcode, info in OPCODES.items()}
 
-# Regex for capturing DS and DB data
-REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
-REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
+# Number of operands taken by each opcode type
+OPERAND_COUNTS = {
+    0: 0,
+    1: 1,
+    2: 2,
+    8: 2,   # LDI r,i or LDI r,label
+}
+
+# Pattern for classifying a line, with comments and whitespace stripped
+# Capturing groups: label, DS or DB, DS/DB data, opcode, operandA, operandB
+LINE_PATTERN = re.compile(
+    r"(?:(\w+?):)?\s*"
+    r"(?:(?i:(DS|DB))\b\s*(.*)"
+    r"|(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
+)
+
+# Pattern for register operands
+REGISTER_PATTERN = re.compile(r"R([0-7])")
+
+# Where the emulator is, for its .ls8b image writer (ls8/image.py)
+LS8_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ls8")
+
+# Version of the assembler cache file format. See save_cache()
+CACHE_VERSION = 1
+
+# What pass 1 produces for each source line:
+#   label   - the label defined on the line, or None
+#   op      - the opcode or pseudo-opcode (DS, DB), or None
+#   data    - the bytes the line assembles to, as ints, or as symbol names
+#             to look up in pass 2
+#   comment - what to show next to the first byte in .ls8 output
+Statement = collections.namedtuple("Statement", ["label", "op", "data", "comment"])
 
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-O] [inputfile] [outputfile]
+
+    If outputfile ends in .ls8b, a binary image is written instead of text.
+    -O optimizes the code between pass 1 and pass 2.
     """
 
-    if len(argv) == 1:
+    args = [arg for arg in argv[1:] if arg != "-O"]
+    optimize = len(args) < len(argv) - 1
+
+    if len(args) == 0:
         inputfile = "-"
         outputfile = "-"
 
-    elif len(argv) == 2:
-        inputfile = argv[1]
+    elif len(args) == 1:
+        inputfile = args[0]
         outputfile = "-"
 
-    elif len(argv) == 3:
-        inputfile = argv[1]
-        outputfile = argv[2]
+    elif len(args) == 2:
+        inputfile = args[0]
+        outputfile = args[1]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [-O] [infile.asm] [outfile.ls8|outfile.ls8b]",
+              file=sys.stderr)
         sys.exit(1)
 
-    return inputfile, outputfile
+    return inputfile, outputfile, optimize
 
 
-def open_files(inputfile, outputfile):
+def open_output(outputfile):
     """
-    Open files for reading and writing. If either of the files are named "-",
-    stdin or stdout is returned as appropriate.
+    Open the output file for writing. If it's named "-", stdout is returned.
     """
 
-    if inputfile == "-":
-        inputfile = sys.stdin
-    else:
-        inputfile = open(inputfile)
-
     if outputfile == "-":
-        outputfile = sys.stdout
-    else:
-        outputfile = open(outputfile, "w")
+        return sys.stdout
 
-    return inputfile, outputfile
+    if is_binary(outputfile):
+        return open(outputfile, "wb")
 
+    return open(outputfile, "w")
 
-def normalize_line(groups):
+
+def is_binary(outputfile):
     """
-    Takes match groups and uppercases them if they're not None.
+    Binary images are written for output files ending in .ls8b
     """
 
-    result = []
-
-    for g in groups:
-        if g is None:
-            result.append(None)
-        else:
-            result.append(g.upper())
-
-    return result
+    return outputfile.endswith(".ls8b")
 
 
 def p8(v):
     return "{:08b}".format(v)
 
 
-def pass1(inputfile, sym, code):
+# p8() of every byte value, looked up rather than formatted in pass 2
+BITS = [p8(v) for v in range(256)]
+
+
+def get_reg(op, line_num):
+    """Get a register number from a string, e.g. "R2" -> 2"""
+
+    m = REGISTER_PATTERN.match(op)
+
+    if m is None:
+        print(f"Line {line_num}: unknown register {op}", file=sys.stderr)
+        sys.exit(1)
+
+    return int(m.group(1))
+
+
+def out0(opcode, op_a, op_b, machine_code, line_num):
+    """Handle opcodes with zero operands"""
+
+    return (machine_code,), opcode
+
+
+def out1(opcode, op_a, op_b, machine_code, line_num):
+    """Handle opcodes with one operand"""
+
+    reg_a = get_reg(op_a, line_num)
+
+    return (machine_code, reg_a), f"{opcode} {op_a}"
+
+
+def out2(opcode, op_a, op_b, machine_code, line_num):
+    """Handle opcodes with two operands"""
+
+    reg_a = get_reg(op_a, line_num)
+    reg_b = get_reg(op_b, line_num)
+
+    return (machine_code, reg_a, reg_b), f"{opcode} {op_a},{op_b}"
+
+
+def out8(opcode, op_a, op_b, machine_code, line_num):
+    """Handle LDI opcode (type 8)"""
+
+    reg_a = get_reg(op_a, line_num)
+
+    try:
+        val_b = int(op_b, 0) & 0xff
+
+    except ValueError:
+        # If it's not a value, it might be a symbol
+        val_b = op_b
+
+    return (machine_code, reg_a, val_b), f"{opcode} {op_a},{op_b}"
+
+
+# Type to function mapping
+type_f = {
+    0: out0,
+    1: out1,
+    2: out2,
+    8: out8,
+}
+
+# Everything needed to assemble each opcode, looked up once per line:
+# (machine code, number of operands, output function)
+INSTRUCTIONS = {
+    opcode: (MACHINE_CODES[opcode], OPERAND_COUNTS[info["type"]],
+             type_f[info["type"]])
+    for opcode, info in OPCODES.items()
+}
+
+# The Statement for lines with nothing on them
+BLANK = Statement(None, None, (), None)
+
+
+def handle_ds(data, line_num):
+    """
+    Handle DS pseudo-opcode
+    """
+
+    return tuple(map(ord, data)), None
+
+
+def handle_db(data, line_num):
+    """
+    Handle the DB pseudo-opcode
+    """
+
+    try:
+        val = int(data, 0)
+
+    except ValueError:
+        print(f"line {line_num}: invalid integer argument to DB",
+              file=sys.stderr)
+        sys.exit(2)
+
+    # Force to byte size
+    val &= 0xff
+
+    return (val,), data
+
+
+# Pseudo-opcode to function mapping
+pseudo_f = {
+    'DS': handle_ds,
+    'DB': handle_db,
+}
+
+
+def parse_line(line, line_num):
+    """
+    Parse a line of source into a Statement. The result only depends on the
+    text of the line, not on where it is in the program, so it can be cached.
+    """
+
+    # Strip comments and whitespace
+    line = line.partition(';')[0].strip()
+
+    if line == '':
+        return BLANK
+
+    label, pseudo, data, opcode, op_a, op_b = LINE_PATTERN.match(line).groups()
+
+    if label is not None:
+        label = label.upper()
+
+    if pseudo is not None:
+        pseudo = pseudo.upper()
+
+        if data == '':
+            print(f"line {line_num}: missing argument to {pseudo}",
+                  file=sys.stderr)
+            sys.exit(2)
+
+        return Statement(label, pseudo, *pseudo_f[pseudo](data, line_num))
+
+    if opcode is None:
+        return Statement(label, None, (), None)
+
+    opcode = opcode.upper()
+
+    # Make sure we know this opcode at all
+    instruction = INSTRUCTIONS.get(opcode)
+
+    if instruction is None:
+        print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
+        sys.exit(2)
+
+    machine_code, operand_count, handler = instruction
+
+    # Make sure we have the right operand count
+    found = 0
+
+    if op_a is not None:
+        op_a = op_a.upper()
+        found += 1
+
+    if op_b is not None:
+        op_b = op_b.upper()
+        found += 1
+
+    if found < operand_count:
+        print(f"Line {line_num}: missing operand to {opcode}", file=sys.stderr)
+        sys.exit(1)
+    elif found > operand_count:
+        print(f"Line {line_num}: unexpected operand to {opcode}",
+              file=sys.stderr)
+        sys.exit(1)
+
+    return Statement(label, opcode,
+                     *handler(opcode, op_a, op_b, machine_code, line_num))
+
+
+def pass1(inputfile, sym, code, cache=None):
     """
     Pass 1
 
     * Read the source code lines
     * Parse labels, opcodes, and operands
     * Record label offsets
-    * Emit machine code
+    * Emit a Statement for each line
+
+    cache maps the text of lines to the Statements they were parsed into. Lines
+    found there aren't parsed again, and new lines are added to it. Without
+    one, lines that repeat are still only parsed once.
     """
 
-    # Source line number
-    line_num = 0
+    if cache is None:
+        cache = {}
 
     # Current code address (for labels)
     addr = 0
 
-    def get_reg(op, fatal=True):
-        """Get a register number from a string, e.g. "R2" -> 2"""
+    for line_num, line in enumerate(inputfile, 1):
+        statement = cache.get(line)
+
+        if statement is None:
+            statement = cache[line] = parse_line(line, line_num)
+
+        # Track label address
+        if statement.label is not None:
+            sym[statement.label] = addr
+
+        code.append(statement)
+        addr += len(statement.data)
+
+
+def resolve(value, sym):
+    """
+    Get the byte for a value in a Statement's data, looking up symbols
+    """
+
+    if isinstance(value, int):
+        return value
+
+    if value not in sym:
+        print(f"unknown symbol: {value}", file=sys.stderr)
+        sys.exit(2)
+
+    return sym[value] & 0xff
+
+
+def link(sym, code):
+    """
+    Get the machine code for the Statements from pass 1 as bytes, substituting
+    in any symbols
+    """
+
+    data = bytearray()
+
+    for statement in code:
+        for value in statement.data:
+            data.append(resolve(value, sym))
+
+    return data
+
+
+def data_regions(code):
+    """
+    Get the (start, length) regions of memory filled by DS and DB lines,
+    merging regions that are next to each other
+    """
 
-        nonlocal line_num
+    regions = []
+    address = 0
 
-        m = re.match(r"R([0-7])", op)
+    for statement in code:
+        length = len(statement.data)
 
-        if m is None:
-            if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
+        if statement.op in ("DS", "DB") and length:
+            if regions and regions[-1][0] + regions[-1][1] == address:
+                start, previous = regions[-1]
+                regions[-1] = (start, previous + length)
             else:
-                return None
+                regions.append((address, length))
+
+        address += length
 
-        return int(m.group(1))
+    return regions
 
-    def out0(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with zero operands"""
 
-        nonlocal addr
+def load_cache(path):
+    """
+    Read an assembler cache file. Returns the hash of the source it was made
+    from, its symbol table, and a dict of line text to Statement, or None if
+    the cache can't be used
+    """
 
-        code.append(f"{machine_code} # {opcode}")
-        addr += 1
+    try:
+        with open(path) as cachefile:
+            cached = json.load(cachefile)
 
-    def out1(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with one operand"""
+        if cached["version"] != CACHE_VERSION:
+            return None
 
-        nonlocal addr
+        lines = {}
 
-        reg_a = get_reg(op_a)
-        code.append(f"{machine_code} # {opcode} {op_a}")
-        code.append(p8(reg_a))
-        addr += 2
+        for text, label, opcode, data, comment in cached["lines"]:
+            lines[text] = Statement(label, opcode, tuple(data), comment)
 
-    def out2(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with two operands"""
+        return cached["hash"], cached["symbols"], lines
 
-        nonlocal addr
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_cache(path, source_hash, sym, source, code):
+    """
+    Write an assembler cache file, keeping the parsed form of every line. A
+    cache that can't be written is skipped
+    """
 
-        reg_a = get_reg(op_a)
-        reg_b = get_reg(op_b)
+    lines = []
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(p8(reg_b))
+    for text, statement in zip(source, code):
+        lines.append([text, *statement])
 
-        addr += 3
+    cached = {
+        "version": CACHE_VERSION,
+        "hash": source_hash,
+        "symbols": sym,
+        "lines": lines,
+    }
 
-    def out8(opcode, op_a, op_b, machine_code):
-        """Handle LDI opcode (type 8)"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
 
-        nonlocal addr
+    try:
+        with open(temp_path, "w") as cachefile:
+            json.dump(cached, cachefile)
 
-        reg_a = get_reg(op_a)
+        os.replace(temp_path, path)
 
+    except OSError:
         try:
-            val_b = int(op_b, 0)
-            out_b = p8(val_b)
+            os.remove(temp_path)
+        except OSError:
+            pass
 
-        except ValueError:
-            # If it's not a value, it might be a symbol
-            out_b = f"sym:{op_b}"
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(out_b)
+def cache_path(path):
+    """
+    Get the path of the cache for a source file: .name.asmcache next to it
+    """
 
-        addr += 3
+    directory, name = os.path.split(path)
 
-    def handle_ds(line):
-        """
-        Handle DS pseudo-opcode
-        """
+    return os.path.join(directory, f".{name}cache")
 
-        nonlocal addr
 
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
+def assemble_file(path, sym, code):
+    """
+    Run pass 1 on a source file, using the cache kept next to it. If the
+    source hasn't changed, the cached symbol table and Statements are used as
+    they are. Otherwise only the lines that aren't in the cache are parsed.
+    """
 
-        if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
-            sys.exit(2)
+    with open(path) as inputfile:
+        source = inputfile.readlines()
 
-        data = m.group(2)
+    source_hash = hashlib.sha256("".join(source).encode()).hexdigest()
 
-        for i in range(len(data)):
-            print_char = data[i]
+    path_of_cache = cache_path(path)
+    cached = load_cache(path_of_cache)
 
-            if print_char == ' ':
-                print_char = '[space]'
+    if cached is not None and cached[0] == source_hash:
+        _, cached_sym, lines = cached
 
-            code.append(f"{p8(ord(data[i]))} # {print_char}")
+        sym.update(cached_sym)
+        code.extend(lines[text] for text in source)
+        return
 
-        addr += len(data)
+    lines = {} if cached is None else cached[2]
 
-    def handle_db(line):
-        """
-        Handle the DB pseudo-opcode
-        """
+    pass1(source, sym, code, lines)
 
-        nonlocal addr
+    save_cache(path_of_cache, source_hash, sym, source, code)
 
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
 
-        if m is None or m.group(2) is None:
-            print(f"line {line}: missing argument to DB", file=sys.stderr)
-            sys.exit(2)
+# The optimizer (asm.py -O) rewrites the Statements from pass 1 before pass 2
+# outputs them. Code and data move when instructions are removed, so it
+# assumes the program only refers to addresses in itself through labels. See
+# absolute_addresses() for the check that it does.
+
+# Constant folding for ALU operations, giving the same results as the CPU
+# before the result is ANDed with 0xFF. None means there is no result, since
+# dividing by zero halts the CPU
+BINARY_FOLDS = {
+    "ADD": lambda x, y: x + y,
+    "SUB": lambda x, y: x - y,
+    "MUL": lambda x, y: x * y,
+    "DIV": lambda x, y: x // y if y else None,
+    "MOD": lambda x, y: x % y if y else None,
+    "AND": lambda x, y: x & y,
+    "OR": lambda x, y: x | y,
+    "XOR": lambda x, y: x ^ y,
+    "SHL": lambda x, y: x << y,
+    "SHR": lambda x, y: x >> y,
+}
 
-        data = m.group(2)
+UNARY_FOLDS = {
+    "INC": lambda x: x + 1,
+    "DEC": lambda x: x - 1,
+    "NOT": lambda x: ~x,
+}
 
-        try:
-            val = int(data, 0)
+# Jumps through a register, and the instructions that never go on to the next
+# instruction
+JUMPS = {"JMP", "JEQ", "JNE", "JGT", "JLT", "JGE", "JLE"}
+TERMINATORS = {"JMP", "RET", "IRET", "HLT"}
 
-        except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
-                  file=sys.stderr)
-            sys.exit(2)
+# Instructions that use the stack
+STACK_OPS = {"PUSH", "POP", "CALL", "RET", "IRET", "INT"}
 
-        # Force to byte size
-        val &= 0xff
+# Registers whose values are tracked. R6 (IS) is changed by devices and R7
+# (SP) by the stack instructions, so they're never known
+TRACKED_REGISTERS = range(6)
 
-        code.append(f"{p8(val)} # {data}")
+# Registers that LDIs can be removed or moved to earlier for. When R5 (IM) is
+# written decides which interrupts can be taken, so LDIs to it stay put
+GENERAL_REGISTERS = range(5)
 
-        addr += 1
 
-    def check_ops(opcode, op_a, op_b):
-        """Check operands for sanity with a particular opcode"""
+def registers_used(statement):
+    """
+    Get the registers an instruction Statement reads, and the ones it writes
+    """
 
-        def check_ops_count(desired, found):
-            # Makes sure we have right operand count
-            if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
-            elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+    op = statement.op
+    operands = statement.data[1:]
 
-        # Make sure we know this opcode at all
-        if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
-            sys.exit(2)
+    if op == "LDI" or op == "POP":
+        return (), operands[:1]
 
-        op_type = OPCODES[opcode]["type"]
+    if op == "LD":
+        return operands[1:], operands[:1]
 
-        total_operands = 0
+    if op in BINARY_FOLDS or op in UNARY_FOLDS:
+        return operands, operands[:1]
 
-        if op_a is not None:
-            total_operands += 1
+    # Everything else (CMP, ST, PUSH, PRN, PRA, jumps, CALL, INT) only reads
+    # its operands
+    return operands, ()
 
-        if op_b is not None:
-            total_operands += 1
 
-        if op_type == 0 or op_type == 1 or op_type == 2:
-            # 0, 1, or 2 register operands
-            check_ops_count(op_type, total_operands)
+def ldi_statement(label, register, value):
+    """Make the Statement for LDI register,value"""
 
-        elif op_type == 8:
-            # LDI r,i or LDI r,label
-            check_ops_count(2, total_operands)
+    return Statement(label, "LDI", (MACHINE_CODES["LDI"], register, value),
+                     f"LDI R{register},{value}")
 
-    # Type to function mapping
-    type_f = {
-        0: out0,
-        1: out1,
-        2: out2,
-        8: out8,
-    }
 
-    for line in inputfile:
-        line_num += 1
+def removed(statement):
+    """
+    Get what's left of a Statement when it's removed: its label, if it has one
+    """
+
+    if statement.label is None:
+        return None
+
+    return Statement(statement.label, None, (), None)
+
+
+def fold(op, values, operands):
+    """
+    Get the result of an ALU operation on registers with known values, or
+    None if it can't be worked out
+    """
+
+    x = values[operands[0]]
 
-        # Strip comments
-        comment_index = line.find(';')
-        if comment_index != -1:
-            line = line[:comment_index]
+    if not isinstance(x, int):
+        return None
 
-        # Normalize
-        line = line.strip()
+    if op in UNARY_FOLDS:
+        return UNARY_FOLDS[op](x) & 0xff
 
-        # Ignore blank lines
-        if input == '':
+    y = values[operands[1]]
+
+    if not isinstance(y, int):
+        return None
+
+    value = BINARY_FOLDS[op](x, y)
+
+    return None if value is None else value & 0xff
+
+
+def trampoline(code, index, register):
+    """
+    If the code from index on is just LDI register,label and JMP register,
+    get the label it jumps on to
+    """
+
+    instructions = []
+
+    for statement in code[index:]:
+        if statement.op in ("DS", "DB"):
+            return None
+
+        if statement.op is not None:
+            instructions.append(statement)
+
+            if len(instructions) == 2:
+                break
+
+    if len(instructions) < 2:
+        return None
+
+    load, jump = instructions
+
+    if (load.op == "LDI" and load.data[1] == register and
+            isinstance(load.data[2], str) and
+            jump.op == "JMP" and jump.data[1] == register):
+        return load.data[2]
+
+    return None
+
+
+def final_target(code, labels, label, register):
+    """
+    Follow a chain of jumps to jumps through a register from a label, and get
+    the label at the end. If the chain loops, the label it started from is
+    returned
+    """
+
+    seen = [label]
+
+    while seen[-1] in labels:
+        target = trampoline(code, labels[seen[-1]], register)
+
+        if target is None:
+            break
+
+        if target in seen:
+            return label
+
+        seen.append(target)
+
+    return seen[-1]
+
+
+def dead_after(code, index, register):
+    """
+    Check if a register's value is never read again when execution goes on
+    to the Statement at index: it's written, or the CPU halts, first
+    """
+
+    for statement in code[index:]:
+        op = statement.op
+
+        if op is None:
+            continue
+
+        if op in ("DS", "DB"):
+            return False
+
+        reads, writes = registers_used(statement)
+
+        if register in reads:
+            return False
+
+        if register in writes or op == "HLT":
+            return True
+
+        if op in JUMPS or op in STACK_OPS:
+            return False
+
+    return False
+
+
+def simplify(code):
+    """
+    Make one pass over the code, in straight line runs of instructions that
+    can only be entered at the top, i.e. at a label or after a conditional
+    jump falls through:
+
+    * Drop LDIs of values the register already holds
+    * Drop LDIs whose value is overwritten before anything reads it
+    * Drop PUSHes that are popped back into the same register
+    * Fold ALU operations on known values into an LDI
+    * Point jumps to jumps (LDI Rn,label and JMP Rn) at the final target
+
+    Returns the new Statements.
+    """
+
+    labels = {statement.label: index for index, statement in enumerate(code)
+              if statement.label is not None}
+
+    out = []
+    reset = True
+
+    for index, statement in enumerate(code):
+        op = statement.op
+
+        # Every register's value is unknown at a label, since it could be
+        # jumped to from anywhere, and after a call or the end of a run
+        if reset or statement.label is not None or op in ("DS", "DB"):
+            # Register values (ints or label names), or None when unknown
+            values = [None] * 8
+
+            # LDIs to registers that nothing has read since, by register
+            unread = {}
+
+            # [LDI that loaded the register, whether anything but a jump has
+            # read it since], by register
+            loads = {}
+
+            # (PUSH, register) that a POP of the same register could cancel
+            pushed = None
+
+        reset = op in TERMINATORS or op in ("CALL", "DS", "DB")
+
+        if op not in INSTRUCTIONS:
+            out.append(statement)
+            continue
+
+        data = statement.data
+        reads, writes = registers_used(statement)
+        value = None
+
+        if op == "LDI":
+            value = data[2]
+
+            if data[1] in TRACKED_REGISTERS and values[data[1]] == value:
+                out.append(removed(statement))
+                continue
+
+        elif op in BINARY_FOLDS or op in UNARY_FOLDS:
+            value = fold(op, values, data[1:])
+            register = data[1]
+
+            if value is not None and register in unread:
+                # Load the result instead of the value it was worked out from
+                load = unread[register]
+                out[load] = ldi_statement(out[load].label, register, value)
+
+                values[register] = value
+                loads[register] = [load, False]
+
+                out.append(removed(statement))
+                continue
+
+            if value is not None and op in BINARY_FOLDS:
+                # Loading the result is the same size, and doesn't read the
+                # second register
+                statement = ldi_statement(statement.label, register, value)
+                op = "LDI"
+                reads = ()
+
+        elif op == "POP" and pushed is not None and pushed[1] == data[1]:
+            out[pushed[0]] = removed(out[pushed[0]])
+            out.append(removed(statement))
+            pushed = None
             continue
 
-        # print(line)  # debug
+        elif op in JUMPS:
+            register = data[1]
+            load = loads.get(register)
+            label = values[register]
+
+            if load is not None and not load[1] and isinstance(label, str):
+                target = final_target(code, labels, label, register)
+
+                # A conditional jump goes on to the next instruction with the
+                # register holding the new target, so it mustn't be read
+                if target != label and (op == "JMP" or
+                                        dead_after(code, index + 1, register)):
+                    out[load[0]] = ldi_statement(out[load[0]].label, register,
+                                                 target)
+                    values[register] = target
+
+        for register in reads:
+            unread.pop(register, None)
+
+            if register in loads and op not in JUMPS:
+                loads[register][1] = True
+
+        for register in writes:
+            # Nothing read what was loaded before, so there was no need to
+            # load it
+            if register in unread:
+                load = unread.pop(register)
+                out[load] = removed(out[load])
+
+            loads.pop(register, None)
+            values[register] = None
+
+        if op in JUMPS or op == "INT":
+            # Whatever is jumped to could read any register
+            unread = {}
+
+        if pushed is not None and (op in JUMPS or op in STACK_OPS or
+                                   op in ("LD", "ST") or pushed[1] in writes or
+                                   7 in reads or 7 in writes):
+            pushed = None
+
+        if value is not None and writes and writes[0] in TRACKED_REGISTERS:
+            values[writes[0]] = value
 
-        m = re.match(REGEX, line)
+        if op == "LDI" and data[1] in GENERAL_REGISTERS:
+            unread[data[1]] = len(out)
+            loads[data[1]] = [len(out), False]
 
-        if m is not None:
-            label, opcode, op_a, op_b = normalize_line(m.groups())
+        elif op == "PUSH":
+            pushed = (len(out), data[1])
 
-            # print(label, opcode, op_a, op_b)  # debug
+        out.append(statement)
 
-            # Track label address
-            if label is not None:
-                sym[label] = addr
-                # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
+    return [statement for statement in out if statement is not None]
 
-            if opcode is not None:
-                if opcode == 'DS':
-                    handle_ds(line)
-                elif opcode == 'DB':
-                    handle_db(line)
-                else:
-                    # Check operand count
-                    check_ops(opcode, op_a, op_b)
 
-                    # Handle opcodes
-                    op_info = OPCODES[opcode]
-                    handler = type_f[op_info["type"]]
-                    handler(opcode, op_a, op_b, op_info["code"])
+def remove_unreachable(code):
+    """
+    Remove instructions that can never run: ones after a JMP, RET, IRET or
+    HLT, up to the next label that something loads the address of. Labels
+    and DS and DB data are kept
+    """
+
+    entries = {value for statement in code if statement.op == "LDI"
+               for value in statement.data[2:] if isinstance(value, str)}
+
+    out = []
+    reachable = True
+
+    for statement in code:
+        if statement.label in entries:
+            reachable = True
+
+        if statement.op not in INSTRUCTIONS:
+            out.append(statement)
+
+        elif reachable:
+            out.append(statement)
+            reachable = statement.op not in TERMINATORS
+
+        elif statement.label is not None:
+            out.append(removed(statement))
+
+    return out
+
+
+def absolute_addresses(code):
+    """
+    Check if the code uses a number as an address in the program, e.g. with
+    LDI R0,5 and JMP R0. That address would be wrong once the code moved
+    """
+
+    size = sum(len(statement.data) for statement in code)
+    values = {}
+
+    for statement in code:
+        op = statement.op
+
+        if statement.label is not None or op in ("DS", "DB"):
+            values = {}
+
+        if op not in INSTRUCTIONS:
+            continue
+
+        operands = statement.data[1:]
+
+        # The register each instruction uses as an address
+        if op in JUMPS or op in ("CALL", "ST"):
+            address = values.get(operands[0])
+        elif op == "LD":
+            address = values.get(operands[1])
         else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
+            address = None
+
+        if isinstance(address, int) and address < size:
+            return True
+
+        for register in registers_used(statement)[1]:
+            values.pop(register, None)
+
+        if op == "LDI":
+            values[operands[0]] = operands[1]
+
+        if op in TERMINATORS or op == "CALL":
+            values = {}
+
+    return False
+
+
+def optimize(sym, code):
+    """
+    Optimize the Statements from pass 1: remove code that can never run, and
+    simplify the rest with simplify() until it doesn't get any smaller.
+    Labels are moved to their new addresses in sym, and the DS and DB data is
+    left as it is. Returns the new Statements.
+
+    How many bytes and cycles were saved is printed. The cycles are an
+    estimate: the CPU takes a cycle per instruction, and each instruction
+    removed from code that can run is counted once.
+    """
+
+    if absolute_addresses(code):
+        print("asm.py: not optimizing, since the program uses numbers as "
+              "addresses in itself", file=sys.stderr)
+        return code
+
+    size = sum(len(statement.data) for statement in code)
+
+    # Code that can never run takes space but no cycles
+    code = remove_unreachable(code)
+    instructions = sum(statement.op in INSTRUCTIONS for statement in code)
+
+    while True:
+        optimized = remove_unreachable(simplify(code))
+
+        if optimized == code:
+            break
+
+        code = optimized
+
+    address = 0
+
+    for statement in code:
+        if statement.label is not None:
+            sym[statement.label] = address
+
+        address += len(statement.data)
+
+    cycles = instructions - sum(statement.op in INSTRUCTIONS
+                                for statement in code)
+
+    print(f"asm.py: optimizing saved {size - address} bytes ({size} -> "
+          f"{address}) and an estimated {cycles} cycles", file=sys.stderr)
+
+    return code
 
 
 def pass2(outputfile, sym, code):
     """
-    Output the code, substituting in any symbols.
+    Output the code as .ls8 text, substituting in any symbols.
     """
 
-    for c in code:
-        # Replace symbols
-        if c[:4] == 'sym:':
-            s = c[4:].strip()
+    lines = []
+    addr = 0
+
+    for statement in code:
+        if statement.label is not None:
+            lines.append(f"# {statement.label} (address {addr}):\n")
+
+        data = statement.data
+
+        # DS lines show each character, other lines show the source on the
+        # first byte
+        if statement.op == 'DS':
+            for value in data:
+                print_char = chr(value)
 
-            if s in sym:
-                c = p8(sym[s])
+                if print_char == ' ':
+                    print_char = '[space]'
 
+                bits = BITS[value] if value < 256 else p8(value)
+
+                lines.append(f"{bits} # {print_char}\n")
+
+        elif data:
+            bits = BITS[resolve(data[0], sym)]
+
+            if statement.comment is None:
+                lines.append(f"{bits}\n")
             else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
+                lines.append(f"{bits} # {statement.comment}\n")
 
-        outputfile.write(f"{c}\n")
+            for value in data[1:]:
+                lines.append(f"{BITS[resolve(value, sym)]}\n")
+
+        addr += len(data)
+
+    outputfile.write("".join(lines))
+
+
+def import_image():
+    """
+    Import the emulator's image module from the ls8 directory next to this
+    one, so there's only one copy of the .ls8b format
+    """
+    if LS8_DIRECTORY not in sys.path:
+        sys.path.append(LS8_DIRECTORY)
+
+    import image
+
+    return image
+
+
+def pass2_binary(outputfile, sym, code):
+    """
+    Output the code as a binary .ls8b image, substituting in any symbols.
+    The symbol table and the DS/DB data regions are included in the image.
+    """
+
+    data = link(sym, code)
+
+    if len(data) > 256:
+        print("program does not fit in memory", file=sys.stderr)
+        sys.exit(2)
+
+    # Load address and entry point are both 0
+    import_image().write_image(outputfile, data, 0, 0, sym, data_regions(code))
 
 
 def main(argv):
     # Parse command line
-    inputfile, outputfile = parse_commandline(argv)
-
-    # Open files
-    inputfile, outputfile = open_files(inputfile, outputfile)
+    inputfile, outputfile, optimize_code = parse_commandline(argv)
+    binary = is_binary(outputfile)
 
     # Set up the symbol table
     sym = {}
@@ -394,9 +1047,23 @@ def main(argv):
     # Set up the machine code output
     code = []
 
-    # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    # Assemble. Files are assembled incrementally, using the cache kept next
+    # to them
+    if inputfile == "-":
+        pass1(sys.stdin, sym, code)
+    else:
+        assemble_file(inputfile, sym, code)
+
+    if optimize_code:
+        code = optimize(sym, code)
+
+    # Open the output file
+    outputfile = open_output(outputfile)
+
+    if binary:
+        pass2_binary(outputfile, sym, code)
+    else:
+        pass2(outputfile, sym, code)
 
     return 0
 
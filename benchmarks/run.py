@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"""Benchmark runner for the LS-8 emulator.
+
+Runs every workload on every execution engine and measures instructions per
+second, wall time per run and peak memory. Workloads are the programs in
+ls8/examples that halt, plus the synthetic programs in benchmarks/workloads.
+
+Usage: run.py [--output results.json] [--baseline baseline.json]
+              [--threshold 0.05] [--engine NAME ...] [--workload NAME ...]
+
+Each workload is run once to warm up, then at least MIN_RUNS times, and its
+speed is worked out from the fastest of those runs.
+
+With --baseline, the results are compared against an earlier results file,
+and the exit status is 1 if any workload got slower by more than the
+threshold. Workloads that run for less than GATE_MIN_SECONDS are too short to
+time reliably, so they're shown but never count as regressions.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(ROOT, "ls8"))
+sys.path.insert(0, os.path.join(ROOT, "asm"))
+
+import asm
+from compiler import BlockCompiler
+from cpu import CPU, parse_program
+
+# Stop any workload after this many instructions
+MAX_CYCLES = 10000000
+
+# Runs of each workload made before measuring it
+WARMUP_RUNS = 1
+
+# Measure at least this many runs of each workload, and keep going until this
+# much time has been measured
+MIN_RUNS = 5
+MIN_SECONDS = 0.5
+
+# Workloads whose fastest run is shorter than this aren't checked for
+# regressions, since timer resolution and per-run overhead swamp them
+GATE_MIN_SECONDS = 0.01
+
+
+def run_interpreter(cpu):
+    return cpu.run(MAX_CYCLES)
+
+
+def run_compiled(cpu):
+    return BlockCompiler(cpu).run(MAX_CYCLES)
+
+
+# Execution engines, by name
+ENGINES = {
+    "interpreter": run_interpreter,
+    "compiled": run_compiled,
+}
+
+
+def assemble(path):
+    """
+    Assemble an .asm file into program bytes
+    """
+    sym = {}
+    code = []
+
+    with open(path) as inputfile:
+        asm.pass1(inputfile, sym, code)
+
+    return bytes(asm.link(sym, code))
+
+
+def find_workloads():
+    """
+    Get the workloads, as a dict of name to program bytes
+    """
+    workloads = {}
+
+    for path in sorted(glob.glob(os.path.join(ROOT, "ls8", "examples", "*.ls8"))):
+        with open(path) as file:
+            program = bytes(parse_program(file))
+
+        # Only programs that halt on their own make useful benchmarks
+        cpu = CPU()
+        cpu.load(program)
+
+        try:
+            result = cpu.run(MAX_CYCLES)
+        except Exception:
+            continue
+
+        if result.halt_reason == "HLT":
+            name = os.path.splitext(os.path.basename(path))[0]
+            workloads["examples/" + name] = program
+
+    workloads_dir = os.path.join(ROOT, "benchmarks", "workloads")
+
+    for path in sorted(glob.glob(os.path.join(workloads_dir, "*.asm"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        workloads[name] = assemble(path)
+
+    return workloads
+
+
+def measure(program, engine):
+    """
+    Run a program on an engine after warming up, at least MIN_RUNS times and
+    until MIN_SECONDS of run time have been measured, and return its results.
+    The speed is based on the fastest run, which is the one least disturbed
+    by anything else going on
+    """
+    times = []
+    cycles = 0
+
+    while len(times) < WARMUP_RUNS + MIN_RUNS or \
+            sum(times[WARMUP_RUNS:]) < MIN_SECONDS:
+        cpu = CPU()
+        cpu.load(program)
+
+        start = time.perf_counter()
+        result = ENGINES[engine](cpu)
+        times.append(time.perf_counter() - start)
+
+        cycles = result.cycles
+
+    times = sorted(times[WARMUP_RUNS:])
+    best = times[0]
+
+    # Measure memory in a separate run, since tracing slows everything down
+    tracemalloc.start()
+
+    cpu = CPU()
+    cpu.load(program)
+    ENGINES[engine](cpu)
+
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "engine": engine,
+        "runs": len(times),
+        "cycles": cycles,
+        "seconds": best,
+        "median_seconds": times[len(times) // 2],
+        "instructions_per_second": cycles / best,
+        "peak_memory": peak_memory,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Print how the results compare to a baseline, and return the number of
+    regressions beyond the threshold. Both are compared on their fastest run,
+    and workloads too short to time reliably aren't counted
+    """
+    previous = {}
+
+    for record in baseline["results"]:
+        previous[(record["workload"], record["engine"])] = record
+
+    regressions = 0
+
+    print("\n%-24s %-12s %14s %14s %8s" % (
+        "workload", "engine", "baseline ips", "current ips", "change"))
+
+    for record in results:
+        key = (record["workload"], record["engine"])
+
+        if key not in previous:
+            continue
+
+        # Compare fastest runs, the ones other load disturbs least
+        before = previous[key]["cycles"] / previous[key]["seconds"]
+        after = record["cycles"] / record["seconds"]
+        change = (after - before) / before
+
+        flag = ""
+
+        if min(previous[key]["seconds"], record["seconds"]) < GATE_MIN_SECONDS:
+            flag = "  (too short to check)"
+        elif change < -threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+
+        print("%-24s %-12s %14.0f %14.0f %+7.1f%%%s" % (
+            key[0], key[1], before, after, 100 * change, flag))
+
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="run.py",
+        description="Benchmark the LS-8 emulator.",
+    )
+    parser.add_argument("--output", default=None,
+                        help="file to save the results to, as JSON")
+    parser.add_argument("--baseline", default=None,
+                        help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.05,
+                        help="slowdown that counts as a regression "
+                             "(default: 0.05, i.e. 5%%)")
+    parser.add_argument("--engine", action="append", choices=sorted(ENGINES),
+                        default=None, help="only run this engine")
+    parser.add_argument("--workload", action="append", default=None,
+                        help="only run this workload")
+    args = parser.parse_args(argv[1:])
+
+    engines = args.engine or list(ENGINES)
+    workloads = find_workloads()
+
+    if args.workload is not None:
+        for name in args.workload:
+            if name not in workloads:
+                print(f"unknown workload: {name}", file=sys.stderr)
+                return 2
+
+        workloads = {name: workloads[name] for name in args.workload}
+
+    results = []
+
+    print("%-24s %-12s %12s %12s %14s %10s" % (
+        "workload", "engine", "cycles", "seconds", "ips", "peak KiB"))
+
+    for name, program in workloads.items():
+        for engine in engines:
+            record = measure(program, engine)
+            record["workload"] = name
+            results.append(record)
+
+            print("%-24s %-12s %12d %12.6f %14.0f %10.1f" % (
+                name, engine, record["cycles"], record["seconds"],
+                record["instructions_per_second"], record["peak_memory"] / 1024))
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump({
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+            }, file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+        if compare(results, baseline, args.threshold):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
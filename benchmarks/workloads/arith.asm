@@ -0,0 +1,30 @@
+; arith.asm
+;
+; Tight arithmetic loop: 200 x 250 passes through a block of ALU operations.
+;
+; Expected output: the final value of the accumulator
+
+        LDI R0,0             ; accumulator
+        LDI R1,200           ; outer loop counter
+
+Outer:
+        LDI R2,250           ; inner loop counter
+
+Inner:
+        LDI R3,3
+        ADD R0,R2
+        MUL R0,R3
+        XOR R0,R1
+        DEC R2
+        LDI R3,0
+        CMP R2,R3
+        LDI R4,Inner
+        JNE R4
+
+        DEC R1
+        CMP R1,R3
+        LDI R4,Outer
+        JNE R4
+
+        PRN R0
+        HLT
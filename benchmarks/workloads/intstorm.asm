@@ -0,0 +1,48 @@
+; intstorm.asm
+;
+; Interrupt storm: raises interrupt 0 with INT 100 x 250 times. The handler
+; counts the interrupts in memory.
+;
+; Expected output: the interrupt count, modulo 256
+
+        LDI R0,0xF8          ; R0 holds the interrupt vector for I0
+        LDI R1,IntHandler    ; R1 holds the address of the handler
+        ST R0,R1             ; Store handler addr in int vector
+        LDI R5,1             ; Enable interrupt 0
+
+        LDI R1,100           ; outer loop counter
+        LDI R2,0             ; zero, for comparisons
+        LDI R4,0             ; interrupt number to raise
+
+Outer:
+        LDI R0,250           ; inner loop counter
+
+Inner:
+        INT R4
+
+        DEC R0
+        CMP R0,R2
+        LDI R3,Inner
+        JNE R3
+
+        DEC R1
+        CMP R1,R2
+        LDI R3,Outer
+        JNE R3
+
+        LDI R0,Count
+        LD R1,R0
+        PRN R1
+        HLT
+
+; Interrupt handler. R0-R6 are restored by IRET, so it can use any of them
+
+IntHandler:
+        LDI R0,Count
+        LD R1,R0
+        INC R1
+        ST R0,R1
+        IRET
+
+Count:
+        DB 0
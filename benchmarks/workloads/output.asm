@@ -0,0 +1,28 @@
+; output.asm
+;
+; Output heavy loop: prints 200 x 250 numbers, each followed by a '.'
+;
+; Expected output: 250 down to 1, each followed by '.', 200 times
+
+        LDI R1,200           ; outer loop counter
+        LDI R2,0             ; zero, for comparisons
+        LDI R3,46            ; '.'
+
+Outer:
+        LDI R0,250           ; inner loop counter
+
+Inner:
+        PRN R0
+        PRA R3
+
+        DEC R0
+        CMP R0,R2
+        LDI R4,Inner
+        JNE R4
+
+        DEC R1
+        CMP R1,R2
+        LDI R4,Outer
+        JNE R4
+
+        HLT
@@ -0,0 +1,36 @@
+; recursion.asm
+;
+; CALL/RET heavy recursion: 250 times, recursively count down from 100.
+;
+; Expected output: none
+
+        LDI R1,250           ; outer loop counter
+
+Loop:
+        LDI R0,100           ; recursion depth
+        LDI R3,Count
+        CALL R3
+
+        DEC R1
+        LDI R2,0
+        CMP R1,R2
+        LDI R3,Loop
+        JNE R3
+
+        HLT
+
+; Subroutine: Count
+; R0 the number of levels left to recurse
+
+Count:
+        LDI R2,0
+        CMP R0,R2
+        LDI R3,CountDone
+        JEQ R3               ; stop recursing at 0
+
+        DEC R0
+        LDI R3,Count
+        CALL R3
+
+CountDone:
+        RET
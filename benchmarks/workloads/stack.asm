@@ -0,0 +1,31 @@
+; stack.asm
+;
+; Stack churn: 250 x 200 rounds of pushing three values and popping them.
+;
+; Expected output: none
+
+        LDI R1,250           ; outer loop counter
+        LDI R2,0             ; zero, for comparisons
+
+Outer:
+        LDI R0,200           ; inner loop counter
+
+Inner:
+        PUSH R0
+        PUSH R1
+        PUSH R0
+        POP R3
+        POP R4
+        POP R3
+
+        DEC R0
+        CMP R0,R2
+        LDI R4,Inner
+        JNE R4
+
+        DEC R1
+        CMP R1,R2
+        LDI R4,Outer
+        JNE R4
+
+        HLT
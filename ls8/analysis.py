@@ -0,0 +1,688 @@
+"""Static analysis and disassembly of LS-8 programs.
+
+Usage: ls8.py disasm [--cfg | --dot] program
+
+analyze() takes an image.Image and works out, without running the program:
+
+  * which bytes are code and which are data, from the DS/DB regions the
+    assembler records in .ls8b images
+  * the basic blocks of the reachable code, and the edges between them
+  * the targets of CALLs, and the interrupt handlers the program installs
+
+LS-8 jumps and calls all go through a register, so their targets are found by
+following the values LDI puts in registers along every path into a block
+(constant propagation over the control flow graph). Jumps whose register
+can't be pinned down are listed in Analysis.unresolved.
+
+The most recent results are cached by the contents of the image, so asking
+for the analysis of a program again doesn't work it out again. BlockCompiler
+uses analyze_cpu() to compile every block of a program before running it.
+"""
+
+import argparse
+import collections
+import functools
+import sys
+
+import image
+from cpu import OPCODES, read_program
+
+# Map opcodes back to their names
+NAMES = {code: name for name, code in OPCODES.items()}
+
+# Where the interrupt handler addresses are stored
+VECTOR_TABLE = 0xF8
+
+# Register values when the CPU starts: R0-R6 are 0, and the SP is 0xF4
+INITIAL_REGISTERS = (0, 0, 0, 0, 0, 0, 0, 0xF4)
+
+# Register values that aren't known at all
+UNKNOWN = (None,) * 8
+
+# Constant folding for instructions that store a result in register A
+BINARY = {
+    "ADD": lambda x, y: x + y,
+    "SUB": lambda x, y: x - y,
+    "MUL": lambda x, y: x * y,
+    "DIV": lambda x, y: x // y if y else None,
+    "MOD": lambda x, y: x % y if y else None,
+    "AND": lambda x, y: x & y,
+    "OR": lambda x, y: x | y,
+    "XOR": lambda x, y: x ^ y,
+    "SHL": lambda x, y: x << y,
+    "SHR": lambda x, y: x >> y,
+}
+
+UNARY = {
+    "INC": lambda x: x + 1,
+    "DEC": lambda x: x - 1,
+    "NOT": lambda x: ~x,
+}
+
+# How many analyses analyze() keeps, so a long-running process doesn't hold
+# on to every program it has seen
+CACHE_SIZE = 64
+
+# A decoded instruction. operands is a tuple of 0 to 2 bytes
+Instruction = collections.namedtuple("Instruction",
+                                     ["address", "opcode", "operands"])
+
+# A basic block: the instructions from start up to end (exclusive), the
+# blocks control can pass to, and the subroutines it calls
+Block = collections.namedtuple("Block", ["start", "end", "instructions",
+                                         "successors", "calls"])
+
+
+class Analysis:
+    """Everything analyze() works out about a program."""
+
+    def __init__(self, program):
+        self.program = program
+        self.entry = program.entry
+        self.symbols = dict(program.symbols)
+
+        # The program laid out in memory, as the CPU would see it
+        self.memory = bytearray(256)
+        end = program.load_address + len(program.code)
+        self.memory[program.load_address:end] = program.code
+
+        # Addresses the program occupies, and the ones that are data
+        self.extent = range(program.load_address, end)
+        self.data = set()
+
+        for start, length in program.data:
+            self.data.update(range(start, start + length))
+
+        # Registers each subroutine (by address) can change, not counting
+        # the SP. Subroutines start out assumed to change nothing, and the
+        # whole analysis is repeated until every subroutine found changes
+        # only registers in its set
+        self.clobbers = collections.defaultdict(frozenset)
+
+        while True:
+            self.reset()
+            self.solve()
+            self.build()
+
+            if not self.update_clobbers():
+                break
+
+    def reset(self):
+        """
+        Forget everything worked out by solve() and build()
+        """
+        # Register values on entry to each basic block, as tuples with None
+        # for registers that could hold anything
+        self.states = {}
+
+        # Block starts whose walks passed over each instruction address, so a
+        # block can be walked again when a jump into its middle is found
+        self.covering = collections.defaultdict(set)
+
+        # Results
+        self.instructions = {}
+        self.blocks = {}
+        self.call_targets = set()
+        self.handlers = set()
+        self.unresolved = set()
+        self.problems = {}
+        self.reachable = set()
+
+    def decode(self, address):
+        """
+        Decode the instruction at an address, or return None and record why
+        it can't be executed
+        """
+        opcode = self.memory[address]
+
+        if address in self.data:
+            self.problems[address] = "execution runs into data"
+            return None
+
+        if opcode not in NAMES:
+            self.problems[address] = "unknown instruction %02X" % opcode
+            return None
+
+        length = (opcode >> 6) + 1
+
+        if address + length > 256:
+            self.problems[address] = "instruction runs off the end of memory"
+            return None
+
+        operands = tuple(self.memory[address + 1:address + length])
+
+        # Every operand is a register, except LDI's value
+        registers = operands[:1] if NAMES[opcode] == "LDI" else operands
+
+        if any(register > 7 for register in registers):
+            self.problems[address] = "bad register number"
+            return None
+
+        return Instruction(address, opcode, operands)
+
+    def step(self, name, operands, registers, exits):
+        """
+        Update the known register values for an instruction that doesn't
+        change the flow of control
+        """
+        if name == "LDI":
+            registers[operands[0]] = operands[1]
+
+        elif name in BINARY:
+            a, b = operands
+            x = registers[a]
+            y = registers[b]
+
+            if x is None or y is None:
+                registers[a] = None
+            else:
+                value = BINARY[name](x, y)
+                registers[a] = None if value is None else value & 0xFF
+
+        elif name in UNARY:
+            a = operands[0]
+            x = registers[a]
+            registers[a] = None if x is None else UNARY[name](x) & 0xFF
+
+        elif name == "LD":
+            registers[operands[0]] = None
+
+        elif name == "PUSH":
+            if registers[7] is not None:
+                registers[7] = (registers[7] - 1) & 0xFF
+
+        elif name == "POP":
+            if registers[7] is not None:
+                registers[7] = (registers[7] + 1) & 0xFF
+
+            registers[operands[0]] = None
+
+        elif name == "ST":
+            address = registers[operands[0]]
+            value = registers[operands[1]]
+
+            # Installing an interrupt handler. It can interrupt anything, so
+            # nothing is known about the registers when it starts
+            if address is not None and address >= VECTOR_TABLE and \
+                    value is not None:
+                exits.append((value, UNKNOWN, "handler"))
+
+    def walk(self, start, state):
+        """
+        Follow the instructions of the block starting at start, given the
+        register values on entry. Returns the block's instructions and its
+        exits, as a list of (address, register values, kind) where kind is
+        "next", "jump", "call" or "handler"
+        """
+        registers = list(state)
+        instructions = []
+        exits = []
+        address = start
+
+        while True:
+            instruction = self.decode(address)
+
+            if instruction is None:
+                break
+
+            instructions.append(instruction)
+            self.covering[address].add(start)
+
+            name = NAMES[instruction.opcode]
+            operands = instruction.operands
+            next_address = address + len(operands) + 1
+
+            if name in ("JMP", "JEQ", "JNE", "CALL"):
+                target = registers[operands[0]]
+
+                if target is None:
+                    self.unresolved.add(address)
+
+                if name == "CALL":
+                    if target is not None:
+                        stack = list(registers)
+
+                        if stack[7] is not None:
+                            stack[7] = (stack[7] - 1) & 0xFF
+
+                        exits.append((target, tuple(stack), "call"))
+
+                    # The subroutine leaves the stack as it found it, and
+                    # the registers it doesn't change
+                    if target is None:
+                        clobbered = range(7)
+                    else:
+                        clobbered = self.clobbers[target]
+
+                    after = [None if register in clobbered else value
+                             for register, value in enumerate(registers)]
+                    after[7] = registers[7]
+
+                    exits.append((next_address, tuple(after), "next"))
+
+                else:
+                    if target is not None:
+                        exits.append((target, tuple(registers), "jump"))
+
+                    if name != "JMP":
+                        exits.append((next_address, tuple(registers), "next"))
+
+                break
+
+            if name in ("HLT", "RET", "IRET"):
+                break
+
+            self.step(name, operands, registers, exits)
+
+            if next_address >= 256:
+                self.problems[address] = "execution runs off the end of memory"
+                break
+
+            address = next_address
+
+            # Another block starts here
+            if address in self.states:
+                exits.append((address, tuple(registers), "next"))
+                break
+
+        return instructions, exits
+
+    def merge(self, address, state, worklist):
+        """
+        Combine the register values coming into a block along one edge with
+        what's known already, and queue the block if that changed anything
+        """
+        old = self.states.get(address)
+
+        if old is None:
+            self.states[address] = state
+            worklist.append(address)
+
+            # Blocks that ran straight through this address now end here
+            worklist.extend(self.covering.get(address, ()))
+            return
+
+        merged = tuple(a if a == b else None for a, b in zip(old, state))
+
+        if merged != old:
+            self.states[address] = merged
+            worklist.append(address)
+
+    def solve(self):
+        """
+        Find every block start and the register values on entry to it
+        """
+        self.states[self.entry] = INITIAL_REGISTERS
+        worklist = [self.entry]
+
+        while worklist:
+            start = worklist.pop()
+            _, exits = self.walk(start, self.states[start])
+
+            for address, state, _ in exits:
+                self.merge(address, state, worklist)
+
+    def build(self):
+        """
+        Walk every block once more with the final register values, and record
+        the results
+        """
+        self.unresolved.clear()
+        self.problems.clear()
+
+        for start in sorted(self.states):
+            instructions, exits = self.walk(start, self.states[start])
+
+            successors = []
+            calls = []
+
+            for address, _, kind in exits:
+                if kind == "call":
+                    calls.append(address)
+                    self.call_targets.add(address)
+                elif kind == "handler":
+                    self.handlers.add(address)
+                elif address not in successors:
+                    successors.append(address)
+
+            if instructions:
+                last = instructions[-1]
+                end = last.address + len(last.operands) + 1
+            else:
+                end = start
+
+            self.blocks[start] = Block(start, end, tuple(instructions),
+                                       tuple(successors), tuple(calls))
+
+            for instruction in instructions:
+                self.instructions[instruction.address] = instruction
+                length = len(instruction.operands) + 1
+                self.reachable.update(range(instruction.address,
+                                            instruction.address + length))
+
+    def update_clobbers(self):
+        """
+        Add the registers each subroutine was found to change to its set.
+        Returns True if any set grew
+        """
+        grew = False
+
+        for target in self.call_targets:
+            written = self.clobbers[target]
+            seen = set()
+            starts = [target]
+
+            # Every block the subroutine can reach before it returns, and the
+            # registers changed by the subroutines those call
+            while starts:
+                start = starts.pop()
+
+                if start in seen or start not in self.blocks:
+                    continue
+
+                seen.add(start)
+                block = self.blocks[start]
+
+                for instruction in block.instructions:
+                    written |= written_registers(instruction)
+
+                for callee in block.calls:
+                    written |= self.clobbers[callee]
+
+                starts.extend(block.successors)
+
+            written -= {7}
+
+            if written != self.clobbers[target]:
+                self.clobbers[target] = frozenset(written)
+                grew = True
+
+        return grew
+
+    def unreachable(self):
+        """
+        Get the addresses in the program that are neither data nor reachable
+        code
+        """
+        return [address for address in self.extent
+                if address not in self.data and address not in self.reachable]
+
+    def label(self, address):
+        """
+        Get the label for an address, or None
+        """
+        for name, label_address in self.symbols.items():
+            if label_address == address:
+                return name
+
+        return None
+
+    def describe(self, address):
+        """
+        Name an address for comments: its label, or its value in hex
+        """
+        return self.label(address) or "%02X" % address
+
+
+def written_registers(instruction):
+    """
+    Get the set of registers an instruction stores a value in, apart from
+    the SP changing for the stack
+    """
+    name = NAMES[instruction.opcode]
+
+    if name in ("LDI", "LD", "POP") or name in BINARY or name in UNARY:
+        return {instruction.operands[0]}
+
+    return set()
+
+
+def analyze(program):
+    """
+    Analyze an image.Image, reusing the result if the same image has been
+    analyzed recently
+    """
+    return analyze_image(program.load_address, program.entry,
+                         bytes(program.code),
+                         tuple(sorted(program.symbols.items())),
+                         tuple(program.data))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def analyze_image(load_address, entry, code, symbols, data):
+    """
+    Analyze the image with the given contents, in a hashable form
+    """
+    return Analysis(image.Image(load_address, entry, code, dict(symbols),
+                                data))
+
+
+def analyze_cpu(cpu):
+    """
+    Analyze the program in a CPU's memory, starting from its PC. All of
+    memory counts as code, but only what's reachable ends up in blocks
+    """
+    return analyze(image.Image(0, cpu.pc, bytes(cpu.ram), cpu.symbols))
+
+
+def format_instruction(instruction):
+    """
+    Format an instruction in assembler syntax, e.g. "LDI R0,10"
+    """
+    name = NAMES[instruction.opcode]
+    operands = instruction.operands
+
+    if name == "LDI":
+        return "LDI R%d,%d" % operands
+
+    return name + " " + ",".join("R%d" % (operand & 0b111)
+                                 for operand in operands)
+
+
+def format_data(values):
+    """
+    Format data bytes as DS and DB lines the assembler would accept. Returns
+    a list of (offset of the line's first byte, line)
+    """
+    lines = []
+    text = ""
+
+    for offset, value in enumerate(values):
+        character = chr(value)
+
+        if character.isprintable() and character != ";":
+            text += character
+            continue
+
+        if text:
+            lines.append((offset - len(text), "DS " + text))
+            text = ""
+
+        lines.append((offset, "DB 0x%02X" % value))
+
+    if text:
+        lines.append((len(values) - len(text), "DS " + text))
+
+    return lines
+
+
+def disassemble(analysis):
+    """
+    Get the lines of a disassembly of the whole program
+    """
+    lines = []
+    memory = analysis.memory
+    address = analysis.extent.start
+    end = analysis.extent.stop
+
+    while address < end:
+        label = analysis.label(address)
+
+        if (address in analysis.blocks or label is not None) and \
+                lines and lines[-1] != "":
+            lines.append("")
+
+        if label is not None:
+            lines.append("%s:" % label)
+
+        instruction = analysis.instructions.get(address)
+
+        if instruction is not None:
+            length = len(instruction.operands) + 1
+            text = format_instruction(instruction)
+            name = NAMES[instruction.opcode]
+            comment = ""
+
+            if name in ("JMP", "JEQ", "JNE", "CALL"):
+                block = analysis.blocks[
+                    max(start for start in analysis.blocks if start <= address)]
+                targets = block.calls if name == "CALL" else [
+                    target for target in block.successors
+                    if target != address + length]
+
+                if address in analysis.unresolved:
+                    comment = "-> ?"
+                elif targets:
+                    comment = "-> " + ", ".join(analysis.describe(target)
+                                                for target in targets)
+
+            elif name == "LDI":
+                value = instruction.operands[1]
+
+                # Probably the address of some code or data
+                if value in analysis.blocks or value in analysis.data:
+                    comment = analysis.label(value) or ""
+
+            lines.append(format_line(address, memory[address:address + length],
+                                     text, comment))
+            address += length
+            continue
+
+        # A run of data, or of bytes nothing reaches, up to the next label or
+        # instruction
+        is_data = address in analysis.data
+        start = address
+        address += 1
+
+        while address < end and (address in analysis.data) == is_data and \
+                address not in analysis.instructions and \
+                analysis.label(address) is None:
+            address += 1
+
+        comment = "" if is_data else "unreachable"
+
+        for offset, text in format_data(memory[start:address]):
+            lines.append(format_line(start + offset, b"", text, comment))
+
+    return lines
+
+
+def format_line(address, data, text, comment):
+    line = "%02X  %-9s  %-16s" % (address, " ".join("%02X" % b for b in data),
+                                 text)
+
+    if comment:
+        line += "; " + comment
+
+    return line.rstrip()
+
+
+def write_cfg(analysis, file):
+    """
+    Write the basic blocks and the edges between them
+    """
+    for start, block in sorted(analysis.blocks.items()):
+        name = analysis.label(start)
+        title = "%02X-%02X" % (start, block.end - 1) if block.end > start \
+            else "%02X" % start
+
+        if name is not None:
+            title += " " + name
+
+        print("block %s" % title, file=file)
+
+        if block.successors:
+            print("  -> %s" % ", ".join(analysis.describe(address)
+                                        for address in block.successors),
+                  file=file)
+
+        if block.calls:
+            print("  calls %s" % ", ".join(analysis.describe(address)
+                                           for address in block.calls),
+                  file=file)
+
+    def addresses(values):
+        return ", ".join(analysis.describe(address) for address in sorted(values))
+
+    print("\nentry: %s" % analysis.describe(analysis.entry), file=file)
+    print("call targets: %s" % (addresses(analysis.call_targets) or "none"),
+          file=file)
+    print("interrupt handlers: %s" % (addresses(analysis.handlers) or "none"),
+          file=file)
+    print("unresolved jumps: %s" % (addresses(analysis.unresolved) or "none"),
+          file=file)
+
+    for address, problem in sorted(analysis.problems.items()):
+        print("problem at %02X: %s" % (address, problem), file=file)
+
+
+def write_dot(analysis, file):
+    """
+    Write the control flow graph in Graphviz dot format
+    """
+    print("digraph ls8 {", file=file)
+    print('  node [shape=box, fontname="monospace"];', file=file)
+
+    for start, block in sorted(analysis.blocks.items()):
+        text = "\\l".join(format_instruction(i) for i in block.instructions)
+        name = analysis.label(start)
+
+        if name is not None:
+            text = name + ":\\l" + text
+
+        print('  b%02X [label="%02X\\l%s\\l"];' % (start, start, text),
+              file=file)
+
+        for address in block.successors:
+            print("  b%02X -> b%02X;" % (start, address), file=file)
+
+        for address in block.calls:
+            print("  b%02X -> b%02X [style=dashed];" % (start, address),
+                  file=file)
+
+    print("}", file=file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="ls8.py disasm",
+        description="Disassemble an LS-8 program and analyze its control "
+                    "flow.",
+    )
+    parser.add_argument("program",
+                        help=".ls8, .ls8b or .asm file. Labels and data "
+                             "regions come from .asm and .ls8b files")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--cfg", action="store_true",
+                       help="list the basic blocks and control flow instead")
+    group.add_argument("--dot", action="store_true",
+                       help="write the control flow graph in Graphviz format")
+    args = parser.parse_args(argv)
+
+    try:
+        program = read_program(args.program)
+    except FileNotFoundError as e:
+        print(f"ls8.py disasm: {e.filename} not found", file=sys.stderr)
+        return 1
+
+    analysis = analyze(program)
+
+    if args.cfg:
+        write_cfg(analysis, sys.stdout)
+    elif args.dot:
+        write_dot(analysis, sys.stdout)
+    else:
+        for line in disassemble(analysis):
+            print(line)
+
+    return 0
@@ -0,0 +1,407 @@
+"""Run many LS-8 programs across a pool of worker processes.
+
+Usage: ls8.py batch [options] path [path ...]
+
+Each path is a program (an .ls8, .ls8b or .asm file), a directory of programs,
+or a manifest listing one program per line. One JSON object is written per
+program, e.g.
+
+    {"program": "examples/mult.ls8", "status": "HLT", "exit_status": 0,
+     "cycles": 5, "idle_cycles": 0, "seconds": 0.0001,
+     "cycles_per_second": 50000.0, "output": "72\n"}
+
+cycles is the number of instructions executed, and cycles_per_second is based
+on it. idle_cycles is how many cycles were skipped while the program waited
+for the timer.
+
+Each program is stopped once DEFAULT_MAX_CYCLES cycles have gone by (executed
+or skipped) or it has run for DEFAULT_TIMEOUT seconds, unless --max-cycles and
+--timeout give other limits (or "none").
+
+With --in-process, the programs share one process instead, taking turns on a
+scheduler.Scheduler. That's cheaper for large numbers of small programs.
+
+run_variants() runs many variations of one machine state in the same way: each
+worker restores the state once and forks a child CPU for every variant.
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import sys
+import time
+
+from cpu import CPU
+from devices import ScriptedKeyboard, Timer
+from scheduler import DEFAULT_QUANTUM, Scheduler
+
+# Files CPU.load() can run: text programs, binary images and assembler source
+PROGRAM_EXTENSIONS = (".ls8", ".ls8b", ".asm")
+
+# Number of cycles a worker runs between checks of its timeout
+CYCLES_PER_SLICE = 10000
+
+# Limits for each program, unless --max-cycles or --timeout say otherwise, so
+# one program that never halts can't hold up the whole batch
+DEFAULT_MAX_CYCLES = 100000000
+DEFAULT_TIMEOUT = 60.0
+
+# The CPU each worker forks its variants from, set up by init_variant_worker()
+parent = None
+
+
+def find_programs(paths):
+    """
+    Expand the given paths into a list of program files
+    """
+    programs = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            # Every program file in the directory, skipping hidden files such
+            # as the images .ls8 files are cached in
+            for name in sorted(os.listdir(path)):
+                if name.endswith(PROGRAM_EXTENSIONS) and \
+                        not name.startswith("."):
+                    programs.append(os.path.join(path, name))
+
+        elif path.endswith(PROGRAM_EXTENSIONS):
+            programs.append(path)
+
+        elif not os.path.isfile(path):
+            raise ValueError("%s is not a program, directory or manifest"
+                             % path)
+
+        else:
+            # A manifest, with paths relative to the manifest itself
+            base = os.path.dirname(path)
+
+            with open(path) as manifest:
+                for line in manifest:
+                    line = line.split("#")[0].strip()
+
+                    if line != "":
+                        programs.append(os.path.join(base, line))
+
+    return programs
+
+
+def limit(convert):
+    """
+    Make an argparse type for a limit: a positive number, or "none" for no
+    limit at all
+    """
+    def parse(text):
+        if text.lower() == "none":
+            return None
+
+        value = convert(text)
+
+        if value <= 0:
+            raise argparse.ArgumentTypeError("must be positive, or none")
+
+        return value
+
+    return parse
+
+
+def positive(text):
+    """
+    argparse type for a positive whole number
+    """
+    value = int(text)
+
+    if value <= 0:
+        raise argparse.ArgumentTypeError("must be positive")
+
+    return value
+
+
+def run_program(path, max_cycles=None, timeout=None, cycles_per_second=None):
+    """
+    Run a single program and return a dict describing how it went. This runs
+    in a worker process.
+    """
+    cpu = CPU()
+
+    # Timer interrupts are driven by the cycle count, so every run of a
+    # program behaves the same no matter how busy the machine is
+    if cycles_per_second is None:
+        cpu.devices.append(Timer())
+    else:
+        cpu.devices.append(Timer(cycles_per_second=cycles_per_second))
+
+    return run_cpu(cpu, path, {"program": path}, max_cycles, timeout)
+
+
+def run_cpu(cpu, program, record, max_cycles=None, timeout=None):
+    """
+    Load a program into a CPU and run it, filling in record with how it went.
+    Returns the record
+    """
+    start = time.perf_counter()
+    start_cycles = cpu.cycles
+    start_idle_cycles = cpu.idle_cycles
+    status = None
+
+    try:
+        cpu.load(program)
+
+        # Run in slices so the timeout can be checked without having to kill
+        # the worker
+        while status is None:
+            slice_cycles = CYCLES_PER_SLICE
+
+            # The limit counts cycles skipped while idle too
+            elapsed = cpu.cycles - start_cycles
+
+            if max_cycles is not None:
+                slice_cycles = min(slice_cycles, max_cycles - elapsed)
+
+            result = cpu.run(max_cycles=slice_cycles)
+            elapsed = cpu.cycles - start_cycles
+
+            if result.halt_reason != "max_cycles":
+                status = result.halt_reason
+            elif max_cycles is not None and elapsed >= max_cycles:
+                status = "max_cycles"
+            elif timeout is not None and time.perf_counter() - start > timeout:
+                status = "timeout"
+
+    except Exception as e:
+        status = "error"
+        record["error"] = str(e)
+
+    seconds = time.perf_counter() - start
+
+    # Counted from the CPU, so the slice that raised counts what ran
+    idle_cycles = cpu.idle_cycles - start_idle_cycles
+    cycles = cpu.cycles - start_cycles - idle_cycles
+
+    record["status"] = status
+    record["exit_status"] = 0 if status == "HLT" else 1
+    record["cycles"] = cycles
+    record["idle_cycles"] = idle_cycles
+    record["seconds"] = seconds
+    record["cycles_per_second"] = cycles / seconds if seconds > 0 else None
+    record["output"] = cpu.output.getvalue()
+
+    return record
+
+
+def run_batch(programs, max_cycles=None, timeout=None, workers=None,
+              cycles_per_second=None):
+    """
+    Run the given programs across a process pool, yielding a record for each
+    one in the order they were given
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(
+            run_program,
+            programs,
+            itertools.repeat(max_cycles),
+            itertools.repeat(timeout),
+            itertools.repeat(cycles_per_second),
+        )
+
+
+def run_scheduled(programs, max_cycles=None, timeout=None,
+                  cycles_per_second=None, quantum=DEFAULT_QUANTUM):
+    """
+    Run the given programs in this process, taking turns on a Scheduler, and
+    return a record for each one in the order they were given
+    """
+    scheduler = Scheduler(quantum)
+    jobs = []
+    records = []
+
+    for path in programs:
+        cpu = CPU()
+
+        if cycles_per_second is None:
+            cpu.devices.append(Timer())
+        else:
+            cpu.devices.append(Timer(cycles_per_second=cycles_per_second))
+
+        record = {"program": path}
+        records.append(record)
+
+        try:
+            cpu.load(path)
+        except Exception as e:
+            record["error"] = str(e)
+            jobs.append(None)
+            continue
+
+        jobs.append(scheduler.add(cpu, name=path, max_cycles=max_cycles,
+                                  timeout=timeout))
+
+    scheduler.run()
+
+    for record, job in zip(records, jobs):
+        if job is None:
+            status = "error"
+            cycles = 0
+            idle_cycles = 0
+            seconds = 0.0
+            output = ""
+        else:
+            status = job.result.halt_reason
+            cycles = job.cycles
+            idle_cycles = job.idle_cycles
+            seconds = job.seconds
+            output = job.result.output
+
+            if job.error is not None:
+                record["error"] = job.error
+
+        record["status"] = status
+        record["exit_status"] = 0 if status == "HLT" else 1
+        record["cycles"] = cycles
+        record["idle_cycles"] = idle_cycles
+        record["seconds"] = seconds
+        record["cycles_per_second"] = cycles / seconds if seconds > 0 else None
+        record["output"] = output
+
+    return records
+
+
+def init_variant_worker(snapshot, devices, symbols):
+    """
+    Set up the CPU that a worker process forks variants from
+    """
+    global parent
+
+    parent = CPU()
+    parent.devices = devices
+    parent.restore(snapshot)
+    parent.symbols = symbols
+
+
+def run_variant(variant, max_cycles=DEFAULT_MAX_CYCLES):
+    """
+    Fork the worker's CPU, apply a variant to it and run it, returning a dict
+    describing how it went. This runs in a worker process.
+
+    A variant is a dict that can have:
+      registers - a dict of register number to the value to start with
+      memory    - a dict of address to the value to store there
+      keys      - keys for a devices.ScriptedKeyboard to type
+    """
+    cpu = parent.fork()
+
+    for register, value in variant.get("registers", {}).items():
+        cpu.reg[int(register)] = value & 0xFF
+
+    for address, value in variant.get("memory", {}).items():
+        cpu.ram_write(int(address), value)
+
+    if "keys" in variant:
+        cpu.devices.append(ScriptedKeyboard(variant["keys"]))
+
+    record = {"variant": variant}
+
+    start = time.perf_counter()
+    start_cycles = cpu.cycles
+    start_idle_cycles = cpu.idle_cycles
+
+    try:
+        result = cpu.run(max_cycles=max_cycles)
+        status = result.halt_reason
+    except Exception as e:
+        status = "error"
+        record["error"] = str(e)
+
+    seconds = time.perf_counter() - start
+
+    # Counted from the CPU, so a variant that raises still counts what ran
+    idle_cycles = cpu.idle_cycles - start_idle_cycles
+    cycles = cpu.cycles - start_cycles - idle_cycles
+
+    record["status"] = status
+    record["exit_status"] = 0 if status == "HLT" else 1
+    record["cycles"] = cycles
+    record["idle_cycles"] = idle_cycles
+    record["seconds"] = seconds
+    record["registers"] = list(cpu.reg)
+    record["output"] = cpu.output.getvalue()
+
+    return record
+
+
+def run_variants(cpu, variants, max_cycles=DEFAULT_MAX_CYCLES, workers=None):
+    """
+    Run variations of a CPU's current state across a process pool, yielding a
+    record for each variant in the order they were given. The CPU's devices
+    are sent to the workers, so they need to be picklable. Each variant is
+    stopped after max_cycles cycles, or never if it's None
+    """
+    initargs = (cpu.snapshot(), cpu.devices, cpu.symbols)
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=init_variant_worker,
+            initargs=initargs) as pool:
+        yield from pool.map(run_variant, variants, itertools.repeat(max_cycles))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="ls8.py batch",
+        description="Run many LS-8 programs in parallel.",
+    )
+    parser.add_argument("paths", nargs="+",
+                        help="programs (.ls8, .ls8b or .asm files), "
+                             "directories or manifests")
+    parser.add_argument("--max-cycles", type=limit(int),
+                        default=DEFAULT_MAX_CYCLES,
+                        help="stop each program after this many instructions "
+                             "(default: %(default)s, or none for no limit)")
+    parser.add_argument("--timeout", type=limit(float),
+                        default=DEFAULT_TIMEOUT,
+                        help="stop each program after this many seconds "
+                             "(default: %(default)s, or none for no limit)")
+    parser.add_argument("--workers", type=positive, default=None,
+                        help="number of worker processes")
+    parser.add_argument("--in-process", action="store_true",
+                        help="run every program in this process, taking "
+                             "turns, instead of in worker processes")
+    parser.add_argument("--quantum", type=positive, default=DEFAULT_QUANTUM,
+                        help="instructions per turn with --in-process "
+                             "(default: %(default)s)")
+    parser.add_argument("--cycles-per-second", type=positive, default=None,
+                        help="instructions per timer tick (default: 1000000)")
+    parser.add_argument("--output", default="-",
+                        help="file to write JSON lines to (default: stdout)")
+    args = parser.parse_args(argv)
+
+    try:
+        programs = find_programs(args.paths)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    if args.output == "-":
+        outputfile = sys.stdout
+    else:
+        outputfile = open(args.output, "w")
+
+    failures = 0
+
+    if args.in_process:
+        records = run_scheduled(programs, args.max_cycles, args.timeout,
+                                args.cycles_per_second, args.quantum)
+    else:
+        records = run_batch(programs, args.max_cycles, args.timeout,
+                            args.workers, args.cycles_per_second)
+
+    for record in records:
+        outputfile.write(json.dumps(record) + "\n")
+
+        if record["exit_status"] != 0:
+            failures += 1
+
+    if outputfile is not sys.stdout:
+        outputfile.close()
+
+    return 1 if failures else 0
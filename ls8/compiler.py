@@ -0,0 +1,301 @@
+"""Basic-block compiler for the LS-8.
+
+Splits a loaded program into basic blocks that end at an instruction which
+sets the PC (or HLT), and compiles each block once into a Python function that
+works on the CPU registers directly. Blocks run back to back without going
+through the decode and dispatch steps in CPU.run() for every instruction.
+
+Usage:
+
+    cpu = CPU()
+    cpu.load("examples/mult.ls8")
+    result = BlockCompiler(cpu).run()
+
+The first run() compiles every block static analysis can find up front, so
+the program doesn't stop to compile blocks as it reaches them.
+"""
+
+import analysis
+from devices import PRA_BYTES, PRN_BYTES
+
+# Python source for the instructions the compiler can inline. {a} and {b} are
+# replaced with the operands and {next} with the address of the following
+# instruction. Stores are handled separately because they may modify code.
+# DIV and MOD aren't here, since dividing by zero has to halt the CPU.
+TEMPLATES = {
+    "LDI": ["reg[{a}] = {b}"],
+    "ADD": ["reg[{a}] = (reg[{a}] + reg[{b}]) & 0xFF"],
+    "AND": ["reg[{a}] &= reg[{b}]"],
+    "DEC": ["reg[{a}] = (reg[{a}] - 1) & 0xFF"],
+    "INC": ["reg[{a}] = (reg[{a}] + 1) & 0xFF"],
+    "MUL": ["reg[{a}] = (reg[{a}] * reg[{b}]) & 0xFF"],
+    "NOT": ["reg[{a}] = ~reg[{a}] & 0xFF"],
+    "OR": ["reg[{a}] |= reg[{b}]"],
+    "SHL": ["reg[{a}] = (reg[{a}] << reg[{b}]) & 0xFF"],
+    "SHR": ["reg[{a}] >>= reg[{b}]"],
+    "SUB": ["reg[{a}] = (reg[{a}] - reg[{b}]) & 0xFF"],
+    "XOR": ["reg[{a}] ^= reg[{b}]"],
+    "CMP": [
+        "x = reg[{a}]",
+        "y = reg[{b}]",
+        "cpu.fl = 0b001 if x == y else 0b010 if x > y else 0b100",
+    ],
+    "PRA": ["cpu.output.write(PRA_BYTES[reg[{a}]])"],
+    "PRN": ["cpu.output.write(PRN_BYTES[reg[{a}]])"],
+    "POP": [
+        "reg[{a}] = ram[reg[7]]",
+        "reg[7] = (reg[7] + 1) & 0xFF",
+    ],
+}
+
+# Instructions that write to memory. Each entry is the source that runs before
+# the store, followed by the source for the address and the value to store
+STORES = {
+    "CALL": (["reg[7] = (reg[7] - 1) & 0xFF"], "reg[7]", "{next}"),
+    "PUSH": (["reg[7] = (reg[7] - 1) & 0xFF"], "reg[7]", "reg[{a}]"),
+    "ST": ([], "reg[{a}]", "reg[{b}]"),
+}
+
+# Instructions that end a block by setting the PC. CALL is also a store, and
+# pushes the return address before it jumps
+TERMINATORS = {
+    "CALL": ["cpu.pc = reg[{a}]"],
+    "JMP": ["cpu.pc = reg[{a}]"],
+    "JEQ": ["cpu.pc = reg[{a}] if cpu.fl & 0b001 else {next}"],
+    "JNE": ["cpu.pc = {next} if cpu.fl & 0b001 else reg[{a}]"],
+    "RET": [
+        "cpu.pc = ram[reg[7]]",
+        "reg[7] = (reg[7] + 1) & 0xFF",
+    ],
+}
+
+# Longest block we'll compile, in instructions
+MAX_BLOCK_LENGTH = 64
+
+
+class BlockCompiler:
+    """Execution engine that runs a CPU by compiling its basic blocks."""
+
+    def __init__(self, cpu):
+        """Construct a compiler for the program loaded into the given CPU."""
+        self.cpu = cpu
+
+        # Map opcodes back to their names
+        self.names = {code: name for name, code in cpu.opcodes.items()}
+
+        # Compiled blocks, keyed by their start address. Each value is a tuple
+        # of (function, addresses the block was compiled from)
+        self.blocks = {}
+
+        # Map each address to the start addresses of blocks compiled from it
+        self.owners = {}
+
+        # Set when a write throws away compiled code, so a running block knows
+        # to stop before it executes anything stale
+        self.modified = False
+
+        # Whether the blocks found by static analysis have been compiled
+        self.precompiled = False
+
+        cpu.code_watchers.append(self.invalidate)
+
+    def invalidate(self, address):
+        """
+        Throw away every block compiled from the given address
+        """
+        starts = self.owners.pop(address, None)
+
+        if not starts:
+            return
+
+        for start in starts:
+            block = self.blocks.pop(start, None)
+
+            if block is None:
+                continue
+
+            # Forget the block at every other address it covers
+            for covered in block[1]:
+                if covered != address and covered in self.owners:
+                    self.owners[covered].discard(start)
+
+        self.modified = True
+
+    def reset(self):
+        """
+        Throw away all compiled blocks, e.g. after loading a new program
+        """
+        self.blocks.clear()
+        self.owners.clear()
+        self.precompiled = False
+
+    def precompile(self, analysis):
+        """
+        Compile every basic block found by static analysis (an
+        analysis.Analysis of the program loaded into the CPU), so the program
+        doesn't stop to compile blocks as it reaches them
+        """
+        for start in analysis.blocks:
+            if start in self.blocks:
+                continue
+
+            # Analysis can find blocks the program never reaches, e.g. the
+            # far side of a branch that's never taken. If one holds something
+            # that isn't code, leave it to raise if the program gets there
+            try:
+                self.compile(start)
+            except Exception:
+                pass
+
+    def compile(self, start):
+        """
+        Compile the basic block starting at the given address and cache it
+        """
+        cpu = self.cpu
+        ram = cpu.ram
+
+        lines = []
+        namespace = {
+            "engine": self,
+            "PRA_BYTES": PRA_BYTES,
+            "PRN_BYTES": PRN_BYTES,
+        }
+        addresses = []
+
+        address = start
+        count = 0
+
+        def emit(source, a, b, next_address):
+            for line in source:
+                lines.append("    " + line.format(a=a, b=b, next=next_address))
+
+        while True:
+            instruction = ram[address]
+            operand_a = ram[(address + 1) & 0xFF]
+            operand_b = ram[(address + 2) & 0xFF]
+
+            # The PC wraps around from the end of memory to the start
+            size = (instruction >> 6) + 1
+            end = address + size
+            next_address = end & 0xFF
+            name = self.names.get(instruction)
+
+            # Instructions that could make an interrupt fire go through the
+            # CPU's handler, which returns to CPU.run() to check for them
+            if cpu.affects_interrupts(instruction, operand_a):
+                name = None
+
+            for covered in range(address, address + size):
+                addresses.append(covered & 0xFF)
+            count += 1
+
+            if name in TEMPLATES:
+                emit(TEMPLATES[name], operand_a, operand_b, next_address)
+
+            elif name in STORES:
+                before, target, value = STORES[name]
+
+                emit(before, operand_a, operand_b, next_address)
+                emit(["cpu.ram_write(%s, %s)" % (target, value)],
+                     operand_a, operand_b, next_address)
+
+                if name in TERMINATORS:
+                    emit(TERMINATORS[name], operand_a, operand_b, next_address)
+                    break
+
+                # If the store overwrote compiled code, this block may be
+                # stale, so stop here and let the engine recompile
+                emit([
+                    "if engine.modified:",
+                    "    cpu.pc = {next}",
+                    "    cpu.ir = %d" % instruction,
+                    "    return %d" % count,
+                ], operand_a, operand_b, next_address)
+
+            elif name in TERMINATORS:
+                emit(TERMINATORS[name], operand_a, operand_b, next_address)
+                break
+
+            else:
+                # Anything else goes through the CPU's own handler, which also
+                # raises for unknown instructions. We can't know what the
+                # handler does, so it always ends the block
+                handler_name = "handler_%02X" % address
+                _, handler, _, _, pc_advance = cpu.decode(address)
+                namespace[handler_name] = handler
+
+                emit([
+                    "cpu.pc = %d" % address,
+                    "cpu.ir = %d" % instruction,
+                    "%s(%d, %d)" % (handler_name, operand_a, operand_b),
+                    "cpu.pc += %d" % pc_advance,
+                ], operand_a, operand_b, next_address)
+                break
+
+            # Don't let a block run off the end of memory or grow too long
+            if end > 0xFF or count == MAX_BLOCK_LENGTH:
+                emit(["cpu.pc = {next}"], operand_a, operand_b, next_address)
+                break
+
+            address = next_address
+
+        lines.append("    cpu.ir = %d" % instruction)
+        lines.append("    return %d" % count)
+
+        function_name = "block_%02X" % start
+        source = "def %s(cpu, reg, ram):\n%s\n" % (function_name, "\n".join(lines))
+        exec(source, namespace)
+
+        function = namespace[function_name]
+        self.blocks[start] = (function, addresses)
+
+        for covered in addresses:
+            self.owners.setdefault(covered & 0xFF, set()).add(start)
+
+        return function
+
+    def run(self, max_cycles=None):
+        """
+        Run the CPU until it halts, or until it has executed max_cycles
+        instructions. Returns a RunResult, just like CPU.run().
+        """
+        if not self.precompiled:
+            self.precompile(analysis.analyze_cpu(self.cpu))
+            self.precompiled = True
+
+        return self.cpu.run(max_cycles, self.execute)
+
+    def execute(self, max_cycles=None):
+        """
+        Execute blocks until the CPU halts, or until max_cycles instructions
+        have been executed. Returns the number of instructions executed.
+        """
+        cpu = self.cpu
+        blocks = self.blocks
+        cycles = 0
+
+        try:
+            while cpu.running:
+                # Blocks can't stop part way through, so hand the last few
+                # instructions over to the CPU to stop on exactly max_cycles
+                if max_cycles is not None and \
+                        max_cycles - cycles < MAX_BLOCK_LENGTH:
+                    cycles += cpu.execute(max_cycles - cycles)
+                    break
+
+                block = blocks.get(cpu.pc)
+
+                if block is None:
+                    function = self.compile(cpu.pc)
+                else:
+                    function = block[0]
+
+                self.modified = False
+                cycles += function(cpu, cpu.reg, cpu.ram)
+        except BaseException:
+            # run() only counts slices that return, so count the
+            # instructions that ran before the one that raised
+            cpu.cycles += cycles
+            raise
+
+        return cycles
@@ -1,36 +1,178 @@
 """CPU functionality."""
+import collections
+import copy
+import os
+import struct
 import sys
+import time
+import types
+
+import image
+from devices import OutputBuffer, PRA_BYTES, PRN_BYTES
+
+# What CPU.run() returns:
+#   halt_reason - why the CPU stopped, e.g. "HLT" or "max_cycles"
+#   cycles      - number of instructions executed during the run
+#   output      - everything the program has printed, if the output sink
+#                 captures it (e.g. io.StringIO), otherwise None
+#   idle_cycles - cycles skipped while the CPU was idle, waiting for a device
+#                 that counts time in cycles
+RunResult = collections.namedtuple(
+    "RunResult", ["halt_reason", "cycles", "output", "idle_cycles"],
+    defaults=[0])
+
+# Snapshots made by CPU.snapshot() start with this header: magic, version, PC,
+# FL, flags, cycles, idle cycles and the length of the halt reason. Then come
+# the halt reason, RAM, the registers, the number of devices, and for each
+# device the length of its state followed by the state.
+SNAPSHOT_MAGIC = b"LS8S"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<4sBHBBQQB")
+
+# Version 1 snapshots have no idle cycle count
+SNAPSHOT_HEADER_V1 = struct.Struct("<4sBHBBQB")
+
+# Bits in the snapshot flags
+SNAPSHOT_INTERRUPTS_ENABLED = 0b01
+
+# Where the assembler (asm.py) is, for loading .asm source files
+ASM_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "asm")
+
+
+def import_assembler():
+    """
+    Import the assembler from the asm directory next to this one
+    """
+    if ASM_DIRECTORY not in sys.path:
+        sys.path.append(ASM_DIRECTORY)
+
+    import asm
+
+    return asm
+
+
+def parse_program(lines):
+    """
+    Convert the lines of an .ls8 file into the bytes of the program
+    """
+    program = bytearray()
+
+    for line in lines:
+        # Split the line into an array, with '#' as the delimiter
+        comment_split = line.split('#')
+
+        # The first string is a possible instruction
+        possible_instruction = comment_split[0]
+
+        # If it's an empty string, this line is a comment
+        if possible_instruction == '':
+            continue
+
+        # If the string starts with a 1 or 0, it's an instruction
+        if possible_instruction[0] == '1' or possible_instruction[0] == '0':
+            # Get the first 8 values (remove trailing whitespace and chars) and
+            # convert the instruction into an integer
+            program.append(int(possible_instruction[:8], 2))
+
+    return program
+
+
+def read_program(path):
+    """
+    Read a program file into an image.Image, without loading it into a CPU.
+    .asm files are assembled, keeping their labels and DS/DB data regions
+    """
+    path = os.fspath(path)
+
+    if path.endswith(".ls8b"):
+        return image.read_image(path)
+
+    if path.endswith(".asm"):
+        asm = import_assembler()
+
+        sym = {}
+        code = []
+
+        asm.assemble_file(path, sym, code)
+
+        symbols = {name: address & 0xFF for name, address in sym.items()}
+
+        return image.Image(0, 0, bytes(asm.link(sym, code)), symbols,
+                           tuple(asm.data_regions(code)))
+
+    cached = image.cached_image(path)
+
+    if cached is not None:
+        return image.read_image(cached)
+
+    with open(path) as file:
+        data = parse_program(file)
+
+    image.save_cache(path, data)
+
+    return image.Image(0, 0, bytes(data), {})
+
+
+# Opcodes, by instruction name
+OPCODES = {
+    "ADD": 0b10100000,
+    "AND": 0b10101000,
+    "CALL": 0b01010000,
+    "CMP": 0b10100111,
+    "DEC": 0b01100110,
+    "DIV": 0b10100011,
+    "HLT": 0b00000001,
+    "INC": 0b01100101,
+    "INT": 0b01010010,
+    "IRET": 0b00010011,
+    "JEQ": 0b01010101,
+    "JMP": 0b01010100,
+    "JNE": 0b01010110,
+    "LD": 0b10000011,
+    "LDI": 0b10000010,
+    "MOD": 0b10100100,
+    "MUL": 0b10100010,
+    "NOT": 0b01101001,
+    "OR": 0b10101010,
+    "PRA": 0b01001000,
+    "PRN": 0b01000111,
+    "POP": 0b01000110,
+    "PUSH": 0b01000101,
+    "RET": 0b00010001,
+    "SHL": 0b10101100,
+    "SHR": 0b10101101,
+    "ST": 0b10000100,
+    "SUB": 0b10100001,
+    "XOR": 0b10101011,
+}
+
 
 class CPU:
     """Main CPU class."""
 
-    def __init__(self):
-        """Construct a new CPU."""
+    def __init__(self, output=None):
+        """
+        Construct a new CPU.
+
+        output is where PRN and PRA write to: a devices.OutputBuffer, or a
+        file, pipe or text stream to wrap in one. By default output is kept in
+        memory and returned from run().
+        """
 
         # OPCODEs
-        self.opcodes = {
-            "ADD": 0b10100000,
-            "CALL": 0b01010000,
-            "CMP": 0b10100111,
-            "DIV": 0b10100011,
-            "HLT": 0b00000001,
-            "JEQ": 0b01010101,
-            "JMP": 0b01010100,
-            "JNE": 0b01010110,
-            "LDI": 0b10000010,
-            "MUL": 0b10100010,
-            "PRN": 0b01000111,
-            "POP": 0b01000110,
-            "PUSH": 0b01000101,
-            "RET": 0b00010001,
-            "SUB": 0b10100001
-        }
+        self.opcodes = OPCODES
+
+        # Initialize ram to hold 256 bytes of memory. A bytearray can only hold
+        # values 0-255, so every write has to wrap its value to 8 bits first
+        self.ram = bytearray(256)
 
-        # Initialize ram to hold 256 bytes of memory
-        self.ram = [0] * 256
+        # A view of ram that loaders, debuggers and snapshots can use to read
+        # and write memory in bulk without copying it
+        self.memory = memoryview(self.ram)
 
-        # Eight general purpose registers
-        self.reg = [0] * 8
+        # Eight general purpose 8-bit registers
+        self.reg = bytearray(8)
 
         # self.reg[5] is reserved as the Interrupt Mark (IM)
         # self.reg[6] is reserved as the Interrupt Status (IS)
@@ -64,14 +206,43 @@ class CPU:
         # E Equal: during a CMP, set to 1 if registerA is equal to registerB, zero otherwise.
         self.fl = 0b00000000
 
-        # Loop in cpu_run() will run while this is True
+        # Labels and their addresses, if the loaded program came with them
+        self.symbols = {}
+
+        # Loop in execute() will run while this is True. It's set to False when
+        # the CPU halts, and to return to run() to check for interrupts
         self.running = True
 
+        # Why the CPU stopped running, set when it halts
+        self.halt_reason = None
+
+        # Total number of cycles gone by. Devices keep virtual time by this,
+        # so it includes the cycles skipped while idle
+        self.cycles = 0
+
+        # How many of those cycles were skipped while idle, rather than
+        # executed
+        self.idle_cycles = 0
+
+        # Interrupts are disabled while an interrupt handler is running
+        self.interrupts_enabled = True
+
+        # Devices polled by run(), e.g. a devices.Timer
+        self.devices = []
+
+        # Where PRN and PRA write to
+        if not isinstance(output, OutputBuffer):
+            output = OutputBuffer(output)
+
+        self.output = output
+
         # Set up a branch table
         self.branchtable = {}
         self.branchtable[self.opcodes['HLT']] = self.handle_hlt
+        self.branchtable[self.opcodes['LD']] = self.handle_ld
         self.branchtable[self.opcodes['LDI']] = self.handle_ldi
         self.branchtable[self.opcodes['PRN']] = self.handle_prn
+        self.branchtable[self.opcodes['PRA']] = self.handle_pra
         self.branchtable[self.opcodes['PUSH']] = self.handle_push
         self.branchtable[self.opcodes['POP']] = self.handle_pop
         self.branchtable[self.opcodes['CALL']] = self.handle_call
@@ -79,191 +250,498 @@ class CPU:
         self.branchtable[self.opcodes['JMP']] = self.handle_jmp
         self.branchtable[self.opcodes['JEQ']] = self.handle_jeq
         self.branchtable[self.opcodes['JNE']] = self.handle_jne
+        self.branchtable[self.opcodes['ST']] = self.handle_st
+        self.branchtable[self.opcodes['INT']] = self.handle_int
+        self.branchtable[self.opcodes['IRET']] = self.handle_iret
+
+        # Non-ALU instructions that write to the register given as operand_a
+        self.register_writes = {
+            self.opcodes['LD'],
+            self.opcodes['LDI'],
+            self.opcodes['POP'],
+        }
+
+        # Set up the ALU dispatch table - one slot for every possible opcode,
+        # so finding an ALU operation is a single index
+        self.alu_table = [None] * 256
+        self.alu_table[self.opcodes['ADD']] = self.alu_add
+        self.alu_table[self.opcodes['AND']] = self.alu_and
+        self.alu_table[self.opcodes['CMP']] = self.alu_cmp
+        self.alu_table[self.opcodes['DEC']] = self.alu_dec
+        self.alu_table[self.opcodes['DIV']] = self.alu_div
+        self.alu_table[self.opcodes['INC']] = self.alu_inc
+        self.alu_table[self.opcodes['MOD']] = self.alu_mod
+        self.alu_table[self.opcodes['MUL']] = self.alu_mul
+        self.alu_table[self.opcodes['NOT']] = self.alu_not
+        self.alu_table[self.opcodes['OR']] = self.alu_or
+        self.alu_table[self.opcodes['SHL']] = self.alu_shl
+        self.alu_table[self.opcodes['SHR']] = self.alu_shr
+        self.alu_table[self.opcodes['SUB']] = self.alu_sub
+        self.alu_table[self.opcodes['XOR']] = self.alu_xor
+
+        # Decode cache - maps an address to the already decoded instruction
+        # stored there, as a tuple of:
+        #   (instruction, handler, operand_a, operand_b, pc_advance)
+        # Entries are thrown away by ram_write() when the bytes they were
+        # decoded from are overwritten
+        self.decode_cache = {}
+
+        # Functions called with the address of every ram_write(), so other
+        # execution engines can throw away code compiled from that address
+        self.code_watchers = []
 
     def alu(self, op, reg_a, reg_b):
         """ALU operations."""
-        if op == self.opcodes['ADD']:
-            self.reg[reg_a] += self.reg[reg_b]
-        elif op == self.opcodes['SUB']:
-            self.reg[reg_a] -= self.reg[reg_b]
-        elif op == self.opcodes['MUL']:
-            self.reg[reg_a] *= self.reg[reg_b]
-        elif op == self.opcodes['DIV']:
-            self.reg[reg_a] /= self.reg[reg_b]
-        elif op == self.opcodes['CMP']:
-            # Reset the flags
-            self.fl = 0b00000000
-
-            # If reg_a and reg_b are equal, set the E flag to 1 or 0 otherwise
-            if self.reg[reg_a] == self.reg[reg_b]:
-                self.fl = self.fl | 0b00000001
-
-            # If reg_a is greater than reg_b, set the G flag to 1 or 0 otherwise
-            if self.reg[reg_a] > self.reg[reg_b]:
-                self.fl = self.fl | 0b00000010
-
-            # If reg_a is less than reg_b, set the L flag to 1 or 0 otherwise
-            if self.reg[reg_a] < self.reg[reg_b]:
-                self.fl = self.fl | 0b00000100
+        operation = self.alu_table[op]
 
-        else:
+        if operation is None:
             raise Exception("Unsupported ALU operation")
 
-    def handle_call(self):
+        operation(reg_a, reg_b)
+
+    # Every ALU result is bitwise-AND-ed with 0xFF to keep the register values
+    # in the 0-255 range
+
+    def alu_add(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] + self.reg[reg_b]) & 0xFF
+
+    def alu_and(self, reg_a, reg_b):
+        self.reg[reg_a] = self.reg[reg_a] & self.reg[reg_b]
+
+    def alu_cmp(self, reg_a, reg_b):
+        # Reset the flags
+        self.fl = 0b00000000
+
+        # If reg_a and reg_b are equal, set the E flag to 1 or 0 otherwise
+        if self.reg[reg_a] == self.reg[reg_b]:
+            self.fl = self.fl | 0b00000001
+
+        # If reg_a is greater than reg_b, set the G flag to 1 or 0 otherwise
+        if self.reg[reg_a] > self.reg[reg_b]:
+            self.fl = self.fl | 0b00000010
+
+        # If reg_a is less than reg_b, set the L flag to 1 or 0 otherwise
+        if self.reg[reg_a] < self.reg[reg_b]:
+            self.fl = self.fl | 0b00000100
+
+    def alu_dec(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] - 1) & 0xFF
+
+    def alu_div(self, reg_a, reg_b):
+        # Dividing by zero halts, with the error as the halt reason
+        if self.reg[reg_b] == 0:
+            self.running = False
+            self.halt_reason = "division by zero"
+            return
+
+        self.reg[reg_a] = self.reg[reg_a] // self.reg[reg_b]
+
+    def alu_inc(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] + 1) & 0xFF
+
+    def alu_mod(self, reg_a, reg_b):
+        # Dividing by zero halts, with the error as the halt reason
+        if self.reg[reg_b] == 0:
+            self.running = False
+            self.halt_reason = "division by zero"
+            return
+
+        self.reg[reg_a] = self.reg[reg_a] % self.reg[reg_b]
+
+    def alu_mul(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] * self.reg[reg_b]) & 0xFF
+
+    def alu_not(self, reg_a, reg_b):
+        self.reg[reg_a] = ~self.reg[reg_a] & 0xFF
+
+    def alu_or(self, reg_a, reg_b):
+        self.reg[reg_a] = self.reg[reg_a] | self.reg[reg_b]
+
+    def alu_shl(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] << self.reg[reg_b]) & 0xFF
+
+    def alu_shr(self, reg_a, reg_b):
+        self.reg[reg_a] = self.reg[reg_a] >> self.reg[reg_b]
+
+    def alu_sub(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] - self.reg[reg_b]) & 0xFF
+
+    def alu_xor(self, reg_a, reg_b):
+        self.reg[reg_a] = self.reg[reg_a] ^ self.reg[reg_b]
+
+    def handle_call(self, operand_a, operand_b):
         # Get the address of the instruction directly after CALL
-        return_address = self.pc + 2
+        return_address = (self.pc + 2) & 0xFF
 
         # Push it onto the stack
         ## Decrement the Stack Pointer
-        self.reg[7] -= 1
+        self.reg[7] = (self.reg[7] - 1) & 0xFF
 
         ## Store the return address at the top of the stack
         self.ram_write(self.reg[7], return_address)
 
-        # Get the register to fetch from
-        register_num = self.ram_read(self.pc + 1)
-
-        # Grab the address stored in that register
-        address = self.reg[register_num]
+        # Grab the address stored in the register given as the operand
+        address = self.reg[operand_a]
 
         # Set the PC to that address
         self.pc = address
 
-    def handle_hlt(self):
+    def handle_hlt(self, operand_a, operand_b):
         self.running = False
-        sys.exit()
+        self.halt_reason = "HLT"
+
+    def handle_int(self, operand_a, operand_b):
+        # Set the bit in IS for the interrupt number in the register
+        self.raise_interrupt(self.reg[operand_a] & 0b111)
+
+        self.pc = (self.pc + 2) & 0xFF
+
+    def handle_iret(self, operand_a, operand_b):
+        # Pop R6-R0 off the stack, in that order
+        for register in range(6, -1, -1):
+            self.reg[register] = self.stack_pop()
 
-    def handle_jeq(self):
+        # Pop the FL register off the stack
+        self.fl = self.stack_pop()
+
+        # Pop the return address off the stack into the PC
+        self.pc = self.stack_pop()
+
+        # Re-enable interrupts
+        self.interrupts_enabled = True
+
+    def handle_jeq(self, operand_a, operand_b):
         # Isolate the equal flag
         equal = self.fl & 0b00000001
 
         if equal:
-            # Get the register to retrieve from
-            register = self.ram_read(self.pc + 1)
-
-            # Get the address stored in that register
-            address = self.reg[register]
+            # Get the address stored in the register given as the operand
+            address = self.reg[operand_a]
 
             # Jump to that address
             self.pc = address
         else:
             # Otherwise go to the next instruction
-            self.pc += 2
-
-    def handle_jmp(self):
-        # Get the register to retrieve from
-        register = self.ram_read(self.pc + 1)
+            self.pc = (self.pc + 2) & 0xFF
 
+    def handle_jmp(self, operand_a, operand_b):
         # Get the address to jump to, from the register
-        address = self.reg[register]
+        address = self.reg[operand_a]
 
         # Set the PC to the address
         self.pc = address
 
-    def handle_jne(self):
+    def handle_jne(self, operand_a, operand_b):
         # Isolate the equal flag
         equal = self.fl & 0b00000001
 
         if not equal:
-            # Get the register to retrieve from
-            register = self.ram_read(self.pc + 1)
-
-            # Get the address stored in that register
-            address = self.reg[register]
+            # Get the address stored in the register given as the operand
+            address = self.reg[operand_a]
 
             # Jump to that address
             self.pc = address
         else:
             # Otherwise go to the next instruction
-            self.pc += 2
+            self.pc = (self.pc + 2) & 0xFF
 
-    def handle_ldi(self):
-        register = self.ram_read(self.pc + 1)
-        value = self.ram_read(self.pc + 2)
+    def handle_ld(self, operand_a, operand_b):
+        # Load registerA with the value at the address stored in registerB
+        self.reg[operand_a] = self.ram_read(self.reg[operand_b])
 
-        self.reg[register] = value
+    def handle_ldi(self, operand_a, operand_b):
+        self.reg[operand_a] = operand_b
 
-    def handle_pop(self):
+    def handle_pop(self, operand_a, operand_b):
         # Get the value from address pointed to by the Stack Pointer
         value = self.ram_read(self.reg[7])
 
-        # Get the register number to copy into
-        register = self.ram_read(self.pc + 1)
-
         # Copy the value into the register
-        self.reg[register] = value
+        self.reg[operand_a] = value
 
         # Increment the Stack Pointer
-        self.reg[7] += 1
+        self.reg[7] = (self.reg[7] + 1) & 0xFF
 
-    def handle_prn(self):
-        register = self.ram_read(self.pc + 1)
-        print(self.reg[register])
+    def handle_pra(self, operand_a, operand_b):
+        # Print the ASCII character for the value in the register
+        self.output.write(PRA_BYTES[self.reg[operand_a]])
 
-    def handle_push(self):
-        # Decrement the Stack Pointer
-        self.reg[7] -= 1
+    def handle_prn(self, operand_a, operand_b):
+        # Print the decimal value in the register
+        self.output.write(PRN_BYTES[self.reg[operand_a]])
 
-        # Get the register to retrieve the value from
-        register = self.ram_read(self.pc + 1)
+    def handle_push(self, operand_a, operand_b):
+        # Decrement the Stack Pointer
+        self.reg[7] = (self.reg[7] - 1) & 0xFF
 
         # Get the value from the register
-        value = self.reg[register]
+        value = self.reg[operand_a]
 
         # Copy the value to the address pointed to by the SP
         self.ram_write(self.reg[7], value)
 
-    def handle_ret(self):
+    def handle_ret(self, operand_a, operand_b):
         # Pop the address at the top of the stack
 
         ## Get the address pointed to by the Stack Pointer
         address = self.ram_read(self.reg[7])
 
         ## Increment the Stack Pointer
-        self.reg[7] += 1
+        self.reg[7] = (self.reg[7] + 1) & 0xFF
 
         # Point to PC to that address
         self.pc = address
 
-    def load(self):
-        """Load a program into memory."""
-        # Print an error if user did not provide a program to load
-        # and exit the program
-        if len(sys.argv) < 2:
-            print("Please provide a file to open\n")
-            print("Usage: filename file_to_open\n")
-            sys.exit()
+    def handle_st(self, operand_a, operand_b):
+        # Store the value in registerB at the address held in registerA
+        self.ram_write(self.reg[operand_a], self.reg[operand_b])
 
-        try:
-            # Open the file provided as the 2nd arg
-            with open(sys.argv[1]) as file:
-                for line in file:
-                    # Split the line into an array, with '#' as the delimiter
-                    comment_split = line.split('#')
+    def decode(self, address):
+        """
+        Decode the instruction at the given address and store it in the
+        decode cache, so the next time the PC lands here we can skip straight
+        to executing it
+        """
+        # Get the instruction and the bytes at address+1 and address+2
+        instruction = self.ram_read(address)
+        operand_a = self.ram_read((address + 1) & 0xFF)
+        operand_b = self.ram_read((address + 2) & 0xFF)
+
+        # Get the number of operands
+        num_operands = instruction >> 6
+
+        # Check if it's an ALU instruction
+        is_alu_operation = (instruction >> 5) & 0b1
+
+        if is_alu_operation:
+            # The ALU table entries take the same operands as a handler
+            handler = self.alu_table[instruction]
+
+            if handler is None:
+                raise Exception("Unsupported ALU operation")
+        elif instruction in self.branchtable:
+            handler = self.branchtable[instruction]
+        else:
+            raise Exception(
+                "Unknown instruction %02X at address %02X" % (instruction, address)
+            )
+
+        # run() only checks for interrupts every so often, so instructions that
+        # could make an interrupt fire need to stop execute() for a check
+        if self.affects_interrupts(instruction, operand_a):
+            handler = self.interrupt_checkpoint(handler)
+
+        # Check if this instruction sets the PC directly. If it doesn't, the PC
+        # is advanced past the instruction and its operands after it runs. The
+        # PC is 8 bits, so an instruction at the end of memory wraps around to
+        # the start - the advance is worked out here so execute() doesn't
+        # have to mask the PC
+        sets_pc = (instruction >> 4) & 0b0001
+
+        if sets_pc:
+            pc_advance = 0
+        else:
+            pc_advance = ((address + num_operands + 1) & 0xFF) - address
+
+        entry = (instruction, handler, operand_a, operand_b, pc_advance)
+        self.decode_cache[address] = entry
+
+        return entry
+
+    def affects_interrupts(self, instruction, operand_a):
+        """
+        Check if an instruction could make an interrupt fire: INT, IRET, or
+        anything that writes to the IM or IS registers
+        """
+        if instruction == self.opcodes['INT'] or instruction == self.opcodes['IRET']:
+            return True
+
+        if operand_a != 5 and operand_a != 6:
+            return False
+
+        # Every ALU operation except CMP writes to registerA
+        if (instruction >> 5) & 0b1:
+            return instruction != self.opcodes['CMP']
+
+        return instruction in self.register_writes
 
-                    # The first string is a possible instruction
-                    possible_instruction = comment_split[0]
+    def interrupt_checkpoint(self, handler):
+        """
+        Wrap a handler so that execute() returns to run() after it, to check
+        for interrupts
+        """
+        def checkpoint(operand_a, operand_b):
+            handler(operand_a, operand_b)
+            self.running = False
+
+        # Keep the wrapped handler, so fork() can rebind it
+        checkpoint.handler = handler
+
+        return checkpoint
+
+    def rebind(self, handler):
+        """
+        Get the handler on this CPU that does the same as the given handler,
+        which belongs to another CPU
+        """
+        function = getattr(handler, "__func__", None)
+
+        # Handlers wrapped by interrupt_checkpoint() aren't methods
+        if function is None:
+            return self.interrupt_checkpoint(self.rebind(handler.handler))
+
+        return types.MethodType(function, self)
+
+    def raise_interrupt(self, number):
+        """
+        Set the bit for an interrupt in the IS register
+        """
+        self.reg[6] |= 1 << number
+
+    def interrupt(self):
+        """
+        Service the lowest numbered interrupt that is both raised and unmasked,
+        if there is one
+        """
+        # AND the IM register with the IS register
+        masked_interrupts = self.reg[5] & self.reg[6]
 
-                    # If it's an empty string, this line is a comment
-                    if possible_instruction == '':
-                        continue
+        if not masked_interrupts:
+            return
 
-                    # If the string starts with a 1 or 0, it's an instruction
-                    if possible_instruction[0] == '1' or possible_instruction[0] == '0':
-                        # Get the first 8 values (remove trailing whitespace and
-                        # chars)
-                        instruction = possible_instruction[:8]
+        for number in range(8):
+            if masked_interrupts & (1 << number):
+                break
 
-                        # Convert the instruction into an integer and store it
-                        # in memory
-                        self.ram[self.mar] = int(instruction, 2)
+        # Disable further interrupts
+        self.interrupts_enabled = False
 
-                        # Increment the memory address register value
-                        self.mar += 1
+        # Clear the bit in the IS register
+        self.reg[6] &= ~(1 << number) & 0xFF
 
-        except FileNotFoundError:
-                print(f'{sys.argv[0]}: {sys.argv[1]} not found')
-                sys.exit()
+        # Push the PC, the FL register and R0-R6 on the stack
+        self.stack_push(self.pc)
+        self.stack_push(self.fl)
+
+        for register in range(7):
+            self.stack_push(self.reg[register])
+
+        # Jump to the handler address in the interrupt vector table
+        self.pc = self.ram_read(0xF8 + number)
+
+    def stack_push(self, value):
+        """
+        Push a value onto the stack
+        """
+        self.reg[7] = (self.reg[7] - 1) & 0xFF
+        self.ram_write(self.reg[7], value)
+
+    def stack_pop(self):
+        """
+        Pop a value off the stack
+        """
+        value = self.ram_read(self.reg[7])
+        self.reg[7] = (self.reg[7] + 1) & 0xFF
+
+        return value
+
+    def load(self, program):
+        """
+        Load a program into memory, starting at address 0.
+
+        program can be:
+          * bytes (or a bytearray or memoryview) of machine code
+          * the path to an .ls8 text file, .ls8b image or .asm source file
+          * an image.Image, e.g. from image.decode_image()
+          * an iterable of byte values, or of lines in the .ls8 format
+        """
+        if isinstance(program, (str, os.PathLike)):
+            self.load_file(program)
+            return
+
+        if isinstance(program, image.Image):
+            end = program.load_address + len(program.code)
+
+            self.ram_write_block(program.load_address, program.code)
+            self.pc = program.entry
+            self.symbols = dict(program.symbols)
+            self.mar = end
+            return
+
+        if isinstance(program, (bytes, bytearray, memoryview)):
+            data = program
+        else:
+            program = list(program)
+
+            if all(isinstance(value, int) for value in program):
+                data = bytes(program)
+            else:
+                data = parse_program(program)
+
+        self.ram_write_block(0, data)
+
+        # Leave the MAR pointing just past the end of the program
+        self.mar = len(data)
+
+    def load_file(self, path):
+        """
+        Load an .ls8 text file or .ls8b image. Text files are converted to an
+        image the first time they're loaded, and the image is used from then on
+        """
+        path = os.fspath(path)
+
+        if path.endswith(".asm"):
+            self.load_source(path)
+            return
+
+        if path.endswith(".ls8b"):
+            image_path = path
+        else:
+            image_path = image.cached_image(path)
+
+        if image_path is None:
+            with open(path) as file:
+                data = parse_program(file)
+
+            image.save_cache(path, data)
+            self.ram_write_block(0, data)
+            self.mar = len(data)
+            return
+
+        loaded = image.load_image(self, image_path)
+
+        # The image was read straight into memory, so anything decoded from
+        # there is stale
+        end = loaded.load_address + len(loaded.code)
+        self.invalidate_range(loaded.load_address, end)
+
+        self.pc = loaded.entry
+        self.symbols = loaded.symbols
+        self.mar = end
+
+    def load_source(self, source):
+        """
+        Assemble LS-8 assembly source straight into memory, and keep its labels
+        as the symbols. source is the path to an .asm file, which is assembled
+        incrementally using the assembler's cache, or an iterable of source
+        lines, e.g. an io.StringIO
+        """
+        asm = import_assembler()
+
+        sym = {}
+        code = []
+
+        if isinstance(source, (str, os.PathLike)):
+            asm.assemble_file(os.fspath(source), sym, code)
+        else:
+            asm.pass1(source, sym, code)
+
+        data = asm.link(sym, code)
+
+        self.ram_write_block(0, data)
+        self.mar = len(data)
+
+        self.symbols = {name: address & 0xFF for name, address in sym.items()}
 
     def ram_read(self, address):
         """
@@ -284,42 +762,411 @@ class CPU:
         # Save address to MAR
         self.mar = address
 
-        # Save value to MDR
-        self.mdr = value
+        # Save value to MDR, wrapped to 8 bits
+        self.mdr = value & 0xFF
 
         # Save the value in MDR to the memory address stored in MAR
         self.ram[self.mar] = self.mdr
 
-    def run(self):
-        """Run the CPU."""
-        while self.running:
-            # Get the current instruction
-            instruction = self.ram_read(self.pc)
+        # Throw away any decoded instruction that this write overlaps. An
+        # instruction is at most 3 bytes long, so it could have started at
+        # this address or up to 2 bytes before it
+        if self.decode_cache:
+            for start in (address, address - 1, address - 2):
+                self.decode_cache.pop(start & 0xFF, None)
+
+        for watcher in self.code_watchers:
+            watcher(address)
+
+    def ram_write_block(self, address, data):
+        """
+        Copy a block of bytes into memory starting at the given address,
+        throwing away any code decoded or compiled from that range
+        """
+        end = address + len(data)
+
+        if end > len(self.ram):
+            raise ValueError("Block does not fit in memory")
+
+        self.memory[address:end] = data
+
+        self.invalidate_range(address, end)
+
+    def invalidate_range(self, start, end):
+        """
+        Throw away any code decoded or compiled from addresses start up to end,
+        after memory has been changed without going through ram_write()
+        """
+        self.decode_cache.clear()
+
+        for watcher in self.code_watchers:
+            for address in range(start, end):
+                watcher(address)
+
+    def run(self, max_cycles=None, execute=None, block=True):
+        """
+        Run the CPU until it halts, or until max_cycles cycles have gone by,
+        counting those skipped while idle. Returns a RunResult, with the
+        output of this run only (cpu.output.getvalue() has all of it).
+
+        Instructions are executed in slices by execute (CPU.execute() unless
+        another engine provides its own). Between slices, devices are polled
+        and interrupts are serviced. Slices end at the next device deadline or
+        when an instruction could have made an interrupt fire.
+
+        If block is False, run() returns as soon as the CPU is idle and would
+        have to wait for input or the wall clock, with a halt_reason of
+        "blocked", instead of sleeping.
+        """
+        if execute is None:
+            execute = self.execute
+
+        cycles = 0
+        halt_reason = None
+
+        # Where this run's output starts, and how many cycles had been skipped
+        idle_start = self.idle_cycles
+        output_start = self.output.tell()
+
+        try:
+            while self.halt_reason is None:
+                elapsed = cycles + self.idle_cycles - idle_start
+
+                if max_cycles is not None and elapsed >= max_cycles:
+                    break
+
+                # Let devices raise interrupts, and find out how long we can run
+                # before any of them needs to be polled again
+                budget = None
+
+                for device in self.devices:
+                    until = device.poll(self)
+
+                    if until is not None and (budget is None or until < budget):
+                        budget = until
+
+                if self.interrupts_enabled:
+                    self.interrupt()
+
+                if max_cycles is not None:
+                    remaining = max_cycles - elapsed
+
+                    if budget is None or remaining < budget:
+                        budget = remaining
+
+                if self.spinning():
+                    executed = self.idle(budget, block, execute,
+                                         max_cycles is not None)
+
+                    if executed is None:
+                        halt_reason = "blocked"
+                        break
+                else:
+                    self.running = True
+                    executed = execute(budget)
+
+                cycles += executed
+                self.cycles += executed
+        finally:
+            # Don't lose buffered output if an instruction raises
+            self.output.flush()
+
+        self.running = False
+
+        return self.result(cycles, halt_reason, output_start,
+                           self.idle_cycles - idle_start)
+
+    def execute(self, max_cycles=None):
+        """
+        Execute instructions until the CPU halts, or until max_cycles have been
+        executed. Returns the number of instructions executed.
+        """
+        decode_cache = self.decode_cache
+        cycles = 0
+
+        try:
+            while self.running:
+                if cycles == max_cycles:
+                    break
+
+                # Look up the decoded instruction at the PC, decoding it on a
+                # miss
+                entry = decode_cache.get(self.pc)
+
+                if entry is None:
+                    entry = self.decode(self.pc)
+
+                instruction, handler, operand_a, operand_b, pc_advance = entry
+
+                # Store a copy of the current instruction in IR register
+                self.ir = instruction
+
+                handler(operand_a, operand_b)
+
+                # Point the PC to the next instruction in memory, unless the
+                # instruction set the PC itself (pc_advance is 0)
+                self.pc += pc_advance
+
+                cycles += 1
+        except BaseException:
+            # run() only counts slices that return, so count the
+            # instructions that ran before the one that raised
+            self.cycles += cycles
+            raise
+
+        return cycles
+
+    def spinning(self):
+        """
+        Check if the CPU is idle, jumping to the same instruction over and over
+        while it waits for an interrupt
+        """
+        if self.ram[self.pc] != self.opcodes['JMP']:
+            return False
+
+        return self.reg[self.ram[(self.pc + 1) & 0xFF]] == self.pc
+
+    def idle(self, budget, block=True, execute=None, limited=False):
+        """
+        Wait for the next interrupt instead of executing a spin loop. Returns the
+        number of instructions executed, which is 0 unless nothing can ever
+        interrupt the loop. If block is False and the CPU would have to wait,
+        returns None instead. execute is the engine's execute() that run() was
+        given, used if the loop has to be run after all, and limited says if
+        the run stops after a number of cycles
+        """
+        # Devices that work in wall clock time say how long we can sleep for
+        timeouts = []
+        waiters = []
+
+        # Whether any device works in virtual time, counting cycles
+        counting = False
+
+        for device in self.devices:
+            seconds = None
+            seconds_until_event = getattr(device, "seconds_until_event", None)
 
-            # Store a copy of the current instruction in IR register
-            self.ir = instruction
+            if seconds_until_event is not None:
+                seconds = seconds_until_event(self)
 
-            # Get the number of operands
-            num_operands = instruction >> 6
+                if seconds is not None:
+                    timeouts.append(seconds)
 
-            # Store the bytes at PC+1 and PC+2 
-            operand_a = self.ram_read(self.pc + 1)
-            operand_b = self.ram_read(self.pc + 2)
+            if hasattr(device, "wait"):
+                waiters.append(device)
+            elif seconds is None:
+                counting = True
 
-            # Check if it's an ALU instruction
-            is_alu_operation = (instruction >> 5) & 0b1
+        # Only input can wake the CPU. The budget is just how often the input
+        # devices want polling, so a caller that can wait on them itself gets
+        # control back
+        if waiters and not timeouts and not counting and not block:
+            return None
 
-            if is_alu_operation:
-                self.alu(self.ir, operand_a, operand_b)
+        if timeouts or (waiters and not counting and not limited):
+            if not block:
+                return None
+
+            timeout = min(timeouts) if timeouts else None
+
+            # Show any output before waiting, e.g. a prompt for input
+            self.output.flush()
+
+            # Sleep until the next deadline, or until there's input
+            if waiters:
+                waiters[0].wait(timeout)
             else:
-                self.branchtable[self.ir]()
+                time.sleep(timeout)
+
+            return 0
+
+        if budget is None:
+            # Nothing can ever interrupt the loop, so just run it, on the
+            # same engine as the rest of the program
+            if execute is None:
+                execute = self.execute
+
+            self.running = True
+            return execute(None)
+
+        # In virtual time, or when only the cycle limit can end the loop, skip
+        # straight to the next deadline. Each pass around the loop is one JMP,
+        # so the state at the end is exactly the same
+        self.cycles += budget
+        self.idle_cycles += budget
+
+        return 0
+
+    def result(self, cycles, halt_reason=None, output_start=0, idle_cycles=0):
+        """
+        Build the RunResult for a run that executed the given number of
+        cycles and skipped idle_cycles, and stopped for halt_reason if the CPU
+        didn't halt. Its output is what was written since output_start, an
+        output.tell() value
+        """
+        if self.halt_reason is not None:
+            halt_reason = self.halt_reason
+        elif halt_reason is None:
+            halt_reason = "max_cycles"
+
+        # getvalue() flushes the output buffer, and returns None if the output
+        # went somewhere that can't hand it back
+        return RunResult(halt_reason, cycles,
+                         self.output.getvalue(output_start), idle_cycles)
+
+    def snapshot(self):
+        """
+        Save the state of the machine - RAM, registers, PC, FL, interrupt state
+        and device state - as bytes that restore() can load
+        """
+        flags = 0
+
+        if self.interrupts_enabled:
+            flags |= SNAPSHOT_INTERRUPTS_ENABLED
+
+        halt_reason = (self.halt_reason or "").encode("ascii")
+
+        parts = [
+            SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.pc,
+                                 self.fl, flags, self.cycles, self.idle_cycles,
+                                 len(halt_reason)),
+            halt_reason,
+            self.ram,
+            self.reg,
+            bytes([len(self.devices)]),
+        ]
+
+        # Devices that don't save any state get an empty entry
+        for device in self.devices:
+            snapshot = getattr(device, "snapshot", None)
+            state = b"" if snapshot is None else snapshot(self)
+
+            parts.append(struct.pack("<H", len(state)))
+            parts.append(state)
+
+        return b"".join(parts)
+
+    def restore(self, snapshot):
+        """
+        Load the state saved by snapshot(). Any devices must already be
+        attached, in the same order as when the snapshot was taken
+        """
+        snapshot = memoryview(snapshot)
+
+        magic, version = struct.unpack_from("<4sB", snapshot, 0)
+
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not an LS-8 snapshot")
+
+        if version == SNAPSHOT_VERSION:
+            magic, version, pc, fl, flags, cycles, idle_cycles, halt_length = \
+                SNAPSHOT_HEADER.unpack_from(snapshot, 0)
+            offset = SNAPSHOT_HEADER.size
+        elif version == 1:
+            magic, version, pc, fl, flags, cycles, halt_length = \
+                SNAPSHOT_HEADER_V1.unpack_from(snapshot, 0)
+            idle_cycles = 0
+            offset = SNAPSHOT_HEADER_V1.size
+        else:
+            raise ValueError("Unsupported LS-8 snapshot version %d" % version)
+
+        halt_reason = bytes(snapshot[offset:offset + halt_length]).decode("ascii")
+        offset += halt_length
+
+        # Copy RAM and the registers straight into place
+        self.memory[:] = snapshot[offset:offset + len(self.ram)]
+        offset += len(self.ram)
+
+        self.reg[:] = snapshot[offset:offset + len(self.reg)]
+        offset += len(self.reg)
+
+        self.invalidate_range(0, len(self.ram))
+
+        self.pc = pc
+        self.fl = fl
+        self.cycles = cycles
+        self.idle_cycles = idle_cycles
+        self.interrupts_enabled = bool(flags & SNAPSHOT_INTERRUPTS_ENABLED)
+        self.halt_reason = halt_reason or None
+        self.running = self.halt_reason is None
+
+        device_count = snapshot[offset]
+        offset += 1
+
+        if device_count != len(self.devices):
+            raise ValueError("Snapshot has %d devices, CPU has %d" % (
+                device_count, len(self.devices)))
+
+        for device in self.devices:
+            (length,) = struct.unpack_from("<H", snapshot, offset)
+            offset += 2
+
+            restore = getattr(device, "restore", None)
+
+            if restore is not None:
+                restore(self, bytes(snapshot[offset:offset + length]))
+
+            offset += length
+
+    def fork(self, output=None):
+        """
+        Make a child CPU in exactly the same state as this one, without going
+        through __init__() and load(). Afterwards each CPU runs on its own, and
+        nothing either of them does affects the other.
+
+        The child gets its own copies of RAM, the registers and the devices,
+        and a copy of the decode cache, so it doesn't decode the program again.
+        Code watchers aren't copied, since execution engines attach to the CPU
+        they run. output is where the child's PRN and PRA write to, as for
+        __init__().
+        """
+        child = object.__new__(type(self))
+
+        # Set the attributes one at a time, in the order __init__() does, so
+        # the child's attributes are laid out like any other CPU's and are just
+        # as fast to look up
+        for name, value in self.__dict__.items():
+            setattr(child, name, value)
+
+        # Copying all 256 bytes of RAM takes a fraction of a microsecond, less
+        # than checking for shared pages on every ram_write() would cost
+        child.ram = bytearray(self.ram)
+        child.memory = memoryview(child.ram)
+        child.reg = bytearray(self.reg)
+
+        child.symbols = dict(self.symbols)
+        child.devices = [copy.deepcopy(device) for device in self.devices]
+        child.code_watchers = []
+
+        if not isinstance(output, OutputBuffer):
+            output = OutputBuffer(output)
+
+        child.output = output
+
+        # The handlers in the tables are bound to this CPU, so bind the child's
+        # to the child
+        child.branchtable = {}
+
+        for instruction, handler in self.branchtable.items():
+            child.branchtable[instruction] = child.rebind(handler)
+
+        child.alu_table = [None] * 256
+
+        for instruction in self.opcodes.values():
+            handler = self.alu_table[instruction]
+
+            if handler is not None:
+                child.alu_table[instruction] = child.rebind(handler)
+
+        child.decode_cache = {}
+
+        for address, entry in self.decode_cache.items():
+            instruction, handler, operand_a, operand_b, pc_advance = entry
 
-            # Check if this instruction  sets the PC directly
-            sets_pc = (instruction >> 4) & 0b0001
+            child.decode_cache[address] = (instruction, child.rebind(handler),
+                                           operand_a, operand_b, pc_advance)
 
-            if not sets_pc:
-                # Point the PC to the next instruction in memory
-                self.pc += num_operands + 1
+        return child
 
     def trace(self):
         """
@@ -332,8 +1179,8 @@ class CPU:
             self.fl,
             #self.ie,
             self.ram_read(self.pc),
-            self.ram_read(self.pc + 1),
-            self.ram_read(self.pc + 2)
+            self.ram_read((self.pc + 1) & 0xFF),
+            self.ram_read((self.pc + 2) & 0xFF)
         ), end='')
 
         for i in range(8):
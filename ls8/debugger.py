@@ -0,0 +1,466 @@
+"""Interactive debugger for the LS-8.
+
+Usage: ls8.py debug [--keys KEYS] program
+
+Debugger stops a CPU at breakpoints and watchpoints without slowing down the
+instructions in between. A breakpoint replaces the decode cache entry at its
+address with a trap that stops the run before the instruction executes, so
+CPU.execute() runs exactly as usual everywhere else. A watchpoint is found by
+looking the address of each memory write up in a table with an entry for
+every address, so any number of watched ranges cost the same.
+
+The program runs on the plain interpreter, since other engines don't go
+through the decode cache. A breakpoint on a spin loop (a JMP to itself) isn't
+hit while the CPU is idle, since CPU.run() doesn't execute the loop.
+"""
+
+import argparse
+import cmd
+import sys
+
+import tracer
+from batch import positive
+from cpu import CPU
+from devices import OutputBuffer, ScriptedKeyboard, Timer
+
+# Halt reasons for a run the debugger stopped
+BREAKPOINT = "breakpoint"
+WATCHPOINT = "watchpoint"
+
+# Flag bits in FL, and their names
+FLAGS = [(0b100, "L"), (0b010, "G"), (0b001, "E")]
+
+
+class Debugger:
+    """Runs a CPU, stopping at breakpoints and watchpoints."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+
+        # Breakpoint addresses
+        self.breakpoints = set()
+
+        # Addresses a write to would evict a breakpoint's decode cache entry:
+        # the breakpoint and the 2 bytes after it
+        self.nearby = set()
+
+        # Watched ranges by number, as (start, end) inclusive, and the numbers
+        # of the ranges that cover each address
+        self.watchpoints = {}
+        self.watched = [()] * 256
+        self.next_watchpoint = 1
+
+        # Why the last run stopped, if the debugger stopped it: (BREAKPOINT,
+        # address) or (WATCHPOINT, address, value, pc)
+        self.stopped = None
+
+        # Set while the debugger is running the CPU, so writes made while
+        # loading or restoring don't trip watchpoints
+        self.armed = False
+
+        cpu.code_watchers.append(self.written)
+
+    def add_breakpoint(self, address):
+        address &= 0xFF
+
+        self.breakpoints.add(address)
+        self.update_nearby()
+        self.patch(address)
+
+    def remove_breakpoint(self, address):
+        address &= 0xFF
+
+        if address not in self.breakpoints:
+            raise KeyError("No breakpoint at %02X" % address)
+
+        self.breakpoints.discard(address)
+        self.update_nearby()
+        self.unpatch(address)
+
+    def update_nearby(self):
+        self.nearby = {(address + offset) & 0xFF
+                       for address in self.breakpoints for offset in range(3)}
+
+    def add_watchpoint(self, start, end=None):
+        """
+        Stop after any write to addresses start to end (inclusive). Returns the
+        watchpoint's number
+        """
+        if end is None:
+            end = start
+
+        if not 0 <= start <= end <= 0xFF:
+            raise ValueError("Bad address range %02X-%02X" % (start, end))
+
+        number = self.next_watchpoint
+        self.next_watchpoint += 1
+
+        self.watchpoints[number] = (start, end)
+
+        for address in range(start, end + 1):
+            self.watched[address] += (number,)
+
+        return number
+
+    def remove_watchpoint(self, number):
+        start, end = self.watchpoints.pop(number)
+
+        for address in range(start, end + 1):
+            self.watched[address] = tuple(
+                n for n in self.watched[address] if n != number)
+
+    def trap(self, operand_a, operand_b):
+        """
+        Handler patched in at breakpoints. Stops the run with the PC still
+        pointing at the breakpoint
+        """
+        cpu = self.cpu
+
+        cpu.halt_reason = BREAKPOINT
+        cpu.running = False
+
+        self.stopped = (BREAKPOINT, cpu.pc)
+
+    def patch(self, address):
+        """
+        Put a trap in the decode cache at a breakpoint address
+        """
+        cpu = self.cpu
+        cpu.decode_cache[address] = (cpu.ram[address], self.trap, 0, 0, 0)
+
+    def unpatch(self, address):
+        """
+        Take the trap out again, so the instruction is decoded as usual
+        """
+        entry = self.cpu.decode_cache.get(address)
+
+        if entry is not None and entry[1] == self.trap:
+            del self.cpu.decode_cache[address]
+
+    def written(self, address):
+        """
+        Code watcher: check watchpoints, and put back any breakpoint the write
+        evicted from the decode cache
+        """
+        cpu = self.cpu
+
+        if self.armed and self.watched[address]:
+            # Let the instruction finish, then stop
+            cpu.halt_reason = WATCHPOINT
+            cpu.running = False
+
+            self.stopped = (WATCHPOINT, address, cpu.ram[address], cpu.pc)
+
+        # invalidate_range() clears the whole decode cache before calling the
+        # watchers, so an empty cache means every breakpoint went with it
+        if self.breakpoints and (address in self.nearby or not cpu.decode_cache):
+            for breakpoint in self.breakpoints:
+                self.patch(breakpoint)
+
+    def execute(self, max_cycles=None):
+        """
+        CPU.execute(), unless a watchpoint was hit while an interrupt was
+        being serviced, before the slice started
+        """
+        if self.cpu.halt_reason is not None:
+            return 0
+
+        return self.cpu.execute(max_cycles)
+
+    def resume(self, max_cycles=None):
+        """
+        Run the CPU with breakpoints and watchpoints armed
+        """
+        cpu = self.cpu
+        self.stopped = None
+        self.armed = True
+
+        try:
+            result = cpu.run(max_cycles, self.execute)
+        finally:
+            self.armed = False
+
+        if cpu.halt_reason == BREAKPOINT:
+            # execute() counted the trap as an instruction
+            cpu.cycles -= 1
+            result = result._replace(cycles=result.cycles - 1)
+
+        # Stops are only for the debugger, so the CPU can carry on afterwards
+        if cpu.halt_reason in (BREAKPOINT, WATCHPOINT):
+            cpu.halt_reason = None
+
+        return result
+
+    def step(self):
+        """
+        Execute one instruction, even if there's a breakpoint on it. Returns
+        a RunResult
+        """
+        cpu = self.cpu
+        address = cpu.pc
+
+        patched = address in self.breakpoints
+
+        if patched:
+            self.unpatch(address)
+
+        try:
+            return self.resume(1)
+        finally:
+            if patched:
+                self.patch(address)
+
+    def run(self, max_cycles=None):
+        """
+        Run the CPU until it halts, hits a breakpoint or watchpoint, or has
+        executed max_cycles instructions. Returns a RunResult, with a
+        halt_reason of "breakpoint" or "watchpoint" if the debugger stopped
+        it. If the PC is at a breakpoint, that instruction runs first rather
+        than stopping straight away
+        """
+        cycles = 0
+        idle_cycles = 0
+
+        if self.cpu.pc in self.breakpoints:
+            result = self.step()
+            cycles = result.cycles
+            idle_cycles = result.idle_cycles
+
+            if result.halt_reason != "max_cycles":
+                return result
+
+            if max_cycles is not None:
+                max_cycles -= cycles + idle_cycles
+
+                if max_cycles <= 0:
+                    return result
+
+        result = self.resume(max_cycles)
+
+        return result._replace(cycles=cycles + result.cycles,
+                               idle_cycles=idle_cycles + result.idle_cycles)
+
+
+def parse_location(text, symbols):
+    """
+    Parse an address: a number (decimal, or with a 0x or 0b prefix), a label,
+    or a label plus an offset, e.g. "LOOP+2"
+    """
+    try:
+        return int(text, 0) & 0xFF
+    except ValueError:
+        pass
+
+    label, _, offset = text.partition("+")
+
+    if label not in symbols:
+        raise ValueError("Unknown label %r" % label)
+
+    return (symbols[label] + (int(offset, 0) if offset else 0)) & 0xFF
+
+
+class DebuggerShell(cmd.Cmd):
+    """Command line for a Debugger."""
+
+    intro = "LS-8 debugger. Type help for a list of commands."
+    prompt = "(ls8) "
+
+    def __init__(self, debugger):
+        super().__init__()
+
+        self.debugger = debugger
+        self.cpu = debugger.cpu
+
+        self.names = {code: name for name, code in self.cpu.opcodes.items()}
+        self.labels = tracer.label_table(self.cpu.symbols)
+
+        # Set once the program has halted, and can't run any further
+        self.finished = False
+
+    def location(self, text):
+        return parse_location(text, self.cpu.symbols)
+
+    def onecmd(self, line):
+        try:
+            return super().onecmd(line)
+        except (KeyError, ValueError) as e:
+            print("error:", e.args[0] if e.args else e)
+
+    def emptyline(self):
+        pass
+
+    def show_location(self):
+        cpu = self.cpu
+        pc = cpu.pc
+
+        record = (cpu.cycles, pc, cpu.ram[pc], cpu.ram[(pc + 1) & 0xFF],
+                  cpu.ram[(pc + 2) & 0xFF], cpu.fl, bytes(cpu.reg))
+
+        print(tracer.format_record(record, self.names, self.labels))
+
+    def report(self, result):
+        """
+        Say why a run stopped, and where
+        """
+        stopped = self.debugger.stopped
+
+        if result.halt_reason == BREAKPOINT:
+            print("Breakpoint at %02X" % stopped[1])
+        elif result.halt_reason == WATCHPOINT:
+            _, address, value, pc = stopped
+            print("Watchpoint: %02X = %02X, written by the instruction at %02X"
+                  % (address, value, pc))
+        elif result.halt_reason != "max_cycles":
+            print("Program stopped: %s after %d cycles"
+                  % (result.halt_reason, self.cpu.cycles))
+            self.finished = True
+            return
+
+        self.show_location()
+
+    def can_run(self):
+        if self.finished:
+            print("The program has stopped.")
+
+        return not self.finished
+
+    def do_break(self, arg):
+        """break LOCATION: stop before running the instruction at an address
+        or label"""
+        address = self.location(arg)
+        self.debugger.add_breakpoint(address)
+        print("Breakpoint at %02X" % address)
+
+    def do_delete(self, arg):
+        """delete LOCATION: remove a breakpoint"""
+        self.debugger.remove_breakpoint(self.location(arg))
+
+    def do_watch(self, arg):
+        """watch START [END]: stop after a write to an address, or to any
+        address from START to END"""
+        locations = [self.location(text) for text in arg.split()]
+
+        if len(locations) not in (1, 2):
+            raise ValueError("watch takes a start and an optional end")
+
+        number = self.debugger.add_watchpoint(*locations)
+        print("Watchpoint %d" % number)
+
+    def do_unwatch(self, arg):
+        """unwatch NUMBER: remove a watchpoint"""
+        self.debugger.remove_watchpoint(int(arg))
+
+    def do_info(self, arg):
+        """info: list breakpoints and watchpoints"""
+        for address in sorted(self.debugger.breakpoints):
+            print("Breakpoint at %02X %s" % (address, self.labels[address]))
+
+        for number, (start, end) in sorted(self.debugger.watchpoints.items()):
+            print("Watchpoint %d: %02X-%02X" % (number, start, end))
+
+    def do_continue(self, arg):
+        """continue [N]: run until a breakpoint, a watchpoint, the program
+        stops, or N instructions have run"""
+        if self.can_run():
+            self.report(self.debugger.run(int(arg) if arg else None))
+
+    def do_step(self, arg):
+        """step [N]: execute N instructions (default 1)"""
+        for _ in range(int(arg) if arg else 1):
+            if not self.can_run():
+                return
+
+            result = self.debugger.step()
+
+            if result.halt_reason != "max_cycles":
+                self.report(result)
+                return
+
+        self.show_location()
+
+    def do_registers(self, arg):
+        """registers: show the registers, PC and flags"""
+        cpu = self.cpu
+
+        for number, value in enumerate(cpu.reg):
+            name = {5: " (IM)", 6: " (IS)", 7: " (SP)"}.get(number, "")
+            print("R%d%-5s %02X  %3d" % (number, name, value, value))
+
+        flags = "".join(name for bit, name in FLAGS if cpu.fl & bit) or "-"
+
+        print("PC       %02X  %s" % (cpu.pc, self.labels[cpu.pc]))
+        print("FL       %02X  %s" % (cpu.fl, flags))
+        print("cycles   %d" % cpu.cycles)
+
+    def do_memory(self, arg):
+        """memory LOCATION [COUNT]: show COUNT bytes of memory (default 16)"""
+        words = arg.split()
+
+        if not words:
+            raise ValueError("memory takes a location")
+
+        start = self.location(words[0])
+        count = int(words[1], 0) if len(words) > 1 else 16
+
+        for row in range(start, min(start + count, 256), 16):
+            end = min(row + 16, start + count, 256)
+            values = " ".join("%02X" % value for value in self.cpu.ram[row:end])
+            print("%02X: %s" % (row, values))
+
+    def do_where(self, arg):
+        """where: show the instruction at the PC"""
+        self.show_location()
+
+    def do_quit(self, arg):
+        """quit: leave the debugger"""
+        return True
+
+    def do_EOF(self, arg):
+        print()
+        return True
+
+    # Short forms
+    do_b = do_break
+    do_c = do_continue
+    do_s = do_step
+    do_r = do_registers
+    do_x = do_memory
+    do_q = do_quit
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="ls8.py debug",
+        description="Debug an LS-8 program.",
+    )
+    parser.add_argument("program",
+                        help=".ls8, .ls8b or .asm file. Labels come from .asm "
+                             "and .ls8b files")
+    parser.add_argument("--keys", default=None,
+                        help="keys to type into the program, since the "
+                             "debugger has the terminal")
+    parser.add_argument("--cycles-per-second", type=positive, default=None,
+                        help="instructions per timer tick (default: 1000000)")
+    args = parser.parse_args(argv)
+
+    cpu = CPU(output=OutputBuffer(sys.stdout.buffer))
+
+    # Timer ticks go by the cycle count, so time stands still while the
+    # program is stopped
+    if args.cycles_per_second is None:
+        cpu.devices.append(Timer())
+    else:
+        cpu.devices.append(Timer(cycles_per_second=args.cycles_per_second))
+
+    if args.keys is not None:
+        cpu.devices.append(ScriptedKeyboard(args.keys))
+
+    try:
+        cpu.load(args.program)
+    except FileNotFoundError as e:
+        print(f"ls8.py debug: {e.filename} not found", file=sys.stderr)
+        return 1
+
+    DebuggerShell(Debugger(cpu)).cmdloop()
+
+    return 0
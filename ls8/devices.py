@@ -0,0 +1,422 @@
+"""Devices that can be attached to the LS-8.
+
+A device is any object with a poll(cpu) method. CPU.run() polls every device
+in cpu.devices before it services interrupts. poll() raises any interrupts the
+device has pending with cpu.raise_interrupt(), and returns how many cycles the
+CPU can run before the device needs polling again, or None if it doesn't care.
+The CPU only stops to check for interrupts at those deadlines.
+
+When a program is idle, spinning in a loop waiting for an interrupt, CPU.run()
+doesn't execute the loop. Devices that work in wall clock time tell it how
+long to sleep with seconds_until_event(), and devices that read input can
+block waiting for it with wait(seconds). Devices that read from a file
+descriptor also have fileno(), so a scheduler can wait on many at once.
+"""
+
+import collections
+import io
+import os
+import selectors
+import struct
+import sys
+import time
+
+# Interrupt numbers
+TIMER_INTERRUPT = 0
+KEYBOARD_INTERRUPT = 1
+
+# Address the keyboard stores the most recent key pressed in
+KEY_ADDRESS = 0xF4
+
+# How many cycles the CPU can run before the keyboard checks for input again
+KEYBOARD_POLL_CYCLES = 10000
+
+# How long an idle CPU sleeps at a time once the keyboard input has ended
+KEYBOARD_CLOSED_SLEEP = 1
+
+# In real time mode, the longest the timer lets the CPU run between checks of
+# the clock, in seconds
+TIMER_MAX_SLICE = 0.01
+
+# How many bytes of output are buffered before they're written out
+OUTPUT_BUFFER_SIZE = 8192
+
+# What PRN and PRA output for each register value
+PRN_BYTES = [b"%d\n" % value for value in range(256)]
+PRA_BYTES = [bytes([value]) for value in range(256)]
+
+
+class Timer:
+    """
+    Raises the timer interrupt once per second.
+
+    In "virtual" mode a second is cycles_per_second instructions, so programs
+    behave the same every run and go as fast as the emulator can. In "real"
+    mode a second is a second on the wall clock.
+    """
+
+    def __init__(self, mode="virtual", cycles_per_second=1000000,
+                 clock=time.monotonic):
+        if mode not in ("virtual", "real"):
+            raise ValueError("Unknown timer mode %r" % mode)
+
+        # A tick has to be some cycles away, or polling would never catch up
+        if cycles_per_second <= 0:
+            raise ValueError("Timer cycles_per_second must be positive, not %r"
+                             % cycles_per_second)
+
+        self.mode = mode
+        self.cycles_per_second = cycles_per_second
+        self.clock = clock
+
+        # When the next tick is due - a cycle count in virtual mode, a clock
+        # time in real mode. Set on the first poll
+        self.next_tick = None
+
+        # Clock time and cycle count at the last poll, used in real time mode
+        # to estimate how fast the CPU is running
+        self.last_time = None
+        self.last_cycles = None
+
+    def poll(self, cpu):
+        if self.mode == "virtual":
+            return self.poll_virtual(cpu)
+        else:
+            return self.poll_real(cpu)
+
+    def snapshot(self, cpu):
+        """
+        Save how long until the next tick, in cycles or seconds
+        """
+        if self.next_tick is None:
+            remaining = -1
+        elif self.mode == "virtual":
+            remaining = self.next_tick - cpu.cycles
+        else:
+            remaining = self.next_tick - self.clock()
+
+        return struct.pack("<d", remaining)
+
+    def restore(self, cpu, state):
+        (remaining,) = struct.unpack("<d", state)
+
+        if remaining < 0:
+            self.next_tick = None
+        elif self.mode == "virtual":
+            self.next_tick = cpu.cycles + int(remaining)
+        else:
+            self.next_tick = self.clock() + remaining
+
+        self.last_time = None
+        self.last_cycles = None
+
+    def seconds_until_event(self, cpu):
+        """
+        How long until the next tick on the wall clock, or None in virtual mode
+        """
+        if self.mode == "virtual" or self.next_tick is None:
+            return None
+
+        return max(0, self.next_tick - self.clock())
+
+    def poll_virtual(self, cpu):
+        if self.next_tick is None:
+            self.next_tick = cpu.cycles + self.cycles_per_second
+
+        if cpu.cycles >= self.next_tick:
+            cpu.raise_interrupt(TIMER_INTERRUPT)
+
+            # Ticks that were missed while interrupts were disabled are lost
+            while self.next_tick <= cpu.cycles:
+                self.next_tick += self.cycles_per_second
+
+        return self.next_tick - cpu.cycles
+
+    def poll_real(self, cpu):
+        now = self.clock()
+
+        if self.next_tick is None:
+            self.next_tick = now + 1
+
+        if now >= self.next_tick:
+            cpu.raise_interrupt(TIMER_INTERRUPT)
+
+            while self.next_tick <= now:
+                self.next_tick += 1
+
+        # Estimate how many cycles the CPU runs per second from the last slice
+        if self.last_time is not None and now > self.last_time:
+            rate = (cpu.cycles - self.last_cycles) / (now - self.last_time)
+        else:
+            rate = self.cycles_per_second
+
+        self.last_time = now
+        self.last_cycles = cpu.cycles
+
+        # Run until the next tick is due, but check the clock regularly in case
+        # the estimate is off
+        seconds = min(self.next_tick - now, TIMER_MAX_SLICE)
+
+        return max(1, int(rate * seconds))
+
+
+class OutputBuffer:
+    """
+    Collects PRN and PRA output in a bytes buffer, and writes it to the sink
+    in large chunks: when the buffer fills up, and when flush() is called. The
+    CPU flushes when it halts, when run() returns and before it waits for
+    input.
+
+    The sink can be a binary file or pipe, or a text stream (e.g. sys.stdout
+    or an io.StringIO). If there's no sink, output is kept in memory and
+    getvalue() returns all of it.
+    """
+
+    def __init__(self, sink=None, size=OUTPUT_BUFFER_SIZE):
+        self.sink = sink
+        self.size = size
+        self.buffer = bytearray()
+
+        # Bytes flushed so far
+        self.flushed = 0
+
+        # Everything written, when there's no sink to write it to
+        self.captured = bytearray() if sink is None else None
+
+        # Text streams need strings rather than bytes
+        self.text = isinstance(sink, io.TextIOBase)
+
+    def write(self, data):
+        self.buffer += data
+
+        if len(self.buffer) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        if self.sink is None:
+            self.captured += self.buffer
+        else:
+            # Every byte value maps to the character with the same number
+            if self.text:
+                self.sink.write(self.buffer.decode("latin-1"))
+            else:
+                self.sink.write(self.buffer)
+
+            self.sink.flush()
+
+        self.flushed += len(self.buffer)
+        self.buffer.clear()
+
+    def tell(self):
+        """
+        Get how many bytes have been written so far
+        """
+        return self.flushed + len(self.buffer)
+
+    def getvalue(self, start=None):
+        """
+        Get everything written so far as a string, or everything since start
+        (a value from tell()), if the output is being kept in memory.
+        Otherwise get what the sink has, if it can say
+        """
+        self.flush()
+
+        if self.captured is not None:
+            return self.captured[start or 0:].decode("latin-1")
+
+        getvalue = getattr(self.sink, "getvalue", None)
+
+        if getvalue is None:
+            return None
+
+        value = getvalue()
+
+        if isinstance(value, bytes):
+            value = value.decode("latin-1")
+
+        if start is not None:
+            # The sink may hold more than was written through this buffer,
+            # so count back from its end
+            value = value[max(0, len(value) - (self.flushed - start)):]
+
+        return value
+
+
+class InputDevice:
+    """
+    Base class for keyboards. Keys are queued as they arrive and handed to the
+    CPU one at a time: the key is stored at KEY_ADDRESS and the keyboard
+    interrupt is raised. The next key isn't delivered until the CPU has taken
+    the interrupt for the last one.
+    """
+
+    def __init__(self):
+        self.queue = collections.deque()
+
+    def snapshot(self, cpu):
+        """
+        Save the keys that haven't been delivered yet
+        """
+        return bytes(self.queue)
+
+    def restore(self, cpu, state):
+        self.queue = collections.deque(state)
+
+    def deliver(self, cpu):
+        """
+        Hand the next queued key to the CPU, if it's ready for one
+        """
+        if not self.queue or cpu.reg[6] & (1 << KEYBOARD_INTERRUPT):
+            return
+
+        cpu.ram_write(KEY_ADDRESS, self.queue.popleft())
+        cpu.raise_interrupt(KEYBOARD_INTERRUPT)
+
+
+class Keyboard(InputDevice):
+    """
+    Reads keys from a file descriptor (stdin by default) without blocking, using
+    a selector to check if any input is waiting. If the input is a terminal,
+    it's put in cbreak mode so keys arrive as they're pressed. Call close() to
+    put the terminal back.
+    """
+
+    def __init__(self, stream=None):
+        super().__init__()
+
+        if stream is None:
+            stream = sys.stdin
+
+        self.fd = stream.fileno()
+        self.selector = selectors.DefaultSelector()
+
+        try:
+            self.selector.register(self.fd, selectors.EVENT_READ)
+        except PermissionError:
+            # epoll refuses regular files, e.g. stdin redirected from a file.
+            # select() accepts them and always reports them as readable
+            self.selector.close()
+            self.selector = selectors.SelectSelector()
+            self.selector.register(self.fd, selectors.EVENT_READ)
+
+        # Set once the input reaches end of file
+        self.closed = False
+
+        # Terminal settings to restore in close()
+        self.saved_mode = None
+
+        if os.isatty(self.fd):
+            import termios
+            import tty
+
+            self.saved_mode = termios.tcgetattr(self.fd)
+            tty.setcbreak(self.fd)
+
+    def close(self):
+        if self.saved_mode is not None:
+            import termios
+
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved_mode)
+            self.saved_mode = None
+
+        self.selector.close()
+
+    def fileno(self):
+        """
+        Get the file descriptor keys are read from
+        """
+        return self.fd
+
+    def read(self, timeout):
+        """
+        Queue any input that arrives within timeout seconds. A timeout of 0
+        never blocks, and None waits until there is input
+        """
+        if self.closed:
+            return
+
+        for _ in self.selector.select(timeout):
+            data = os.read(self.fd, 1024)
+
+            if data == b"":
+                self.closed = True
+                self.selector.unregister(self.fd)
+            else:
+                self.queue.extend(data)
+
+    def poll(self, cpu):
+        self.read(0)
+        self.deliver(cpu)
+
+        return KEYBOARD_POLL_CYCLES
+
+    def wait(self, seconds):
+        """
+        Block for up to the given number of seconds (forever if None) until a
+        key is pressed
+        """
+        if self.closed:
+            # No more keys will ever arrive, so just sleep
+            if seconds is None:
+                seconds = KEYBOARD_CLOSED_SLEEP
+
+            time.sleep(seconds)
+            return
+
+        self.read(seconds)
+
+
+class ScriptedKeyboard(InputDevice):
+    """
+    Types the given keys (a string or bytes), one every cycles_per_key cycles.
+    Useful for tests, since it doesn't depend on the wall clock.
+    """
+
+    def __init__(self, keys, cycles_per_key=1000):
+        super().__init__()
+
+        if isinstance(keys, str):
+            keys = keys.encode()
+
+        self.keys = collections.deque(keys)
+        self.cycles_per_key = cycles_per_key
+        self.next_key = None
+
+    def snapshot(self, cpu):
+        """
+        Save the keys still to be typed and delivered, and when the next one
+        is due
+        """
+        if self.next_key is None:
+            remaining = -1
+        else:
+            remaining = self.next_key - cpu.cycles
+
+        return (struct.pack("<qH", remaining, len(self.queue)) +
+                bytes(self.queue) + bytes(self.keys))
+
+    def restore(self, cpu, state):
+        remaining, queued = struct.unpack_from("<qH", state)
+        offset = struct.calcsize("<qH")
+
+        self.next_key = None if remaining < 0 else cpu.cycles + remaining
+        self.queue = collections.deque(state[offset:offset + queued])
+        self.keys = collections.deque(state[offset + queued:])
+
+    def poll(self, cpu):
+        if self.next_key is None:
+            self.next_key = cpu.cycles + self.cycles_per_key
+
+        if cpu.cycles >= self.next_key and self.keys:
+            self.queue.append(self.keys.popleft())
+            self.next_key = cpu.cycles + self.cycles_per_key
+
+        self.deliver(cpu)
+
+        if not self.keys and not self.queue:
+            return None
+
+        return max(1, self.next_key - cpu.cycles)
@@ -0,0 +1,245 @@
+"""Binary LS-8 images (.ls8b files).
+
+An image is a fixed-size header, followed by the raw program bytes, followed
+by an optional symbol table and an optional table of data regions. All
+multi-byte values are little-endian.
+
+Header (12 bytes):
+
+    magic         4 bytes   b"LS8B"
+    version       1 byte    1
+    load address  1 byte    where in RAM the program bytes go
+    entry point   1 byte    initial value of the PC
+    flags         1 byte    bit 0 set if there's a data region table
+    code length   2 bytes   number of program bytes, at most 256
+    symbol count  2 bytes   number of symbol table entries
+
+Each symbol table entry is the symbol's address (1 byte), the length of its
+name (1 byte) and the name itself, in ASCII.
+
+The data region table marks the bytes the assembler emitted with DS or DB,
+so tools can tell data from code. It's a count (2 bytes), then each region's
+start address (1 byte) and length (2 bytes). Readers that don't know about it
+stop after the symbol table.
+
+Text .ls8 files are converted to images once and cached next to the source
+as .<name>.ls8b, so later loads skip parsing the text.
+"""
+
+import collections
+import io
+import os
+import struct
+
+MAGIC = b"LS8B"
+VERSION = 1
+
+HEADER = struct.Struct("<4sBBBBHH")
+REGION = struct.Struct("<BH")
+
+# Header flags
+FLAG_DATA = 0b1
+
+# A decoded image. data is a tuple of (start, length) data regions
+Image = collections.namedtuple("Image",
+                               ["load_address", "entry", "code", "symbols", "data"],
+                               defaults=((),))
+
+
+def write_image(file, code, load_address=0, entry=0, symbols=None, data=()):
+    """
+    Write an image to a file opened in binary mode
+    """
+    if symbols is None:
+        symbols = {}
+
+    if load_address + len(code) > 256:
+        raise ValueError("Program does not fit in memory")
+
+    flags = FLAG_DATA if data else 0
+
+    file.write(HEADER.pack(MAGIC, VERSION, load_address, entry, flags,
+                           len(code), len(symbols)))
+    file.write(bytes(code))
+
+    for name, address in symbols.items():
+        encoded = name.encode("ascii")
+        file.write(bytes([address & 0xFF, len(encoded)]))
+        file.write(encoded)
+
+    if data:
+        file.write(struct.pack("<H", len(data)))
+
+        for start, length in data:
+            file.write(REGION.pack(start, length))
+
+
+def read_exactly(file, size):
+    """
+    Read size bytes, raising ValueError if the image ends first
+    """
+    data = file.read(size)
+
+    if len(data) != size:
+        raise ValueError("Truncated LS-8 image")
+
+    return data
+
+
+def read_header(file):
+    """
+    Read and check an image header, returning its fields
+    """
+    header = read_exactly(file, HEADER.size)
+
+    magic, version, load_address, entry, flags, length, symbol_count = \
+        HEADER.unpack(header)
+
+    if magic != MAGIC:
+        raise ValueError("Not an LS-8 image")
+
+    if version != VERSION:
+        raise ValueError("Unsupported LS-8 image version %d" % version)
+
+    if load_address + length > 256:
+        raise ValueError("Program does not fit in memory")
+
+    return load_address, entry, flags, length, symbol_count
+
+
+def read_symbols(file, symbol_count):
+    """
+    Read the symbol table that follows the program bytes
+    """
+    symbols = {}
+
+    for _ in range(symbol_count):
+        address, length = read_exactly(file, 2)
+
+        try:
+            name = read_exactly(file, length).decode("ascii")
+        except UnicodeDecodeError:
+            raise ValueError("Symbol name in LS-8 image isn't ASCII")
+
+        symbols[name] = address
+
+    return symbols
+
+
+def read_data(file, flags):
+    """
+    Read the data region table that follows the symbol table, if there is one
+    """
+    if not flags & FLAG_DATA:
+        return ()
+
+    (count,) = struct.unpack("<H", read_exactly(file, 2))
+
+    return tuple(REGION.unpack(read_exactly(file, REGION.size))
+                 for _ in range(count))
+
+
+def read_image(path):
+    """
+    Read a whole image into memory
+    """
+    with open(path, "rb") as file:
+        load_address, entry, flags, length, symbol_count = read_header(file)
+        code = read_exactly(file, length)
+        symbols = read_symbols(file, symbol_count)
+        data = read_data(file, flags)
+
+    return Image(load_address, entry, code, symbols, data)
+
+
+def encode_image(code, load_address=0, entry=0, symbols=None, data=()):
+    """
+    Build an image in memory, returning its bytes
+    """
+    file = io.BytesIO()
+    write_image(file, code, load_address, entry, symbols, data)
+
+    return file.getvalue()
+
+
+def decode_image(data):
+    """
+    Decode an image from bytes
+    """
+    file = io.BytesIO(data)
+
+    load_address, entry, flags, length, symbol_count = read_header(file)
+    code = read_exactly(file, length)
+    symbols = read_symbols(file, symbol_count)
+    data = read_data(file, flags)
+
+    return Image(load_address, entry, code, symbols, data)
+
+
+def load_image(cpu, path):
+    """
+    Load an image straight into a CPU's memory, returning the image with
+    code set to a view of the bytes in RAM
+    """
+    with open(path, "rb") as file:
+        load_address, entry, flags, length, symbol_count = read_header(file)
+
+        # Read the program bytes directly into RAM, without copying
+        code = cpu.memory[load_address:load_address + length]
+
+        if file.readinto(code) != length:
+            raise ValueError("Truncated LS-8 image")
+
+        symbols = read_symbols(file, symbol_count)
+        data = read_data(file, flags)
+
+    return Image(load_address, entry, code, symbols, data)
+
+
+def cache_path(path):
+    """
+    Get the path of the cached image for a text .ls8 file
+    """
+    directory, name = os.path.split(path)
+
+    return os.path.join(directory, "." + name + "b")
+
+
+def cached_image(path):
+    """
+    Get the path of an up to date image for a text .ls8 file, or None if
+    there isn't one
+    """
+    cached = cache_path(path)
+
+    try:
+        if os.stat(cached).st_mtime_ns >= os.stat(path).st_mtime_ns:
+            return cached
+    except FileNotFoundError:
+        pass
+
+    return None
+
+
+def save_cache(path, code):
+    """
+    Cache the parsed bytes of a text .ls8 file as an image next to it
+    """
+    cached = cache_path(path)
+
+    # Write to a temporary file first, so another process never sees half
+    # an image
+    temporary = "%s.%d" % (cached, os.getpid())
+
+    try:
+        with open(temporary, "wb") as file:
+            write_image(file, code)
+
+        os.replace(temporary, cached)
+
+    except OSError:
+        # Caching is only an optimization, e.g. the directory may be read-only
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
@@ -2,10 +2,198 @@
 
 """Main."""
 
+import argparse
+import os
 import sys
 from cpu import *
+from devices import Keyboard, OutputBuffer, Timer
 
-cpu = CPU()
 
-cpu.load()
-cpu.run()
\ No newline at end of file
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(
+        prog="ls8.py",
+        description="Run an LS-8 program.",
+        epilog="ls8.py run program is the same as ls8.py program. "
+               "Other commands: ls8.py batch [options] paths..., "
+               "ls8.py trace [options] tracefile, "
+               "ls8.py debug [options] program, "
+               "ls8.py disasm [options] program, "
+               "ls8.py serve [options], "
+               "ls8.py submit [options] programs...",
+    )
+    parser.add_argument("program", nargs="?", default=None,
+                        help=".ls8, .ls8b or .asm file to run. .asm files "
+                             "are assembled straight into memory")
+    parser.add_argument("--profile", metavar="FILE", default=None,
+                        help="profile the run, print a report to stderr and "
+                             "write collapsed call stacks to FILE")
+    parser.add_argument("--trace", metavar="FILE", default=None,
+                        help="record the last instructions executed in FILE, "
+                             "to read with ls8.py trace")
+    parser.add_argument("--trace-size", metavar="N", type=int, default=None,
+                        help="number of instructions to keep in the trace")
+
+    parser.add_argument("--resume", metavar="FILE", default=None,
+                        help="resume from a snapshot instead of loading a "
+                             "program")
+    parser.add_argument("--snapshot", metavar="FILE", default=None,
+                        help="save a snapshot to FILE when the run stops")
+    parser.add_argument("--checkpoint-every", metavar="N", type=int,
+                        default=None,
+                        help="also save the snapshot every N instructions")
+    args = parser.parse_args(argv)
+
+    if (args.program is None) == (args.resume is None):
+        parser.error("give either a program or --resume")
+
+    if args.checkpoint_every is not None and args.snapshot is None:
+        parser.error("--checkpoint-every needs --snapshot")
+
+    if args.checkpoint_every is not None and args.checkpoint_every <= 0:
+        parser.error("--checkpoint-every must be positive")
+
+    if args.trace_size is not None and args.trace_size <= 0:
+        parser.error("--trace-size must be positive")
+
+    if args.profile is not None and args.trace is not None:
+        parser.error("--profile and --trace can't be used together")
+
+    return args
+
+
+def save_snapshot(cpu, path):
+    """
+    Save a snapshot of the CPU, replacing the file in one step so a crash
+    never leaves half a snapshot behind
+    """
+    temporary = path + ".tmp"
+
+    with open(temporary, "wb") as file:
+        file.write(cpu.snapshot())
+
+    os.replace(temporary, path)
+
+
+def run_program(cpu, args, argv):
+    """
+    Load the program or snapshot given on the command line into the CPU and
+    run it, profiling, tracing and saving snapshots as asked. Returns the
+    RunResult, or None if there was nothing to load
+    """
+    try:
+        if args.resume is None:
+            cpu.load(args.program)
+        else:
+            with open(args.resume, "rb") as file:
+                cpu.restore(file.read())
+    except FileNotFoundError as e:
+        print(f'{argv[0]}: {e.filename} not found')
+        return None
+
+    profiler = None
+    recorder = None
+
+    if args.profile is not None:
+        import profiler as profiling
+        profiler = profiling.Profiler(cpu)
+
+    if args.trace is not None:
+        import tracer
+
+        if args.trace_size is None:
+            recorder = tracer.TraceRecorder(cpu, path=args.trace)
+        else:
+            recorder = tracer.TraceRecorder(cpu, args.trace_size, args.trace)
+
+    if profiler is not None:
+        run = profiler.run
+    elif recorder is not None:
+        run = recorder.run
+    else:
+        run = cpu.run
+
+    try:
+        if args.checkpoint_every is None:
+            return run()
+
+        # Save a snapshot after every slice until the program stops
+        result = run(args.checkpoint_every)
+
+        while result.halt_reason == "max_cycles":
+            save_snapshot(cpu, args.snapshot)
+            result = run(args.checkpoint_every)
+
+        return result
+    finally:
+        if args.snapshot is not None:
+            save_snapshot(cpu, args.snapshot)
+
+        if profiler is not None:
+            profiler.report(sys.stderr)
+            profiler.write_collapsed(args.profile)
+
+        if recorder is not None:
+            recorder.close()
+
+
+def main(argv):
+    # Subcommands
+    if len(argv) >= 2 and argv[1] == "batch":
+        import batch
+        return batch.main(argv[2:])
+
+    if len(argv) >= 2 and argv[1] == "trace":
+        import tracer
+        return tracer.main(argv[2:])
+
+    if len(argv) >= 2 and argv[1] == "debug":
+        import debugger
+        return debugger.main(argv[2:])
+
+    if len(argv) >= 2 and argv[1] == "disasm":
+        import analysis
+        return analysis.main(argv[2:])
+
+    if len(argv) >= 2 and argv[1] == "serve":
+        import server
+        return server.main(argv[2:])
+
+    if len(argv) >= 2 and argv[1] == "submit":
+        import server
+        return server.client_main(argv[2:])
+
+    # Running a program is the default
+    if len(argv) >= 2 and argv[1] == "run":
+        argv = argv[:1] + argv[2:]
+
+    args = parse_commandline(argv[1:])
+
+    # Print to the console rather than capturing output
+    cpu = CPU(output=OutputBuffer(sys.stdout.buffer))
+
+    # The timer ticks once per second on the wall clock, and keys come from
+    # stdin
+    keyboard = Keyboard()
+    cpu.devices.append(Timer(mode="real"))
+    cpu.devices.append(keyboard)
+
+    # The keyboard may have put the terminal in cbreak mode, so put it back
+    # however the run ends, even if the program can't be loaded
+    try:
+        result = run_program(cpu, args, argv)
+    finally:
+        keyboard.close()
+
+    if result is None:
+        return 1
+
+    # The CPU only reports errors, e.g. division by zero, as its halt reason
+    if result.halt_reason != "HLT":
+        print(f"Error: {result.halt_reason}", file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,225 @@
+"""Profiler for LS-8 programs.
+
+Counts the instructions executed per opcode, per PC and per basic block, the
+CALL/RET call graph, and the cycles spent in each subroutine. It runs the CPU
+with its own instrumented copy of CPU.execute(), so a CPU that isn't being
+profiled pays nothing for it.
+
+Usage:
+
+    cpu = CPU()
+    cpu.load("examples/call.ls8")
+    profiler = Profiler(cpu)
+    profiler.run()
+    profiler.report(sys.stderr)
+    profiler.write_collapsed("call.folded")
+
+The collapsed stack file has one line per call stack, e.g. "main;MULT2PRINT 6",
+which flamegraph tools read directly.
+
+Cycles the CPU skips while idle in a spin loop (see CPU.idle()) are never
+executed, so they aren't counted.
+"""
+
+import collections
+
+# How many entries of each table report() shows
+REPORT_ROWS = 10
+
+
+class Profiler:
+    """Execution engine that runs a CPU and counts what it does."""
+
+    def __init__(self, cpu):
+        """Construct a profiler for the program loaded into the given CPU."""
+        self.cpu = cpu
+
+        # Map opcodes back to their names
+        self.names = {code: name for name, code in cpu.opcodes.items()}
+
+        # Instructions executed per opcode, per PC and per basic block start
+        self.opcodes = collections.Counter()
+        self.pcs = collections.Counter()
+        self.blocks = collections.Counter()
+
+        # Times each (caller, callee) edge was taken
+        self.edges = collections.Counter()
+
+        # Instructions executed with each call stack, as a tuple of subroutine
+        # addresses. The bottom of the stack is None, for the main program
+        self.stacks = collections.Counter()
+
+        # The current call stack
+        self.frames = [None]
+
+        # Where the PC should be when execute() is next called. If it's
+        # somewhere else, an interrupt handler was called in between
+        self.next_pc = None
+
+        # The next instruction starts a basic block
+        self.new_block = True
+
+    def run(self, max_cycles=None):
+        """
+        Run the CPU until it halts, or until it has executed max_cycles
+        instructions. Returns a RunResult, just like CPU.run().
+        """
+        return self.cpu.run(max_cycles, self.execute)
+
+    def execute(self, max_cycles=None):
+        """
+        Instrumented copy of CPU.execute()
+        """
+        cpu = self.cpu
+        decode_cache = cpu.decode_cache
+
+        opcodes = self.opcodes
+        pcs = self.pcs
+        blocks = self.blocks
+        stacks = self.stacks
+        frames = self.frames
+
+        call = cpu.opcodes['CALL']
+        ret = cpu.opcodes['RET']
+        iret = cpu.opcodes['IRET']
+
+        # An interrupt handler was called since the last slice
+        if self.next_pc is not None and cpu.pc != self.next_pc:
+            self.edges[(frames[-1], cpu.pc)] += 1
+            frames.append(cpu.pc)
+            self.new_block = True
+
+        stack = tuple(frames)
+        new_block = self.new_block
+        cycles = 0
+
+        try:
+            while cpu.running:
+                if cycles == max_cycles:
+                    break
+
+                pc = cpu.pc
+
+                # Look up the decoded instruction at the PC, decoding it on a
+                # miss
+                entry = decode_cache.get(pc)
+
+                if entry is None:
+                    entry = cpu.decode(pc)
+
+                instruction, handler, operand_a, operand_b, pc_advance = entry
+
+                opcodes[instruction] += 1
+                pcs[pc] += 1
+                stacks[stack] += 1
+
+                if new_block:
+                    blocks[pc] += 1
+
+                cpu.ir = instruction
+
+                handler(operand_a, operand_b)
+
+                cpu.pc += pc_advance
+                cycles += 1
+
+                # Anything that can set the PC ends a basic block
+                new_block = pc_advance == 0
+
+                if instruction == call:
+                    self.edges[(frames[-1], cpu.pc)] += 1
+                    frames.append(cpu.pc)
+                    stack = tuple(frames)
+
+                elif (instruction == ret or instruction == iret) and \
+                        len(frames) > 1:
+                    frames.pop()
+                    stack = tuple(frames)
+        except BaseException:
+            # run() only counts slices that return, so count the
+            # instructions that ran before the one that raised
+            cpu.cycles += cycles
+            raise
+
+        self.new_block = new_block
+        self.next_pc = cpu.pc
+
+        return cycles
+
+    def name(self, address):
+        """
+        Get a name for a subroutine: its label if there is one, else its
+        address
+        """
+        if address is None:
+            return "main"
+
+        for label, label_address in self.cpu.symbols.items():
+            if label_address == address:
+                return label
+
+        return "sub_%02X" % address
+
+    def subroutine_cycles(self):
+        """
+        Get the (self, total) instructions executed in each subroutine
+        """
+        own = collections.Counter()
+        total = collections.Counter()
+
+        for stack, cycles in self.stacks.items():
+            own[stack[-1]] += cycles
+
+            # Recursive calls only count once towards the total
+            for address in set(stack):
+                total[address] += cycles
+
+        return own, total
+
+    def report(self, file):
+        """
+        Write a human readable summary of the profile
+        """
+        executed = sum(self.opcodes.values())
+
+        def percent(count):
+            return 100 * count / executed if executed else 0
+
+        print("Instructions executed: %d" % executed, file=file)
+
+        print("\nBy opcode:", file=file)
+        for opcode, count in self.opcodes.most_common(REPORT_ROWS):
+            name = self.names.get(opcode, "%02X" % opcode)
+            print("  %-6s %10d %6.2f%%" % (name, count, percent(count)),
+                  file=file)
+
+        print("\nHottest instructions:", file=file)
+        for pc, count in self.pcs.most_common(REPORT_ROWS):
+            name = self.names.get(self.cpu.ram[pc], "??")
+            print("  %02X %-6s %10d %6.2f%%" % (pc, name, count, percent(count)),
+                  file=file)
+
+        print("\nHottest basic blocks (times entered):", file=file)
+        for pc, count in self.blocks.most_common(REPORT_ROWS):
+            print("  %02X %10d" % (pc, count), file=file)
+
+        print("\nCalls:", file=file)
+        for (caller, callee), count in self.edges.most_common(REPORT_ROWS):
+            print("  %s -> %s %d" % (self.name(caller), self.name(callee), count),
+                  file=file)
+
+        own, total = self.subroutine_cycles()
+
+        print("\nSubroutines (self, total instructions):", file=file)
+        for address, count in total.most_common(REPORT_ROWS):
+            print("  %-16s %10d %10d" % (self.name(address), own[address], count),
+                  file=file)
+
+    def write_collapsed(self, path):
+        """
+        Write the call stacks in the collapsed format used by flamegraph tools
+        """
+        with open(path, "w") as file:
+            for stack, cycles in sorted(self.stacks.items(), key=str):
+                names = ";".join(self.name(address) for address in stack)
+                file.write("%s %d\n" % (names, cycles))
@@ -0,0 +1,393 @@
+"""Cooperative scheduler that runs many LS-8 CPUs in one process.
+
+Usage:
+
+    scheduler = Scheduler()
+
+    for path in paths:
+        cpu = CPU()
+        cpu.load(path)
+        scheduler.add(cpu, name=path)
+
+    for job in scheduler.run():
+        print(job.name, job.result.halt_reason, job.cycles)
+
+Jobs take turns in round robin order. Each turn runs a job until it has
+executed a quantum of instructions, halts, or goes idle waiting for input or
+the wall clock. A job that's waiting is set aside until one of its devices
+can wake it: a keyboard has input (anything with fileno()), or a real time
+timer is due to tick. While every job is waiting, the scheduler sleeps.
+
+run_async() does the same on an asyncio event loop, so the jobs can share a
+process with other coroutines. Waiting jobs are woken by loop readers, and
+cost nothing while they wait.
+"""
+
+import collections
+import heapq
+import itertools
+import selectors
+import time
+
+from cpu import RunResult
+
+# Instructions a job runs per turn
+DEFAULT_QUANTUM = 10000
+
+
+class Job:
+    """A CPU run by the scheduler, and what it has used so far."""
+
+    def __init__(self, cpu, name=None, execute=None, max_cycles=None,
+                 timeout=None):
+        self.cpu = cpu
+        self.name = name
+
+        # Engine execute() to run the CPU with, or None for the interpreter
+        self.execute = execute
+
+        # Stop the job after this many cycles, counting those skipped while
+        # idle, or this many seconds spent running it
+        self.max_cycles = max_cycles
+        self.timeout = timeout
+
+        # Instructions executed, cycles skipped while idle, turns taken and
+        # time spent running
+        self.cycles = 0
+        self.idle_cycles = 0
+        self.slices = 0
+        self.seconds = 0.0
+
+        # RunResult for the whole job once it has finished, and the error
+        # message if it stopped with one
+        self.result = None
+        self.error = None
+
+        # Set while the job is waiting for one of its devices, along with the
+        # file descriptors that can wake it
+        self.waiting = False
+        self.fds = []
+
+    def __repr__(self):
+        return "Job(%r, cycles=%d)" % (self.name, self.cycles)
+
+
+class Scheduler:
+    """Time slices many CPUs, running each for a quantum of cycles in turn."""
+
+    def __init__(self, quantum=DEFAULT_QUANTUM, clock=time.monotonic):
+        self.quantum = quantum
+        self.clock = clock
+
+        # Jobs ready to run, in the order they'll get their turns
+        self.ready = collections.deque()
+
+        # Jobs waiting for input or the wall clock
+        self.waiting = set()
+
+        # When waiting jobs are due to wake: a heap of (time, count, job).
+        # Entries are left behind when a job is woken some other way, and
+        # ignored when they come up
+        self.deadlines = []
+        self.counter = itertools.count()
+
+        # Waiting jobs by the file descriptor that can wake them
+        self.readers = {}
+
+        # Jobs that have finished, in the order they finished
+        self.finished = []
+
+        # Selector for run(), or event loop for run_async(), that watches the
+        # file descriptors in readers
+        self.selector = None
+        self.loop = None
+
+        # Future run_async() waits on while every job is waiting
+        self.wakeup = None
+
+    def add(self, cpu, name=None, execute=None, max_cycles=None,
+            timeout=None):
+        """
+        Add a CPU to be run, and return its Job. execute is the execute()
+        method of an engine to run it with, e.g. BlockCompiler(cpu).execute
+        """
+        job = Job(cpu, name, execute, max_cycles, timeout)
+        self.ready.append(job)
+
+        return job
+
+    def run_slice(self, job):
+        """
+        Give a job its turn, and put it wherever it belongs afterwards
+        """
+        quantum = self.quantum
+
+        if job.max_cycles is not None:
+            quantum = min(quantum,
+                          job.max_cycles - job.cycles - job.idle_cycles)
+
+        start = time.perf_counter()
+        start_cycles = job.cpu.cycles
+        start_idle_cycles = job.cpu.idle_cycles
+
+        try:
+            result = job.cpu.run(quantum, job.execute, block=False)
+            halt_reason = result.halt_reason
+        except Exception as e:
+            halt_reason = "error"
+            job.error = str(e)
+
+        # Counted from the CPU, so a slice that raises still counts what ran
+        idle_cycles = job.cpu.idle_cycles - start_idle_cycles
+
+        job.cycles += job.cpu.cycles - start_cycles - idle_cycles
+        job.idle_cycles += idle_cycles
+        job.seconds += time.perf_counter() - start
+        job.slices += 1
+
+        if halt_reason in ("max_cycles", "blocked") and \
+                job.timeout is not None and job.seconds > job.timeout:
+            self.finish(job, "timeout")
+
+        elif halt_reason == "max_cycles":
+            if job.max_cycles is not None and \
+                    job.cycles + job.idle_cycles >= job.max_cycles:
+                self.finish(job, halt_reason)
+            else:
+                self.ready.append(job)
+
+        elif halt_reason == "blocked":
+            self.park(job)
+
+        else:
+            self.finish(job, halt_reason)
+
+    def finish(self, job, halt_reason):
+        """
+        Record a job's result and retire it
+        """
+        job.result = RunResult(halt_reason, job.cycles,
+                               job.cpu.output.getvalue(), job.idle_cycles)
+        self.finished.append(job)
+
+    def park(self, job):
+        """
+        Set a job aside until one of its devices can wake it
+        """
+        cpu = job.cpu
+
+        job.waiting = True
+        self.waiting.add(job)
+
+        seconds = None
+        wake_now = False
+
+        for device in cpu.devices:
+            seconds_until_event = getattr(device, "seconds_until_event", None)
+
+            if seconds_until_event is not None:
+                timeout = seconds_until_event(cpu)
+
+                if timeout is not None and (seconds is None or timeout < seconds):
+                    seconds = timeout
+
+            fileno = getattr(device, "fileno", None)
+
+            if fileno is not None and not getattr(device, "closed", False):
+                if not self.add_reader(fileno(), job):
+                    wake_now = True
+
+        if seconds is not None:
+            heapq.heappush(self.deadlines,
+                           (self.clock() + seconds, next(self.counter), job))
+
+        if wake_now:
+            self.wake(job)
+
+    def add_reader(self, fd, job):
+        """
+        Wake a job when fd has input. Returns False if fd can't be watched
+        """
+        jobs = self.readers.get(fd)
+
+        if jobs is None:
+            try:
+                self.watch(fd)
+            except PermissionError:
+                # epoll refuses regular files, which always have input (or are
+                # at end of file) anyway
+                return False
+
+            jobs = self.readers[fd] = set()
+
+        jobs.add(job)
+        job.fds.append(fd)
+
+        return True
+
+    def watch(self, fd):
+        if self.loop is not None:
+            self.loop.add_reader(fd, self.readable, fd)
+        else:
+            self.selector.register(fd, selectors.EVENT_READ)
+
+    def unwatch(self, fd):
+        if self.loop is not None:
+            self.loop.remove_reader(fd)
+        else:
+            self.selector.unregister(fd)
+
+    def wake(self, job):
+        """
+        Move a waiting job back to the ready queue
+        """
+        if not job.waiting:
+            return
+
+        job.waiting = False
+        self.waiting.discard(job)
+
+        for fd in job.fds:
+            jobs = self.readers[fd]
+            jobs.discard(job)
+
+            if not jobs:
+                del self.readers[fd]
+                self.unwatch(fd)
+
+        job.fds = []
+        self.ready.append(job)
+
+    def readable(self, fd):
+        """
+        Wake every job waiting for input from fd
+        """
+        for job in list(self.readers.get(fd, ())):
+            self.wake(job)
+
+        if self.wakeup is not None and not self.wakeup.done():
+            self.wakeup.set_result(None)
+
+    def wake_expired(self):
+        """
+        Wake every job whose deadline has passed
+        """
+        deadlines = self.deadlines
+        now = self.clock()
+
+        while deadlines and deadlines[0][0] <= now:
+            _, _, job = heapq.heappop(deadlines)
+            self.wake(job)
+
+    def next_timeout(self):
+        """
+        Seconds until the next deadline, or None if there isn't one
+        """
+        deadlines = self.deadlines
+
+        # Drop deadlines for jobs that have already been woken
+        while deadlines and not deadlines[0][2].waiting:
+            heapq.heappop(deadlines)
+
+        if not deadlines:
+            return None
+
+        return max(0, deadlines[0][0] - self.clock())
+
+    def stuck(self):
+        """
+        Check if nothing can ever wake the waiting jobs
+        """
+        return not self.ready and not self.readers and \
+            self.next_timeout() is None
+
+    def finish_waiting(self):
+        """
+        Retire the jobs nothing can wake, e.g. ones waiting for input after it
+        ended, and return every finished job
+        """
+        for job in list(self.waiting):
+            job.waiting = False
+            self.finish(job, "blocked")
+
+        self.waiting.clear()
+
+        return self.finished
+
+    def run(self):
+        """
+        Run every job until it finishes, sleeping while they're all waiting.
+        Returns the finished jobs, in the order they finished. Jobs that
+        nothing can ever wake finish with a halt_reason of "blocked"
+        """
+        self.selector = selectors.DefaultSelector()
+
+        try:
+            while self.ready or self.waiting:
+                if self.stuck():
+                    break
+
+                if self.ready:
+                    # Give every ready job a turn, then check on the waiting
+                    # ones without blocking
+                    for _ in range(len(self.ready)):
+                        self.run_slice(self.ready.popleft())
+
+                    timeout = 0
+                else:
+                    timeout = self.next_timeout()
+
+                if self.readers:
+                    for key, _ in self.selector.select(timeout):
+                        self.readable(key.fd)
+                elif timeout:
+                    time.sleep(timeout)
+
+                self.wake_expired()
+        finally:
+            for fd in list(self.readers):
+                self.unwatch(fd)
+
+            self.readers.clear()
+            self.selector.close()
+            self.selector = None
+
+        return self.finish_waiting()
+
+    async def run_async(self):
+        """
+        Run every job on the running event loop until it finishes, yielding
+        to other tasks between turns. Returns the finished jobs, just like
+        run()
+        """
+        # Only imported here, since it's slow to import and run() doesn't
+        # need it
+        import asyncio
+
+        self.loop = asyncio.get_running_loop()
+
+        try:
+            while self.ready or self.waiting:
+                if self.stuck():
+                    break
+
+                if self.ready:
+                    self.run_slice(self.ready.popleft())
+
+                    # Let other tasks and the readers run
+                    await asyncio.sleep(0)
+                else:
+                    self.wakeup = self.loop.create_future()
+                    await asyncio.wait([self.wakeup],
+                                       timeout=self.next_timeout())
+                    self.wakeup = None
+
+                self.wake_expired()
+        finally:
+            for fd in list(self.readers):
+                self.unwatch(fd)
+
+            self.readers.clear()
+            self.loop = None
+
+        return self.finish_waiting()
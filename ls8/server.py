@@ -0,0 +1,472 @@
+"""Warm worker server for running LS-8 programs, and its client.
+
+Usage: ls8.py serve [--socket PATH] [--workers N]
+       ls8.py submit [--socket PATH] [options] program [program ...]
+
+The server starts a pool of worker processes that all accept connections on
+one Unix domain socket. Each worker keeps a CPU that has already been through
+__init__(), and forks it for every program it runs, so a submission costs a
+connect and a fork rather than starting the interpreter and building a CPU.
+
+Protocol. Every message is a frame: a kind (1 byte) and a payload length (4
+bytes, little-endian), followed by the payload.
+
+    RUN     client -> server   RUN_HEADER, then the keys to type, then an .ls8b
+                               image of the program
+    OUTPUT  server -> client   output the program has printed so far
+    RESULT  server -> client   how the run went, as a JSON object like a batch
+                               record (without the output, which has been sent)
+
+RUN_HEADER is max_cycles (8 bytes), timeout in seconds (a double), timer
+cycles per second (8 bytes) and the length of the keys (4 bytes). Negative
+values mean no limit, or the default. The server never runs a program for
+longer than its own limits (see ls8.py serve --help), whatever the client
+asks for. A connection can carry any number of runs, one after the other.
+"""
+
+import argparse
+import errno
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import tempfile
+
+import image
+from batch import DEFAULT_MAX_CYCLES, DEFAULT_TIMEOUT, limit, run_cpu
+from cpu import CPU, read_program
+from devices import OutputBuffer, ScriptedKeyboard, Timer
+
+# Frame kinds
+RUN = 1
+OUTPUT = 2
+RESULT = 3
+
+FRAME = struct.Struct("<BI")
+RUN_HEADER = struct.Struct("<qdqI")
+
+# Largest payload either side accepts
+MAX_PAYLOAD = 1 << 20
+
+# Connections waiting to be accepted before new ones are refused
+BACKLOG = 128
+
+
+def default_socket_path():
+    return os.environ.get("LS8_SOCKET") or os.path.join(
+        tempfile.gettempdir(), "ls8-%d.sock" % os.getuid())
+
+
+def receive_exactly(connection, size):
+    """
+    Receive exactly size bytes, or None if the connection closes first
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+
+    while received < size:
+        count = connection.recv_into(view[received:])
+
+        if count == 0:
+            return None
+
+        received += count
+
+    return bytes(data)
+
+
+def receive_frame(connection):
+    """
+    Receive a frame, returning (kind, payload), or None if the connection was
+    closed between frames
+    """
+    header = receive_exactly(connection, FRAME.size)
+
+    if header is None:
+        return None
+
+    kind, length = FRAME.unpack(header)
+
+    if length > MAX_PAYLOAD:
+        raise ValueError("Frame too large: %d bytes" % length)
+
+    payload = receive_exactly(connection, length)
+
+    if payload is None:
+        raise ValueError("Connection closed in the middle of a frame")
+
+    return kind, payload
+
+
+def send_frame(connection, kind, payload):
+    connection.sendall(FRAME.pack(kind, len(payload)) + payload)
+
+
+class FrameWriter:
+    """
+    Output sink that sends everything written to it as OUTPUT frames
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def write(self, data):
+        send_frame(self.connection, OUTPUT, bytes(data))
+
+    def flush(self):
+        pass
+
+
+def encode_run(program, max_cycles=None, timeout=None, cycles_per_second=None,
+               keys=b""):
+    """
+    Build the payload of a RUN frame for an .ls8b image
+    """
+    header = RUN_HEADER.pack(
+        -1 if max_cycles is None else max_cycles,
+        -1.0 if timeout is None else timeout,
+        -1 if cycles_per_second is None else cycles_per_second,
+        len(keys),
+    )
+
+    return header + keys + program
+
+
+def decode_run(payload):
+    """
+    Split the payload of a RUN frame into its image and limits
+    """
+    if len(payload) < RUN_HEADER.size:
+        raise ValueError("Truncated RUN frame")
+
+    max_cycles, timeout, cycles_per_second, key_count = \
+        RUN_HEADER.unpack_from(payload)
+
+    # -1 stands for the default rate, and nothing else that isn't positive
+    # is a rate the timer could tick at
+    if cycles_per_second == 0 or cycles_per_second < -1:
+        raise ValueError("cycles_per_second must be positive, not %d"
+                         % cycles_per_second)
+
+    offset = RUN_HEADER.size
+    keys = payload[offset:offset + key_count]
+    program = image.decode_image(payload[offset + key_count:])
+
+    return {
+        "program": program,
+        "max_cycles": None if max_cycles < 0 else max_cycles,
+        "timeout": None if timeout < 0 else timeout,
+        "cycles_per_second": None if cycles_per_second < 0 else cycles_per_second,
+        "keys": keys,
+    }
+
+
+def clamp(requested, cap):
+    """
+    Get the limit to use for a run: what the client asked for, but no more
+    than the server's cap. None means no limit
+    """
+    if cap is None:
+        return requested
+
+    if requested is None:
+        return cap
+
+    return min(requested, cap)
+
+
+def handle_run(connection, template, payload, max_cycles=None, timeout=None):
+    """
+    Run the program in a RUN frame on a fork of the template CPU, streaming
+    its output back, and send the result. max_cycles and timeout cap the
+    limits the client asks for
+    """
+    try:
+        run = decode_run(payload)
+    except ValueError as e:
+        record = {"status": "error", "exit_status": 1, "error": str(e)}
+        send_frame(connection, RESULT, json.dumps(record).encode())
+        return
+
+    cpu = template.fork(output=OutputBuffer(FrameWriter(connection)))
+
+    if run["cycles_per_second"] is None:
+        cpu.devices.append(Timer())
+    else:
+        cpu.devices.append(Timer(cycles_per_second=run["cycles_per_second"]))
+
+    if run["keys"]:
+        cpu.devices.append(ScriptedKeyboard(run["keys"]))
+
+    record = run_cpu(cpu, run["program"], {},
+                     clamp(run["max_cycles"], max_cycles),
+                     clamp(run["timeout"], timeout))
+
+    # The output has already been streamed
+    del record["output"]
+
+    send_frame(connection, RESULT, json.dumps(record).encode())
+
+
+def handle_connection(connection, template, max_cycles=None, timeout=None):
+    """
+    Serve runs on a connection until the client closes it
+    """
+    while True:
+        frame = receive_frame(connection)
+
+        if frame is None:
+            return
+
+        kind, payload = frame
+
+        if kind != RUN:
+            raise ValueError("Unexpected frame kind %d" % kind)
+
+        handle_run(connection, template, payload, max_cycles, timeout)
+
+
+def worker(listener, template, max_cycles=None, timeout=None):
+    """
+    Accept connections forever. This runs in a worker process
+    """
+    # The server stops the workers itself when it's interrupted
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    while True:
+        connection, _ = listener.accept()
+
+        with connection:
+            try:
+                handle_connection(connection, template, max_cycles, timeout)
+            except Exception as e:
+                # A client that hangs up or sends garbage only loses its own
+                # connection
+                print(f"ls8 serve: worker {os.getpid()}: {e}", file=sys.stderr)
+
+
+def start_worker(listener, template, max_cycles=None, timeout=None):
+    """
+    Fork a worker process, returning its pid
+    """
+    pid = os.fork()
+
+    if pid == 0:
+        try:
+            worker(listener, template, max_cycles, timeout)
+        finally:
+            os._exit(1)
+
+    return pid
+
+
+def remove_stale_socket(path):
+    """
+    Remove the socket a server that didn't shut down cleanly left behind.
+    Raises OSError if a server is still listening on it, or path isn't a
+    socket
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+
+    if not stat.S_ISSOCK(mode):
+        raise OSError(errno.EEXIST, "%s exists and isn't a socket" % path)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+            return
+
+    raise OSError(errno.EADDRINUSE, "A server is already listening on %s"
+                  % path)
+
+
+def serve(path, workers=None, max_cycles=DEFAULT_MAX_CYCLES,
+          timeout=DEFAULT_TIMEOUT):
+    """
+    Serve runs on a Unix domain socket at path until interrupted, replacing
+    any workers that die. No run goes on for more than max_cycles
+    instructions or timeout seconds (None for no limit)
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    remove_stale_socket(path)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(BACKLOG)
+
+    # Build the CPU the workers fork once, so each of them inherits it ready
+    # to go
+    template = CPU()
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    children = set()
+
+    try:
+        for _ in range(workers):
+            children.add(start_worker(listener, template, max_cycles,
+                                      timeout))
+
+        print(f"ls8 serve: listening on {path} with {workers} workers",
+              file=sys.stderr)
+
+        while True:
+            pid, _ = os.wait()
+            children.discard(pid)
+            children.add(start_worker(listener, template, max_cycles,
+                                      timeout))
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+        listener.close()
+        os.remove(path)
+
+    return 0
+
+
+def program_image(path):
+    """
+    Get an .ls8b image of a program file, as bytes
+    """
+    if path.endswith(".ls8b"):
+        with open(path, "rb") as file:
+            return file.read()
+
+    program = read_program(path)
+
+    return image.encode_image(program.code, program.load_address,
+                              program.entry, program.symbols, program.data)
+
+
+def submit(connection, program, output, max_cycles=None, timeout=None,
+           cycles_per_second=None, keys=b""):
+    """
+    Run an .ls8b image on the server, writing its output to a binary file as
+    it arrives. Returns the result record
+    """
+    send_frame(connection, RUN, encode_run(program, max_cycles, timeout,
+                                           cycles_per_second, keys))
+
+    while True:
+        frame = receive_frame(connection)
+
+        if frame is None:
+            raise ConnectionError("Server closed the connection")
+
+        kind, payload = frame
+
+        if kind == OUTPUT:
+            output.write(payload)
+            output.flush()
+        elif kind == RESULT:
+            return json.loads(payload)
+        else:
+            raise ValueError("Unexpected frame kind %d" % kind)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="ls8.py serve",
+        description="Run LS-8 programs for clients on a pool of warm "
+                    "worker processes.",
+    )
+    parser.add_argument("--socket", default=default_socket_path(),
+                        help="path of the Unix domain socket to listen on "
+                             "(default: %(default)s, or $LS8_SOCKET)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes")
+    parser.add_argument("--max-cycles", type=limit(int),
+                        default=DEFAULT_MAX_CYCLES,
+                        help="most instructions any run can take "
+                             "(default: %(default)s, or none for no limit)")
+    parser.add_argument("--timeout", type=limit(float),
+                        default=DEFAULT_TIMEOUT,
+                        help="most seconds any run can take "
+                             "(default: %(default)s, or none for no limit)")
+    args = parser.parse_args(argv)
+
+    try:
+        return serve(args.socket, args.workers, args.max_cycles, args.timeout)
+    except OSError as e:
+        print(f"ls8 serve: {e}", file=sys.stderr)
+        return 1
+
+
+def client_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="ls8.py submit",
+        description="Run LS-8 programs on an ls8.py serve server.",
+    )
+    parser.add_argument("programs", nargs="+",
+                        help=".ls8, .ls8b or .asm files to run")
+    parser.add_argument("--socket", default=default_socket_path(),
+                        help="path of the server's socket "
+                             "(default: %(default)s, or $LS8_SOCKET)")
+    parser.add_argument("--max-cycles", type=int, default=None,
+                        help="stop each program after this many instructions")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="stop each program after this many seconds")
+    parser.add_argument("--cycles-per-second", type=int, default=None,
+                        help="instructions per timer tick (default: 1000000)")
+    parser.add_argument("--keys", default="",
+                        help="keys to type into each program")
+    parser.add_argument("--results", default=None,
+                        help="file to write a JSON line per program to")
+    args = parser.parse_args(argv)
+
+    results = None if args.results is None else open(args.results, "w")
+    failures = 0
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(args.socket)
+
+            for path in args.programs:
+                try:
+                    program = program_image(path)
+                except (OSError, ValueError) as e:
+                    print(f"ls8.py submit: {path}: {e}", file=sys.stderr)
+                    failures += 1
+                    continue
+
+                record = submit(connection, program, sys.stdout.buffer,
+                                args.max_cycles, args.timeout,
+                                args.cycles_per_second, args.keys.encode())
+
+                if record["exit_status"] != 0:
+                    failures += 1
+                    print(f"ls8.py submit: {path}: {record['status']}"
+                          + (f": {record['error']}" if "error" in record else ""),
+                          file=sys.stderr)
+
+                if results is not None:
+                    results.write(json.dumps({"program": path, **record}) + "\n")
+    finally:
+        if results is not None:
+            results.close()
+
+    return 1 if failures else 0
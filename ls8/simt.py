@@ -0,0 +1,355 @@
+"""Lockstep execution engine for the LS-8, using NumPy.
+
+SIMTEngine runs many copies of one machine, called lanes, side by side. All
+lanes start from the state of the CPU they're made from, and their RAM and
+registers are stored as NumPy arrays, shaped (lanes, 256) and (lanes, 8).
+
+Each step picks the lowest PC that any running lane is at, decodes the
+instruction there once, and applies it to every lane at that PC with one
+NumPy operation. Lanes split up when a JEQ or JNE goes different ways for
+different lanes, and join up again when they reach the same PC. Running the
+lowest PC first makes lanes that took a shorter path wait for the others.
+
+Usage:
+
+    cpu = CPU()
+    cpu.load("examples/mult.ls8")
+    engine = SIMTEngine(cpu, 1000)
+    engine.reg[:, 0] = numpy.arange(1000) % 256
+    results = engine.run()
+
+Devices and interrupts aren't supported, so INT and IRET raise an exception.
+"""
+
+from cpu import RunResult
+from devices import PRA_BYTES, PRN_BYTES
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class SIMTEngine:
+    """Execution engine that runs many copies of a CPU in lockstep."""
+
+    def __init__(self, cpu, lanes):
+        """
+        Construct an engine with the given number of lanes, each starting in
+        the state the given CPU is in
+        """
+        if np is None:
+            raise ImportError("The SIMT engine needs NumPy")
+
+        self.cpu = cpu
+        self.lanes = lanes
+
+        # Every lane starts with the CPU's RAM, registers, PC and flags
+        self.ram = np.tile(np.frombuffer(cpu.ram, dtype=np.uint8), (lanes, 1))
+        self.reg = np.tile(np.frombuffer(cpu.reg, dtype=np.uint8), (lanes, 1))
+        self.pc = np.full(lanes, cpu.pc, dtype=np.int64)
+        self.fl = np.full(lanes, cpu.fl, dtype=np.uint8)
+
+        # Total number of instructions executed by each lane
+        self.cycles = np.full(lanes, cpu.cycles, dtype=np.int64)
+
+        # Lanes that haven't halted, and why the others did
+        self.running = np.full(lanes, cpu.halt_reason is None)
+        self.halt_reasons = [cpu.halt_reason] * lanes
+
+        # What each lane has printed
+        self.outputs = [bytearray() for _ in range(lanes)]
+
+        opcodes = cpu.opcodes
+
+        # Handlers take the array of lane numbers to run the instruction on,
+        # and its operands
+        self.handlers = {
+            opcodes['ADD']: self.handle_add,
+            opcodes['AND']: self.handle_and,
+            opcodes['CALL']: self.handle_call,
+            opcodes['CMP']: self.handle_cmp,
+            opcodes['DEC']: self.handle_dec,
+            opcodes['DIV']: self.handle_div,
+            opcodes['HLT']: self.handle_hlt,
+            opcodes['INC']: self.handle_inc,
+            opcodes['JEQ']: self.handle_jeq,
+            opcodes['JMP']: self.handle_jmp,
+            opcodes['JNE']: self.handle_jne,
+            opcodes['LD']: self.handle_ld,
+            opcodes['LDI']: self.handle_ldi,
+            opcodes['MOD']: self.handle_mod,
+            opcodes['MUL']: self.handle_mul,
+            opcodes['NOT']: self.handle_not,
+            opcodes['OR']: self.handle_or,
+            opcodes['POP']: self.handle_pop,
+            opcodes['PRA']: self.handle_pra,
+            opcodes['PRN']: self.handle_prn,
+            opcodes['PUSH']: self.handle_push,
+            opcodes['RET']: self.handle_ret,
+            opcodes['SHL']: self.handle_shl,
+            opcodes['SHR']: self.handle_shr,
+            opcodes['ST']: self.handle_st,
+            opcodes['SUB']: self.handle_sub,
+            opcodes['XOR']: self.handle_xor,
+        }
+
+    # Register values are uint8 arrays, and uint8 arithmetic wraps around at
+    # 256 just like masking with 0xFF does
+
+    def handle_add(self, lanes, operand_a, operand_b):
+        self.reg[lanes, operand_a] += self.reg[lanes, operand_b]
+
+    def handle_and(self, lanes, operand_a, operand_b):
+        self.reg[lanes, operand_a] &= self.reg[lanes, operand_b]
+
+    def handle_call(self, lanes, operand_a, operand_b):
+        # Push the address of the instruction directly after CALL
+        self.push(lanes, (self.pc[lanes] + 2) & 0xFF)
+
+        # Jump to the address in the register
+        self.pc[lanes] = self.reg[lanes, operand_a]
+
+    def handle_cmp(self, lanes, operand_a, operand_b):
+        value_a = self.reg[lanes, operand_a]
+        value_b = self.reg[lanes, operand_b]
+
+        # FL bits: 00000LGE
+        self.fl[lanes] = ((value_a == value_b) |
+                          (value_a > value_b) << 1 |
+                          (value_a < value_b) << 2)
+
+    def handle_dec(self, lanes, operand_a, operand_b):
+        self.reg[lanes, operand_a] -= 1
+
+    def handle_div(self, lanes, operand_a, operand_b):
+        lanes = self.check_divisor(lanes, operand_b)
+
+        self.reg[lanes, operand_a] //= self.reg[lanes, operand_b]
+
+    def handle_hlt(self, lanes, operand_a, operand_b):
+        self.halt(lanes, "HLT")
+
+    def handle_inc(self, lanes, operand_a, operand_b):
+        self.reg[lanes, operand_a] += 1
+
+    def handle_jeq(self, lanes, operand_a, operand_b):
+        # Lanes with the equal flag set jump, the others go to the next
+        # instruction
+        equal = (self.fl[lanes] & 0b00000001) != 0
+
+        self.pc[lanes] = np.where(equal, self.reg[lanes, operand_a],
+                                  (self.pc[lanes] + 2) & 0xFF)
+
+    def handle_jmp(self, lanes, operand_a, operand_b):
+        self.pc[lanes] = self.reg[lanes, operand_a]
+
+    def handle_jne(self, lanes, operand_a, operand_b):
+        equal = (self.fl[lanes] & 0b00000001) != 0
+
+        self.pc[lanes] = np.where(equal, (self.pc[lanes] + 2) & 0xFF,
+                                  self.reg[lanes, operand_a])
+
+    def handle_ld(self, lanes, operand_a, operand_b):
+        self.reg[lanes, operand_a] = self.ram[lanes, self.reg[lanes, operand_b]]
+
+    def handle_ldi(self, lanes, operand_a, operand_b):
+        self.reg[lanes, operand_a] = operand_b
+
+    def handle_mod(self, lanes, operand_a, operand_b):
+        lanes = self.check_divisor(lanes, operand_b)
+
+        self.reg[lanes, operand_a] %= self.reg[lanes, operand_b]
+
+    def handle_mul(self, lanes, operand_a, operand_b):
+        self.reg[lanes, operand_a] *= self.reg[lanes, operand_b]
+
+    def handle_not(self, lanes, operand_a, operand_b):
+        self.reg[lanes, operand_a] = ~self.reg[lanes, operand_a]
+
+    def handle_or(self, lanes, operand_a, operand_b):
+        self.reg[lanes, operand_a] |= self.reg[lanes, operand_b]
+
+    def handle_pop(self, lanes, operand_a, operand_b):
+        self.reg[lanes, operand_a] = self.pop(lanes)
+
+    def handle_pra(self, lanes, operand_a, operand_b):
+        values = self.reg[lanes, operand_a].tolist()
+
+        for lane, value in zip(lanes.tolist(), values):
+            self.outputs[lane] += PRA_BYTES[value]
+
+    def handle_prn(self, lanes, operand_a, operand_b):
+        values = self.reg[lanes, operand_a].tolist()
+
+        for lane, value in zip(lanes.tolist(), values):
+            self.outputs[lane] += PRN_BYTES[value]
+
+    def handle_push(self, lanes, operand_a, operand_b):
+        # The value is read after the SP is decremented, like CPU.handle_push()
+        self.reg[lanes, 7] -= 1
+        self.ram[lanes, self.reg[lanes, 7]] = self.reg[lanes, operand_a]
+
+    def handle_ret(self, lanes, operand_a, operand_b):
+        self.pc[lanes] = self.pop(lanes)
+
+    def handle_shl(self, lanes, operand_a, operand_b):
+        # Shifting by 8 or more leaves nothing, as it does on the CPU
+        shift = np.minimum(self.reg[lanes, operand_b], 8).astype(np.uint16)
+        value = self.reg[lanes, operand_a].astype(np.uint16)
+
+        self.reg[lanes, operand_a] = (value << shift) & 0xFF
+
+    def handle_shr(self, lanes, operand_a, operand_b):
+        shift = np.minimum(self.reg[lanes, operand_b], 8).astype(np.uint16)
+        value = self.reg[lanes, operand_a].astype(np.uint16)
+
+        self.reg[lanes, operand_a] = value >> shift
+
+    def handle_st(self, lanes, operand_a, operand_b):
+        self.ram[lanes, self.reg[lanes, operand_a]] = self.reg[lanes, operand_b]
+
+    def handle_sub(self, lanes, operand_a, operand_b):
+        self.reg[lanes, operand_a] -= self.reg[lanes, operand_b]
+
+    def handle_xor(self, lanes, operand_a, operand_b):
+        self.reg[lanes, operand_a] ^= self.reg[lanes, operand_b]
+
+    def check_divisor(self, lanes, operand_b):
+        """
+        Halt the lanes that would divide by zero, and return the rest
+        """
+        zero = self.reg[lanes, operand_b] == 0
+
+        if not zero.any():
+            return lanes
+
+        self.halt(lanes[zero], "division by zero")
+
+        return lanes[~zero]
+
+    def halt(self, lanes, reason):
+        """
+        Stop the given lanes
+        """
+        self.running[lanes] = False
+
+        for lane in lanes.tolist():
+            self.halt_reasons[lane] = reason
+
+    def push(self, lanes, values):
+        """
+        Push a value onto the stack of each of the given lanes
+        """
+        self.reg[lanes, 7] -= 1
+        self.ram[lanes, self.reg[lanes, 7]] = values
+
+    def pop(self, lanes):
+        """
+        Pop a value off the stack of each of the given lanes
+        """
+        values = self.ram[lanes, self.reg[lanes, 7]]
+        self.reg[lanes, 7] += 1
+
+        return values
+
+    def run(self, max_cycles=None):
+        """
+        Run every lane until it halts, or until it has executed max_cycles
+        instructions. Returns a list with a RunResult for each lane.
+        """
+        start = self.cycles.copy()
+        output_start = [len(output) for output in self.outputs]
+
+        while True:
+            ready = self.running
+
+            if max_cycles is not None:
+                ready = ready & (self.cycles - start < max_cycles)
+
+            waiting = np.flatnonzero(ready)
+
+            if waiting.size == 0:
+                break
+
+            # Run the lanes at the lowest PC
+            pcs = self.pc[waiting]
+            pc = int(pcs.min())
+            lanes = waiting[pcs == pc]
+
+            # Fetch the instruction and operands from each lane's own RAM,
+            # since a program can change its code differently in each lane
+            instructions = self.ram[lanes, pc]
+            operands_a = self.ram[lanes, (pc + 1) & 0xFF]
+            operands_b = self.ram[lanes, (pc + 2) & 0xFF]
+
+            instruction = int(instructions[0])
+            operand_a = int(operands_a[0])
+            operand_b = int(operands_b[0])
+
+            same = ((instructions == instruction) &
+                    (operands_a == operand_a) &
+                    (operands_b == operand_b))
+
+            # Lanes whose code differs from the first lane's run in a later step
+            if not same.all():
+                lanes = lanes[same]
+
+            handler = self.handlers.get(instruction)
+
+            if handler is None:
+                raise Exception(
+                    "Unknown instruction %02X at address %02X" % (instruction, pc)
+                )
+
+            handler(lanes, operand_a, operand_b)
+
+            # Advance the PC past the instruction and its operands, unless the
+            # instruction set the PC itself
+            if not (instruction >> 4) & 0b0001:
+                self.pc[lanes] = (pc + (instruction >> 6) + 1) & 0xFF
+
+            self.cycles[lanes] += 1
+
+        return self.results(start, output_start)
+
+    def results(self, start, output_start):
+        """
+        Build a RunResult for each lane, for a run that started when the lanes
+        had executed the given numbers of cycles, and written the given
+        numbers of bytes of output
+        """
+        results = []
+
+        for lane in range(self.lanes):
+            halt_reason = self.halt_reasons[lane]
+
+            if halt_reason is None:
+                halt_reason = "max_cycles"
+
+            results.append(RunResult(
+                halt_reason,
+                int(self.cycles[lane] - start[lane]),
+                self.outputs[lane][output_start[lane]:].decode("latin-1"),
+            ))
+
+        return results
+
+    def lane(self, number):
+        """
+        Get a CPU in the same state as one of the lanes, e.g. to inspect it or
+        keep running it on its own
+        """
+        cpu = self.cpu.fork()
+
+        cpu.memory[:] = self.ram[number].tobytes()
+        cpu.reg[:] = self.reg[number].tobytes()
+        cpu.invalidate_range(0, len(cpu.ram))
+
+        cpu.pc = int(self.pc[number])
+        cpu.fl = int(self.fl[number])
+        cpu.cycles = int(self.cycles[number])
+        cpu.halt_reason = self.halt_reasons[number]
+        cpu.running = cpu.halt_reason is None
+
+        return cpu
@@ -0,0 +1,294 @@
+"""Binary execution trace recorder for the LS-8.
+
+TraceRecorder runs a CPU and writes a fixed-size record for every instruction
+into a preallocated ring buffer, so only the most recent records are kept. The
+buffer lives in memory, or in a file through mmap so it survives a crash.
+
+The trace format is a header followed by the ring buffer:
+
+    header  magic b"LS8T", version (1 byte), record size (1 byte),
+            reserved (2 bytes), capacity in records (4 bytes)
+    record  cycle (8 bytes), PC, IR, operand A, operand B, FL, R0-R7
+            (1 byte each)
+
+All multi-byte values are little-endian. Records are numbered by cycle,
+starting at 1, so the decoder can put the ring back in order. Slots that were
+never written have cycle 0.
+
+Usage: ls8.py trace [options] tracefile
+"""
+
+import argparse
+import mmap
+import struct
+import sys
+
+MAGIC = b"LS8T"
+VERSION = 1
+
+HEADER = struct.Struct("<4sBBHI")
+RECORD = struct.Struct("<QBBBBB8s")
+
+# Number of records kept by default
+DEFAULT_CAPACITY = 65536
+
+
+class TraceRecorder:
+    """Execution engine that runs a CPU and records every instruction."""
+
+    def __init__(self, cpu, capacity=DEFAULT_CAPACITY, path=None):
+        """
+        Construct a recorder for the program loaded into the given CPU. If path
+        is given, the ring buffer is a file mapped into memory.
+        """
+        if capacity <= 0:
+            raise ValueError("Trace capacity must be positive, not %r"
+                             % capacity)
+
+        self.cpu = cpu
+        self.capacity = capacity
+
+        # Slot the next record goes in
+        self.index = 0
+
+        size = HEADER.size + capacity * RECORD.size
+
+        if path is None:
+            self.file = None
+            self.buffer = bytearray(size)
+        else:
+            self.file = open(path, "w+b")
+            self.file.truncate(size)
+            self.buffer = mmap.mmap(self.file.fileno(), size)
+
+        HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, RECORD.size, 0, capacity)
+
+    def close(self):
+        """
+        Write a file-backed trace out and unmap it
+        """
+        if self.file is not None:
+            self.buffer.flush()
+            self.buffer.close()
+            self.file.close()
+            self.file = None
+
+    def dump(self, path):
+        """
+        Write the trace to a file, e.g. for an in-memory trace after a crash
+        """
+        with open(path, "wb") as file:
+            file.write(self.buffer)
+
+    def run(self, max_cycles=None):
+        """
+        Run the CPU until it halts, or until it has executed max_cycles
+        instructions. Returns a RunResult, just like CPU.run().
+        """
+        return self.cpu.run(max_cycles, self.execute)
+
+    def execute(self, max_cycles=None):
+        """
+        Recording copy of CPU.execute()
+        """
+        cpu = self.cpu
+        decode_cache = cpu.decode_cache
+
+        pack_into = RECORD.pack_into
+        buffer = self.buffer
+        capacity = self.capacity
+        index = self.index
+
+        # Cycle number of the first instruction in this slice
+        first_cycle = cpu.cycles + 1
+        cycles = 0
+
+        try:
+            while cpu.running:
+                if cycles == max_cycles:
+                    break
+
+                # Look up the decoded instruction at the PC, decoding it on a
+                # miss
+                entry = decode_cache.get(cpu.pc)
+
+                if entry is None:
+                    entry = cpu.decode(cpu.pc)
+
+                instruction, handler, operand_a, operand_b, pc_advance = entry
+
+                # Record the state before the instruction runs
+                pack_into(buffer, HEADER.size + index * RECORD.size,
+                          first_cycle + cycles, cpu.pc, instruction,
+                          operand_a, operand_b, cpu.fl, cpu.reg)
+
+                index += 1
+
+                if index == capacity:
+                    index = 0
+
+                # Update the slot index before running the instruction, so
+                # nothing is lost if it raises
+                self.index = index
+
+                cpu.ir = instruction
+
+                handler(operand_a, operand_b)
+
+                cpu.pc += pc_advance
+                cycles += 1
+        except BaseException:
+            # run() only counts slices that return, so count the
+            # instructions that ran before the one that raised
+            cpu.cycles += cycles
+            raise
+
+        return cycles
+
+
+def read_trace(path):
+    """
+    Read the records in a trace file, oldest first. Each record is a tuple of
+    (cycle, pc, ir, operand_a, operand_b, fl, registers)
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+
+    magic, version, record_size, _, capacity = HEADER.unpack_from(data, 0)
+
+    if magic != MAGIC:
+        raise ValueError("Not an LS-8 trace")
+
+    if version != VERSION or record_size != RECORD.size:
+        raise ValueError("Unsupported LS-8 trace version %d" % version)
+
+    records = []
+
+    for index in range(capacity):
+        record = RECORD.unpack_from(data, HEADER.size + index * RECORD.size)
+
+        # Skip slots that were never written
+        if record[0] != 0:
+            records.append(record)
+
+    records.sort()
+
+    return records
+
+
+def label_table(symbols):
+    """
+    Describe every address by the nearest label at or before it, e.g.
+    "LOOP+3". Returns a list indexed by address
+    """
+    labels = [""] * 256
+    by_address = {address: label for label, address in symbols.items()}
+
+    label = None
+    start = 0
+
+    for address in range(256):
+        if address in by_address:
+            label = by_address[address]
+            start = address
+
+        if label is None:
+            continue
+
+        if address == start:
+            labels[address] = label
+        else:
+            labels[address] = "%s+%d" % (label, address - start)
+
+    return labels
+
+
+def format_record(record, names, labels=None):
+    """
+    Format a record like CPU.trace() does, followed by the label for the PC
+    if there's a label table from label_table()
+    """
+    cycle, pc, ir, operand_a, operand_b, fl, registers = record
+
+    line = "%10d | PC: %02X | FL: %02X | %02X %02X %02X | %-4s |" % (
+        cycle, pc, fl, ir, operand_a, operand_b, names.get(ir, "??"))
+
+    for value in registers:
+        line += " %02X" % value
+
+    if labels is not None and labels[pc]:
+        line += " | " + labels[pc]
+
+    return line
+
+
+def parse_range(text):
+    """
+    Parse a PC range like "10-1F" (hex) into (low, high)
+    """
+    low, _, high = text.partition("-")
+
+    if high == "":
+        high = low
+
+    return int(low, 16), int(high, 16)
+
+
+def main(argv):
+    from cpu import CPU
+
+    parser = argparse.ArgumentParser(
+        prog="ls8.py trace",
+        description="Show the instructions recorded in an LS-8 trace file.",
+    )
+    parser.add_argument("tracefile", help="trace written by ls8.py --trace")
+    parser.add_argument("--pc", metavar="LOW-HIGH", type=parse_range,
+                        default=None, help="only show this PC range (hex)")
+    parser.add_argument("--opcode", action="append", default=None,
+                        help="only show this opcode (can be repeated)")
+    parser.add_argument("--last", metavar="N", type=int, default=None,
+                        help="only show the last N matching instructions")
+    parser.add_argument("--program", metavar="FILE", default=None,
+                        help="program the trace was recorded from (.asm or "
+                             ".ls8b), to show labels")
+    args = parser.parse_args(argv)
+
+    if args.last is not None and args.last < 0:
+        parser.error("--last can't be negative")
+
+    opcodes = CPU().opcodes
+    names = {code: name for name, code in opcodes.items()}
+
+    labels = None
+
+    if args.program is not None:
+        cpu = CPU()
+        cpu.load(args.program)
+        labels = label_table(cpu.symbols)
+
+    records = read_trace(args.tracefile)
+
+    if args.pc is not None:
+        low, high = args.pc
+        records = [r for r in records if low <= r[1] <= high]
+
+    if args.opcode is not None:
+        wanted = set()
+
+        for name in args.opcode:
+            if name.upper() not in opcodes:
+                print(f"unknown opcode: {name}", file=sys.stderr)
+                return 1
+
+            wanted.add(opcodes[name.upper()])
+
+        records = [r for r in records if r[2] in wanted]
+
+    if args.last is not None:
+        # Not records[-args.last:], which is every record for --last 0
+        records = records[max(0, len(records) - args.last):]
+
+    for record in records:
+        print(format_record(record, names, labels))
+
+    return 0